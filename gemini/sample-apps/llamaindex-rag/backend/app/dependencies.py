@@ -1,7 +1,12 @@
 import logging
 
-from backend.app.shared_state import index_manager, prompts
-from shared_state import IndexManager, Prompts
+from backend.app.shared_state import (
+    eval_job_manager,
+    index_manager,
+    prompts,
+    response_scorer,
+)
+from shared_state import EvalJobManager, IndexManager, Prompts, ResponseScorer
 
 logger = logging.getLogger(__name__)
 
@@ -15,3 +20,11 @@ def get_index_manager() -> IndexManager:
 
 def get_prompts() -> Prompts:
     return prompts
+
+
+def get_response_scorer() -> ResponseScorer:
+    return response_scorer
+
+
+def get_eval_job_manager() -> EvalJobManager:
+    return eval_job_manager
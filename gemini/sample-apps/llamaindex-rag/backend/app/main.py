@@ -1,6 +1,8 @@
+from contextlib import asynccontextmanager
 import logging
 
-from backend.app.routers import evaluation, indexes, prompts, rag
+from backend.app.routers import evaluation, indexes, metrics, prompts, rag
+from backend.rag.node_reranker import aclose_sessions
 from fastapi import FastAPI
 import uvicorn
 
@@ -8,13 +10,21 @@ import uvicorn
 logging.basicConfig(filename="eval.log", encoding="utf-8", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await aclose_sessions()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Include routers
 app.include_router(prompts.router, tags=["prompts"])
 app.include_router(indexes.router, tags=["indexes"])
 app.include_router(rag.router, tags=["rag"])
 app.include_router(evaluation.router, tags=["evaluation"])
+app.include_router(metrics.router, tags=["metrics"])
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8033)
@@ -40,4 +40,5 @@ class EvalRequest(RAGConfig):
     embedding_model_name: str | None = "text-embedding-004"
     input_eval_dataset_bucket_uri: str = "test_rag_questions/test_ground_truth.csv"
     bq_eval_results_table_id: str = "eval_results.eval_results_table"
+    write_to_bq: bool = False
     ragas_metrics: list[str] = ["faithfulness", "answer_relevancy"]
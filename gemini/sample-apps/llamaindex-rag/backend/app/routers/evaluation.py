@@ -1,46 +1,38 @@
-from datetime import datetime
 import logging
-import uuid
 
-from backend.app.dependencies import get_index_manager, get_prompts
+from backend.app.dependencies import (
+    get_eval_job_manager,
+    get_index_manager,
+    get_prompts,
+)
 from backend.app.models import EvalRequest
+from backend.rag.eval_jobs import RAGAS_METRICS
 from backend.rag.evaluate import LLMEvaluator
-from common.utils import download_blob
-from datasets import Dataset
-from fastapi import APIRouter, Depends
-from langchain_google_vertexai import ChatVertexAI, VertexAIEmbeddings
-import pandas as pd
-from ragas import evaluate
-from ragas.metrics import (
-    answer_correctness,
-    answer_relevancy,
-    answer_similarity,
-    context_precision,
-    context_recall,
-    context_relevancy,
-    faithfulness,
-)
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.encoders import jsonable_encoder
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-ragas_metrics_dict = {
-    "context_precision": context_precision,
-    "answer_relevancy": answer_relevancy,
-    "faithfulness": faithfulness,
-    "context_relevancy": context_relevancy,
-    "context_recall": context_recall,
-    "answer_similarity": answer_similarity,
-    "answer_correctness": answer_correctness,
-}
-
 
 @router.post("/eval_batch")
 def eval_batch(
     eval_batch_request: EvalRequest,
     index_manager=Depends(get_index_manager),
     prompts=Depends(get_prompts),
+    eval_job_manager=Depends(get_eval_job_manager),
 ) -> dict:
+    """
+    Starts a background batch evaluation job and returns its status.
+    Resubmitting the same request and dataset resumes an interrupted or
+    failed job; progress and results are fetched from /eval_batch/{job_id}.
+    """
+    unknown_metrics = set(eval_batch_request.ragas_metrics) - set(RAGAS_METRICS)
+    if unknown_metrics:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown RAGAS metrics: {sorted(unknown_metrics)}"
+        )
+
     query_engine = index_manager.get_query_engine(
         prompts=prompts,
         llm_name=eval_batch_request.llm_name,
@@ -53,17 +45,10 @@ def eval_batch(
         qa_followup=eval_batch_request.qa_followup,
         hybrid_retrieval=eval_batch_request.hybrid_retrieval,
     )
-    bucket_name = eval_batch_request.input_eval_dataset_bucket_uri.split("/")[0]
-    file_name = "/".join(
-        eval_batch_request.input_eval_dataset_bucket_uri.split("/")[1:]
+    logger.info(eval_batch_request.input_eval_dataset_bucket_uri)
+    dataset_path = eval_job_manager.download_dataset(
+        eval_batch_request.input_eval_dataset_bucket_uri
     )
-    logger.info(bucket_name)
-    logger.info(file_name)
-    download_blob(bucket_name, file_name, "ground_truth.csv")
-    eval_df = pd.read_csv("./ground_truth.csv")
-    eval_df = eval_df[["question", "ground_truth"]]
-    eval_df = eval_df.astype({"question": str, "ground_truth": str})
-    logging.info(eval_df.dtypes)
 
     llm_evaluator = LLMEvaluator(
         system_prompt=prompts.eval_prompt_wcontext_system,
@@ -78,37 +63,35 @@ def eval_batch(
             llm_name=eval_batch_request.llm_name,
             temperature=eval_batch_request.temperature,
         )
-        eval_df = llm_evaluator.evaluate(react_agent.achat, eval_df)
+        retrieval_qa_func = react_agent.achat
     else:
-        eval_df = llm_evaluator.evaluate(query_engine.aquery, eval_df)
+        retrieval_qa_func = query_engine.aquery
 
-    vertexai_llm = ChatVertexAI(model_name=eval_batch_request.eval_model_name)
-    vertexai_embeddings = VertexAIEmbeddings(
-        model_name=eval_batch_request.embedding_model_name
+    job_status = eval_job_manager.submit(
+        request=eval_batch_request.model_dump(),
+        dataset_path=dataset_path,
+        retrieval_qa_func=retrieval_qa_func,
+        llm_evaluator=llm_evaluator,
     )
-    eval_df = eval_df.rename(columns={"retrieved_context": "contexts"})
-    eval_df_ds = Dataset.from_pandas(eval_df)
-    logger.info(eval_df.columns)
+    logger.info(f"EVAL JOB ID: {job_status['job_id']}")
+    return job_status
 
-    metrics = [ragas_metrics_dict[m] for m in eval_batch_request.ragas_metrics]
-    result = evaluate(
-        eval_df_ds, metrics=metrics, llm=vertexai_llm, embeddings=vertexai_embeddings
-    )
-    ragas_results_df = result.to_pandas()[eval_batch_request.ragas_metrics].fillna(0)
-
-    eval_uuid = str(uuid.uuid4())
-    eval_df["date_time"] = datetime.now()
-    eval_df["eval_uuid"] = eval_uuid
-    eval_df["retrieval_strategy"] = eval_batch_request.retrieval_strategy
-    eval_df["eval_model_name"] = eval_batch_request.eval_model_name
-    eval_df["similarity_top_k"] = eval_batch_request.similarity_top_k
-    eval_df["llm_model_name"] = eval_batch_request.llm_name
-    eval_df["question_idx"] = eval_df.index
 
-    eval_df = pd.concat([eval_df, ragas_results_df], axis=1)
-    logging.info(eval_df.to_dict(orient="list"))
-
-    # Uncomment the following line if you want to write results to BigQuery
-    # write_results_to_bq(eval_df, table_id=eval_batch_request.bq_eval_results_table_id)
-    logging.info(f"EVAL ID: {eval_uuid}")
-    return eval_df.to_dict(orient="list")
+@router.get("/eval_batch/{job_id}")
+def eval_batch_status(
+    job_id: str,
+    include_results: bool = False,
+    eval_job_manager=Depends(get_eval_job_manager),
+) -> dict:
+    """
+    Returns the status and progress of a batch evaluation job. With
+    include_results, the rows scored so far are returned under "results"
+    as lists of column values.
+    """
+    job_status = eval_job_manager.get_status(job_id)
+    if job_status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown eval job: {job_id}")
+    if include_results:
+        results_df = eval_job_manager.get_results(job_id)
+        job_status["results"] = jsonable_encoder(results_df.to_dict(orient="list"))
+    return job_status
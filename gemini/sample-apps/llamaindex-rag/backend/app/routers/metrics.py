@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def get_metrics() -> Response:
+    """Prometheus metrics, including per-stage RAG query latencies"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
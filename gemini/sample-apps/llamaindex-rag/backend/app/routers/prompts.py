@@ -1,4 +1,4 @@
-from backend.app.dependencies import get_prompts
+from backend.app.dependencies import get_index_manager, get_prompts
 from backend.app.models import PromptUpdate
 from fastapi import APIRouter, Depends, HTTPException
 
@@ -12,10 +12,13 @@ async def get_all_prompts(prompts=Depends(get_prompts)) -> dict:
 
 @router.post("/update_prompt")
 async def update_prompt(
-    prompt_update: PromptUpdate, prompts=Depends(get_prompts)
+    prompt_update: PromptUpdate,
+    prompts=Depends(get_prompts),
+    index_manager=Depends(get_index_manager),
 ) -> None:
     try:
         prompts.update(prompt_update.prompt_name, prompt_update.new_content)
+        index_manager.clear_query_engine_cache()
         return {"message": f"Prompt {prompt_update.prompt_name} updated successfully"}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -1,23 +1,45 @@
+from collections.abc import AsyncGenerator
+import json
 import logging
 
-from backend.app.dependencies import get_index_manager, get_prompts
+from backend.app.dependencies import (
+    get_index_manager,
+    get_prompts,
+    get_response_scorer,
+)
 from backend.app.models import RAGRequest
-from datasets import Dataset
-from fastapi import APIRouter, Depends
-from langchain_google_vertexai import ChatVertexAI, VertexAIEmbeddings
-import pandas as pd
-from ragas import evaluate
-from ragas.metrics import answer_relevancy, context_relevancy, faithfulness
+from backend.rag.tracing import config_labels, trace_query
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from llama_index.core.schema import QueryBundle
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Upper bound for long-polling /eval_results
+MAX_EVAL_WAIT_SECONDS = 120.0
+
+
+def get_trace_labels(rag_request: RAGRequest) -> dict[str, str]:
+    """Metric labels for the query engine configuration of a request"""
+    return config_labels(
+        llm_name=rag_request.llm_name,
+        retrieval_strategy=rag_request.retrieval_strategy,
+        use_hyde=rag_request.use_hyde,
+        qa_followup=rag_request.qa_followup,
+        hybrid_retrieval=rag_request.hybrid_retrieval,
+        use_node_rerank=rag_request.use_node_rerank,
+        use_react=rag_request.use_react,
+    )
+
 
 @router.post("/query_rag")
 async def query_rag(
     rag_request: RAGRequest,
     index_manager=Depends(get_index_manager),
     prompts=Depends(get_prompts),
+    response_scorer=Depends(get_response_scorer),
 ) -> dict:
     query_engine = index_manager.get_query_engine(
         prompts=prompts,
@@ -31,49 +53,136 @@ async def query_rag(
         qa_followup=rag_request.qa_followup,
         hybrid_retrieval=rag_request.hybrid_retrieval,
     )
-    if rag_request.use_react:
-        react_agent = index_manager.get_react_agent(
-            prompts=prompts,
-            llm_name=rag_request.llm_name,
-            temperature=rag_request.temperature,
-        )
-        response = await react_agent.achat(rag_request.query)
-    else:
-        response = await query_engine.aquery(rag_request.query)
+    with trace_query(get_trace_labels(rag_request)):
+        if rag_request.use_react:
+            react_agent = index_manager.get_react_agent(
+                prompts=prompts,
+                llm_name=rag_request.llm_name,
+                temperature=rag_request.temperature,
+            )
+            response = await react_agent.achat(rag_request.query)
+        else:
+            response = await query_engine.aquery(rag_request.query)
 
     if rag_request.evaluate_response:
-        retrieved_contexts = [r.node.text for r in response.source_nodes]
-        eval_df = pd.DataFrame(
-            {
-                "question": rag_request.query,
-                "answer": [response.response],
-                "contexts": [retrieved_contexts],
-            }
-        )
-        eval_df_ds = Dataset.from_pandas(eval_df)
-
-        vertexai_llm = ChatVertexAI(model_name=rag_request.eval_model_name)
-        vertexai_embeddings = VertexAIEmbeddings(
-            model_name=rag_request.embedding_model_name
-        )
-
-        metrics = [answer_relevancy, faithfulness, context_relevancy]
-        result = evaluate(
-            eval_df_ds,
-            metrics=metrics,
-            llm=vertexai_llm,
-            embeddings=vertexai_embeddings,
+        # Score in the background; results are fetched from /eval_results/{eval_id}
+        eval_id = response_scorer.submit(
+            question=rag_request.query,
+            answer=response.response,
+            contexts=[r.node.text for r in response.source_nodes],
+            eval_model_name=rag_request.eval_model_name,
+            embedding_model_name=rag_request.embedding_model_name,
         )
-        result_dict = (
-            result.to_pandas()[
-                ["answer_relevancy", "faithfulness", "context_relevancy"]
-            ]
-            .fillna(0)
-            .iloc[0]
-            .to_dict()
-        )
-        retrieved_context_dict = {"retrieved_chunks": response.source_nodes}
-        logger.info(result_dict)
-        return {"response": response.response} | result_dict | retrieved_context_dict
+        logger.info(f"EVAL ID: {eval_id}")
+        return {
+            "response": response.response,
+            "eval_id": eval_id,
+            "retrieved_chunks": response.source_nodes,
+        }
     else:
         return {"response": response.response}
+
+
+def format_sse(event: str, data) -> str:
+    """Format a Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+
+@router.post("/query_rag_stream")
+async def query_rag_stream(
+    rag_request: RAGRequest,
+    index_manager=Depends(get_index_manager),
+    prompts=Depends(get_prompts),
+    response_scorer=Depends(get_response_scorer),
+) -> StreamingResponse:
+    """
+    Streams a RAG response as Server-Sent Events:
+    - "sources": the retrieved chunks, sent as soon as retrieval finishes
+    - "token": {"delta": ...} for each synthesized token
+    - "done": {"response": ..., "eval_id": ...} once generation finishes
+    - "error": {"detail": ...} if the query fails
+    ReAct agent responses are not streamed and arrive as a single token.
+    """
+
+    async def event_stream() -> AsyncGenerator[str, None]:
+        try:
+            with trace_query(get_trace_labels(rag_request)):
+                if rag_request.use_react:
+                    index_manager.get_query_engine(
+                        prompts=prompts,
+                        llm_name=rag_request.llm_name,
+                        temperature=rag_request.temperature,
+                        similarity_top_k=rag_request.similarity_top_k,
+                        retrieval_strategy=rag_request.retrieval_strategy,
+                        use_hyde=rag_request.use_hyde,
+                        use_refine=rag_request.use_refine,
+                        use_node_rerank=rag_request.use_node_rerank,
+                        qa_followup=rag_request.qa_followup,
+                        hybrid_retrieval=rag_request.hybrid_retrieval,
+                    )
+                    react_agent = index_manager.get_react_agent(
+                        prompts=prompts,
+                        llm_name=rag_request.llm_name,
+                        temperature=rag_request.temperature,
+                    )
+                    response = await react_agent.achat(rag_request.query)
+                    source_nodes = response.source_nodes
+                    yield format_sse("sources", {"retrieved_chunks": source_nodes})
+                    answer = response.response
+                    yield format_sse("token", {"delta": answer})
+                else:
+                    query_engine = index_manager.get_query_engine(
+                        prompts=prompts,
+                        llm_name=rag_request.llm_name,
+                        temperature=rag_request.temperature,
+                        similarity_top_k=rag_request.similarity_top_k,
+                        retrieval_strategy=rag_request.retrieval_strategy,
+                        use_hyde=rag_request.use_hyde,
+                        use_refine=rag_request.use_refine,
+                        use_node_rerank=rag_request.use_node_rerank,
+                        qa_followup=rag_request.qa_followup,
+                        hybrid_retrieval=rag_request.hybrid_retrieval,
+                        streaming=True,
+                    )
+                    query_bundle = QueryBundle(rag_request.query)
+                    source_nodes = await query_engine.aretrieve(query_bundle)
+                    yield format_sse("sources", {"retrieved_chunks": source_nodes})
+
+                    answer = ""
+                    async for token in query_engine.astream_synthesize(
+                        query_bundle, source_nodes
+                    ):
+                        answer += token
+                        yield format_sse("token", {"delta": token})
+
+            done = {"response": answer}
+            if rag_request.evaluate_response:
+                done["eval_id"] = response_scorer.submit(
+                    question=rag_request.query,
+                    answer=answer,
+                    contexts=[r.node.text for r in source_nodes],
+                    eval_model_name=rag_request.eval_model_name,
+                    embedding_model_name=rag_request.embedding_model_name,
+                )
+                logger.info(f"EVAL ID: {done['eval_id']}")
+            yield format_sse("done", done)
+        except Exception as e:
+            logger.exception("Streaming query failed")
+            yield format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@router.get("/eval_results/{eval_id}")
+async def get_eval_results(
+    eval_id: str,
+    wait: float = 0.0,
+    response_scorer=Depends(get_response_scorer),
+) -> dict:
+    """Returns the RAGAS scores of a /query_rag response, waiting up to `wait` seconds."""
+    result = await response_scorer.wait_for_result(
+        eval_id, min(wait, MAX_EVAL_WAIT_SECONDS)
+    )
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Unknown eval_id {eval_id}")
+    return result
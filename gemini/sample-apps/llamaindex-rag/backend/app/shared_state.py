@@ -1,5 +1,8 @@
+from backend.rag.eval_jobs import EvalJobManager
 from backend.rag.index_manager import IndexManager
 from backend.rag.prompts import Prompts
+from backend.rag.response_scorer import ResponseScorer
+from backend.rag.tracing import configure_tracing
 from common.utils import load_config
 
 config = load_config()
@@ -18,9 +21,33 @@ QA_ENDPOINT_NAME = config.get("qa_endpoint_name")
 FIRESTORE_DB_NAME = config.get("firestore_db_name")
 FIRESTORE_NAMESPACE = config.get("firestore_namespace")
 BUCKET_NAME = config.get("docstore_bucket_name")
+QUERY_ENGINE_CACHE_SIZE = config.get("query_engine_cache_size", 8)
+BM25_INDEX_DIR = config.get("bm25_index_dir", "/tmp/bm25_index")
+EVAL_MAX_WORKERS = config.get("eval_max_workers", 4)
+EVAL_RESULTS_CACHE_SIZE = config.get("eval_results_cache_size", 1000)
+EVAL_MAX_PENDING = config.get("eval_max_pending", 100)
+EVAL_JOBS_DIR = config.get("eval_jobs_dir", "/tmp/eval_jobs")
+EVAL_BATCH_CONCURRENCY = config.get("eval_batch_concurrency", 8)
+EVAL_BATCH_SIZE = config.get("eval_batch_size", 100)
+EVAL_BATCH_MAX_RETRIES = config.get("eval_batch_max_retries", 6)
+EVAL_MAX_JOBS = config.get("eval_max_jobs", 2)
+TRACING_ENABLED = config.get("tracing_enabled", True)
+SPECULATIVE_HYDE = config.get("speculative_hyde", False)
+HYDE_CACHE_SIZE = config.get("hyde_cache_size", 1024)
+HYDE_CACHE_TTL_SECONDS = config.get("hyde_cache_ttl_seconds", 3600)
+DOCSTORE_CACHE_SIZE = config.get("docstore_cache_size", 10000)
+DOCSTORE_DISK_CACHE_DIR = config.get("docstore_disk_cache_dir")
+DOCSTORE_VERSION_CHECK_SECONDS = config.get("docstore_version_check_seconds", 60)
+INDEX_POOL_SIZE = config.get("index_pool_size", 4)
+INDEX_ID_CACHE_TTL_SECONDS = config.get("index_id_cache_ttl_seconds", 600)
+VECTOR_STORE_BACKEND = config.get("vector_store_backend", "vertex")
+LOCAL_VECTOR_INDEX_DIR = config.get("local_vector_index_dir", "/tmp/local_vector_index")
+LOCAL_VECTOR_NPROBE = config.get("local_vector_nprobe", 16)
 
 # Initialize State of Prompts and Indexes
 
+# Tracing wraps retrievers and docstores, so it is configured before indexes load
+configure_tracing(TRACING_ENABLED)
 prompts = Prompts()
 index_manager = IndexManager(
     project_id=PROJECT_ID,
@@ -33,4 +60,30 @@ index_manager = IndexManager(
     firestore_db_name=FIRESTORE_DB_NAME,
     firestore_namespace=FIRESTORE_NAMESPACE,
     vs_bucket_name=BUCKET_NAME,
+    query_engine_cache_size=QUERY_ENGINE_CACHE_SIZE,
+    vector_data_prefix=VECTOR_DATA_PREFIX,
+    bm25_index_dir=BM25_INDEX_DIR,
+    speculative_hyde=SPECULATIVE_HYDE,
+    hyde_cache_size=HYDE_CACHE_SIZE,
+    hyde_cache_ttl=HYDE_CACHE_TTL_SECONDS,
+    docstore_cache_size=DOCSTORE_CACHE_SIZE,
+    docstore_disk_cache_dir=DOCSTORE_DISK_CACHE_DIR,
+    docstore_version_check_interval=DOCSTORE_VERSION_CHECK_SECONDS,
+    index_pool_size=INDEX_POOL_SIZE,
+    index_id_cache_ttl=INDEX_ID_CACHE_TTL_SECONDS,
+    vector_store_backend=VECTOR_STORE_BACKEND,
+    local_vector_index_dir=LOCAL_VECTOR_INDEX_DIR,
+    local_vector_nprobe=LOCAL_VECTOR_NPROBE,
+)
+response_scorer = ResponseScorer(
+    max_workers=EVAL_MAX_WORKERS,
+    max_results=EVAL_RESULTS_CACHE_SIZE,
+    max_pending=EVAL_MAX_PENDING,
+)
+eval_job_manager = EvalJobManager(
+    jobs_dir=EVAL_JOBS_DIR,
+    concurrency=EVAL_BATCH_CONCURRENCY,
+    batch_size=EVAL_BATCH_SIZE,
+    max_retries=EVAL_BATCH_MAX_RETRIES,
+    max_jobs=EVAL_MAX_JOBS,
 )
@@ -0,0 +1,6 @@
+"""Offline benchmarks of the RAG pipelines built by IndexManager"""
+from google.cloud import aiplatform
+
+# backend.rag.node_reranker creates a Vertex LLM at import time, which needs a
+# project ID (but no credentials or network access) to be constructed
+aiplatform.init(project="offline-benchmark", location="us-central1")
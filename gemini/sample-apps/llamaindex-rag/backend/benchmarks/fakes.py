@@ -0,0 +1,478 @@
+"""Deterministic local stand-ins for the Vertex AI services used by IndexManager"""
+import asyncio
+import math
+import os
+import re
+import time
+from typing import Any
+import zlib
+
+from backend.rag.bm25_index import PersistentBM25Index
+from backend.rag.index_manager import IndexManager
+from backend.rag.local_vector_store import LocalVectorStore
+from backend.rag.tracing import traced_docstore
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms import (
+    CompletionResponse,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.schema import (
+    BaseNode,
+    NodeRelationship,
+    ObjectType,
+    RelatedNodeInfo,
+    TextNode,
+)
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+import numpy as np
+
+BASE_INDEX_NAME = "offline_base"
+QA_INDEX_NAME = "offline_qa"
+_WORD_PATTERN = re.compile(r"\w+")
+_DOCUMENT_PATTERN = re.compile(r"^Document (\d+):$", flags=re.MULTILINE)
+
+
+class SyntheticCorpus:
+    """
+    Deterministic hierarchical corpus shaped like the hierarchical indexing output.
+
+    Every document has `parents_per_doc` parent chunks, each split into
+    `leaves_per_parent` leaf chunks, and every parent chunk has one
+    hypothetical question (QA node). Only the leaf token ids are kept in
+    memory; nodes are materialized on demand, so corpora of a million
+    leaf nodes stay small.
+    """
+
+    def __init__(
+        self,
+        num_nodes: int,
+        tokens_per_node: int = 48,
+        vocab_size: int = 5000,
+        leaves_per_parent: int = 4,
+        parents_per_doc: int = 4,
+        seed: int = 0,
+    ):
+        self.num_nodes = num_nodes
+        self.tokens_per_node = tokens_per_node
+        self.leaves_per_parent = leaves_per_parent
+        self.parents_per_doc = parents_per_doc
+        self.seed = seed
+        self.num_parents = math.ceil(num_nodes / leaves_per_parent)
+        self.num_docs = math.ceil(self.num_parents / parents_per_doc)
+        self.vocab = [f"w{i}" for i in range(vocab_size)]
+
+        # Zipfian word frequencies, so BM25 and hashed embeddings see
+        # realistic term distributions
+        rng = np.random.default_rng(seed)
+        probs = 1.0 / np.arange(1, vocab_size + 1) ** 1.1
+        probs /= probs.sum()
+        self.token_ids = np.empty((num_nodes, tokens_per_node), dtype=np.uint16)
+        for start in range(0, num_nodes, 100_000):
+            stop = min(start + 100_000, num_nodes)
+            self.token_ids[start:stop] = rng.choice(
+                vocab_size, size=(stop - start, tokens_per_node), p=probs
+            )
+
+    @staticmethod
+    def leaf_id(i: int) -> str:
+        return f"leaf-{i}"
+
+    @staticmethod
+    def parent_id(p: int) -> str:
+        return f"parent-{p}"
+
+    @staticmethod
+    def doc_id(d: int) -> str:
+        return f"doc-{d}"
+
+    @staticmethod
+    def qa_id(p: int) -> str:
+        return f"qa-{p}"
+
+    def leaf_text(self, i: int) -> str:
+        return " ".join(self.vocab[t] for t in self.token_ids[i])
+
+    def qa_token_ids(self) -> np.ndarray:
+        """Token ids of every QA node: the start of its parent's first leaf"""
+        first_leaves = np.arange(self.num_parents) * self.leaves_per_parent
+        return self.token_ids[first_leaves, :12]
+
+    def parent_leaves(self, p: int) -> range:
+        start = p * self.leaves_per_parent
+        return range(start, min(start + self.leaves_per_parent, self.num_nodes))
+
+    def doc_parents(self, d: int) -> range:
+        start = d * self.parents_per_doc
+        return range(start, min(start + self.parents_per_doc, self.num_parents))
+
+    def get_node(self, node_id: str) -> BaseNode | None:
+        """Materializes a leaf, parent, document or QA node from its id"""
+        kind, _, idx = node_id.partition("-")
+        if not idx.isdigit():
+            return None
+        idx = int(idx)
+        if kind == "leaf" and idx < self.num_nodes:
+            p = idx // self.leaves_per_parent
+            return TextNode(
+                id_=node_id,
+                text=self.leaf_text(idx),
+                relationships={
+                    NodeRelationship.PARENT: RelatedNodeInfo(
+                        node_id=self.parent_id(p), node_type=ObjectType.TEXT
+                    ),
+                    NodeRelationship.SOURCE: RelatedNodeInfo(
+                        node_id=self.doc_id(p // self.parents_per_doc),
+                        node_type=ObjectType.DOCUMENT,
+                    ),
+                },
+            )
+        if kind == "parent" and idx < self.num_parents:
+            leaves = self.parent_leaves(idx)
+            return TextNode(
+                id_=node_id,
+                text="\n".join(self.leaf_text(i) for i in leaves),
+                relationships={
+                    NodeRelationship.CHILD: [
+                        RelatedNodeInfo(node_id=self.leaf_id(i)) for i in leaves
+                    ],
+                    NodeRelationship.SOURCE: RelatedNodeInfo(
+                        node_id=self.doc_id(idx // self.parents_per_doc),
+                        node_type=ObjectType.DOCUMENT,
+                    ),
+                },
+            )
+        if kind == "doc" and idx < self.num_docs:
+            return TextNode(
+                id_=node_id,
+                text="\n\n".join(
+                    self.leaf_text(i)
+                    for p in self.doc_parents(idx)
+                    for i in self.parent_leaves(p)
+                ),
+            )
+        if kind == "qa" and idx < self.num_parents:
+            tokens = self.token_ids[idx * self.leaves_per_parent, :12]
+            return TextNode(
+                id_=node_id,
+                text=" ".join(self.vocab[t] for t in tokens) + "?",
+                relationships={
+                    NodeRelationship.SOURCE: RelatedNodeInfo(
+                        node_id=self.parent_id(idx), node_type=ObjectType.TEXT
+                    )
+                },
+            )
+        return None
+
+    def iter_leaf_nodes(self, batch_size: int = 50_000):
+        """Yields the leaf nodes in batches"""
+        for start in range(0, self.num_nodes, batch_size):
+            stop = min(start + batch_size, self.num_nodes)
+            yield [self.get_node(self.leaf_id(i)) for i in range(start, stop)]
+
+    def sample_queries(self, num_queries: int, seed: int = 1) -> list[str]:
+        """Queries made of words from random leaves, so every query has matches"""
+        rng = np.random.default_rng(seed)
+        queries = []
+        for i in rng.integers(0, self.num_nodes, size=num_queries):
+            tokens = rng.choice(self.token_ids[i], size=8, replace=False)
+            queries.append(" ".join(self.vocab[t] for t in tokens))
+        return queries
+
+
+class HashEmbedding(BaseEmbedding):
+    """
+    Feature-hashing bag-of-words embedder. Each word adds +/-1 to one of
+    `dim` buckets chosen by its CRC32, so embeddings are deterministic and
+    texts sharing words are similar.
+    """
+
+    dim: int = Field(default=64, description="Embedding dimension.")
+    latency: float = Field(default=0.0, description="Seconds slept per call.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _buckets(self, words: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        hashes = np.array([zlib.crc32(w.encode()) for w in words], dtype=np.int64)
+        signs = np.where((hashes >> 16) & 1, 1.0, -1.0).astype(np.float32)
+        return hashes % self.dim, signs
+
+    def embed_text(self, text: str) -> list[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        words = _WORD_PATTERN.findall(text.lower())
+        if words:
+            buckets, signs = self._buckets(words)
+            np.add.at(vector, buckets, signs)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_token_ids(self, token_ids: np.ndarray, vocab: list[str]) -> np.ndarray:
+        """Embeds rows of vocabulary ids at once, matching embed_text"""
+        buckets, signs = self._buckets(vocab)
+        vectors = np.zeros((len(token_ids), self.dim), dtype=np.float32)
+        rows = np.repeat(np.arange(len(token_ids)), token_ids.shape[1])
+        np.add.at(vectors, (rows, buckets[token_ids].ravel()), signs[token_ids].ravel())
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _get_query_embedding(self, query: str) -> list[float]:
+        time.sleep(self.latency)
+        return self.embed_text(query)
+
+    async def _aget_query_embedding(self, query: str) -> list[float]:
+        await asyncio.sleep(self.latency)
+        return self.embed_text(query)
+
+    def _get_text_embedding(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return self.embed_text(text)
+
+
+class FakeLLM(CustomLLM):
+    """
+    LLM which sleeps for `latency` seconds and answers deterministically.
+    Choice-select (rerank) prompts get a parseable ranking of their
+    documents; any other prompt is answered with its last words.
+    """
+
+    latency: float = Field(default=0.0, description="Seconds slept per call.")
+    num_output_tokens: int = Field(default=32, description="Words per answer.")
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="fake-llm")
+
+    def _respond(self, prompt: str) -> str:
+        num_docs = max(map(int, _DOCUMENT_PATTERN.findall(prompt)), default=0)
+        if num_docs:
+            return "\n".join(
+                f"Doc: {i}, Relevance: {10 - (i - 1) % 10}"
+                for i in range(1, num_docs + 1)
+            )
+        return " ".join(_WORD_PATTERN.findall(prompt)[-self.num_output_tokens :])
+
+    @llm_completion_callback()
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        time.sleep(self.latency)
+        return CompletionResponse(text=self._respond(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        await asyncio.sleep(self.latency)
+        return CompletionResponse(text=self._respond(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        time.sleep(self.latency)
+        text = ""
+        for word in self._respond(prompt).split(" "):
+            delta = f" {word}" if text else word
+            text += delta
+            yield CompletionResponse(text=text, delta=delta)
+
+
+class InMemoryVectorStore(BasePydanticVectorStore):
+    """
+    Exact dot-product search over a dense float32 matrix. Like the
+    Vertex AI Vector Search store it returns the matched nodes' text.
+    """
+
+    stores_text: bool = True
+    _embeddings: np.ndarray = PrivateAttr()
+    _node_ids: list[str] = PrivateAttr()
+    _corpus: SyntheticCorpus = PrivateAttr()
+
+    def __init__(
+        self, embeddings: np.ndarray, node_ids: list[str], corpus: SyntheticCorpus
+    ) -> None:
+        super().__init__()
+        self._embeddings = embeddings
+        self._node_ids = node_ids
+        self._corpus = corpus
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "InMemoryVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def add(self, nodes: list[BaseNode], **add_kwargs: Any) -> list[str]:
+        raise NotImplementedError("The synthetic corpus is read-only")
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        raise NotImplementedError("The synthetic corpus is read-only")
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        scores = self._embeddings @ np.asarray(query.query_embedding, np.float32)
+        k = min(query.similarity_top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        ids = [self._node_ids[i] for i in top]
+        return VectorStoreQueryResult(
+            nodes=[self._corpus.get_node(node_id) for node_id in ids],
+            similarities=scores[top].tolist(),
+            ids=ids,
+        )
+
+
+class SyntheticDocumentStore(SimpleDocumentStore):
+    """
+    In-memory docstore serving the synthetic corpus. Corpus nodes are
+    materialized on lookup; nodes added explicitly are stored as usual.
+    """
+
+    def __init__(self, corpus: SyntheticCorpus, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._corpus = corpus
+
+    def get_document(self, doc_id: str, raise_error: bool = True) -> BaseNode | None:
+        node = self._corpus.get_node(doc_id)
+        if node is None:
+            return super().get_document(doc_id, raise_error=raise_error)
+        return node
+
+    async def aget_document(
+        self, doc_id: str, raise_error: bool = True
+    ) -> BaseNode | None:
+        return self.get_document(doc_id, raise_error=raise_error)
+
+    def document_exists(self, doc_id: str) -> bool:
+        return self._corpus.get_node(doc_id) is not None or super().document_exists(
+            doc_id
+        )
+
+    async def adocument_exists(self, doc_id: str) -> bool:
+        return self.document_exists(doc_id)
+
+
+class OfflineIndexManager(IndexManager):
+    """
+    IndexManager over a SyntheticCorpus, with FakeLLM for every LLM and
+    HashEmbedding for embeddings. Query engines are built by the regular
+    IndexManager code, so benchmarks exercise the production pipelines.
+    With vector_store_backend "local", vectors are searched by a
+    LocalVectorStore built under local_vector_index_dir instead of exactly.
+    """
+
+    def __init__(
+        self,
+        corpus: SyntheticCorpus,
+        bm25_index_dir: str,
+        embed_dim: int = 64,
+        llm_latency: float = 0.0,
+        embed_latency: float = 0.0,
+        query_engine_cache_size: int = 0,
+        speculative_hyde: bool = False,
+        hyde_cache_size: int = 0,
+        vector_store_backend: str = "vertex",
+        local_vector_index_dir: str = "/tmp/local_vector_index",
+    ):
+        self.corpus = corpus
+        self.embed_dim = embed_dim
+        self.llm_latency = llm_latency
+        self.embed_latency = embed_latency
+        self.docstore = SyntheticDocumentStore(corpus)
+        # Embedding matrices by index name, for measuring recall
+        self.embeddings: dict[str, np.ndarray] = {}
+        super().__init__(
+            project_id="offline-benchmark",
+            location="us-central1",
+            base_index_name=BASE_INDEX_NAME,
+            base_endpoint_name=BASE_INDEX_NAME,
+            qa_index_name=QA_INDEX_NAME,
+            qa_endpoint_name=QA_INDEX_NAME,
+            embeddings_model_name="hash-embedding",
+            firestore_db_name=None,
+            firestore_namespace="offline",
+            vs_bucket_name="offline-benchmark",
+            query_engine_cache_size=query_engine_cache_size,
+            bm25_index_dir=bm25_index_dir,
+            speculative_hyde=speculative_hyde,
+            hyde_cache_size=hyde_cache_size,
+            vector_store_backend=vector_store_backend,
+            local_vector_index_dir=local_vector_index_dir,
+        )
+
+    def get_embed_model(self) -> HashEmbedding:
+        return HashEmbedding(dim=self.embed_dim, latency=self.embed_latency)
+
+    def get_vertex_llm(
+        self, llm_name: str, temperature: float, system_prompt: str
+    ) -> FakeLLM:
+        return FakeLLM(latency=self.llm_latency, system_prompt=system_prompt)
+
+    def get_reranker_llm(self, temperature: float, system_prompt: str) -> FakeLLM:
+        return FakeLLM(latency=self.llm_latency, system_prompt=system_prompt)
+
+    def get_vector_index(
+        self,
+        index_name: str,
+        endpoint_name: str,
+        firestore_db_name: str | None,
+        firestore_namespace: str | None,
+    ) -> VectorStoreIndex:
+        if index_name == QA_INDEX_NAME:
+            token_ids = self.corpus.qa_token_ids()
+            node_ids = [self.corpus.qa_id(p) for p in range(self.corpus.num_parents)]
+        else:
+            token_ids = self.corpus.token_ids
+            node_ids = [self.corpus.leaf_id(i) for i in range(self.corpus.num_nodes)]
+        embeddings = np.concatenate(
+            [
+                self.embed_model.embed_token_ids(
+                    token_ids[start : start + 100_000], self.corpus.vocab
+                )
+                for start in range(0, len(token_ids), 100_000)
+            ]
+        )
+        self.embeddings[index_name] = embeddings
+        if self.vector_store_backend == "local":
+            vector_store = LocalVectorStore(
+                os.path.join(self.local_vector_index_dir, index_name),
+                nprobe=self.local_vector_nprobe,
+            )
+            for start in range(0, len(node_ids), 50_000):
+                vector_store.add_embeddings(
+                    [
+                        self.corpus.get_node(node_id)
+                        for node_id in node_ids[start : start + 50_000]
+                    ],
+                    embeddings[start : start + 50_000],
+                )
+            vector_store.persist()
+        else:
+            vector_store = InMemoryVectorStore(embeddings, node_ids, self.corpus)
+        storage_context = StorageContext.from_defaults(
+            vector_store=vector_store, docstore=traced_docstore(self.docstore)
+        )
+        return VectorStoreIndex(
+            nodes=[], storage_context=storage_context, embed_model=self.embed_model
+        )
+
+    def get_bm25_index(self) -> PersistentBM25Index:
+        with self._bm25_lock:
+            if self._bm25_index is None:
+                bm25_index = PersistentBM25Index(self.bm25_index_dir)
+                for nodes in self.corpus.iter_leaf_nodes():
+                    bm25_index.add_nodes(nodes)
+                self._bm25_index = bm25_index
+            return self._bm25_index
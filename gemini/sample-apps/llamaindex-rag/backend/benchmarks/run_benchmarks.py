@@ -0,0 +1,313 @@
+"""
+Benchmarks every IndexManager query engine configuration against
+synthetic corpora, using the local stand-ins in backend.benchmarks.fakes.
+
+Example:
+    python -m backend.benchmarks.run_benchmarks --num-nodes 1000 100000 \
+        --llm-latency-ms 50 --output benchmark_results.json
+"""
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from backend.benchmarks.fakes import (
+    BASE_INDEX_NAME,
+    OfflineIndexManager,
+    SyntheticCorpus,
+)
+from backend.rag.prompts import Prompts
+from backend.rag.tracing import config_labels, configure_tracing, trace_query
+import llama_index.core
+from llama_index.core.vector_stores.types import VectorStoreQuery
+import numpy as np
+
+logger = logging.getLogger(__name__)
+# Progress is reported even when --log-level silences the backend modules
+logger.setLevel(logging.INFO)
+
+RETRIEVAL_STRATEGIES = ["auto_merging", "parent", "baseline"]
+PERCENTILES = [50, 90, 99]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux)"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    """Latency percentiles and mean in milliseconds"""
+    latencies_ms = np.asarray(latencies) * 1000
+    summary = {
+        f"p{p}": float(v)
+        for p, v in zip(PERCENTILES, np.percentile(latencies_ms, PERCENTILES))
+    }
+    summary["mean"] = float(latencies_ms.mean())
+    return summary
+
+
+def get_configurations(retrieval_strategies: list[str]) -> list[dict]:
+    """Every combination of the benchmarked get_query_engine flags"""
+    flags = ["use_hyde", "qa_followup", "hybrid_retrieval", "use_node_rerank"]
+    return [
+        {"retrieval_strategy": retrieval_strategy} | dict(zip(flags, values))
+        for retrieval_strategy in retrieval_strategies
+        for values in itertools.product([False, True], repeat=len(flags))
+    ]
+
+
+async def run_staged_query(
+    query_engine, query_str: str, labels: dict[str, str]
+) -> dict[str, float]:
+    """
+    Answers a query with aquery, timing each traced stage: hyde, retrieve
+    (and the retrievers within it), rerank and synthesize. Stages that run
+    more than once per query, e.g. retrieve with speculative HyDE, are summed.
+    """
+    start = time.perf_counter()
+    with trace_query(labels) as query_trace:
+        await query_engine.aquery(query_str)
+    timings = dict(query_trace.stage_seconds)
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+async def measure_throughput(
+    query_engine, queries: list[str], concurrency: int
+) -> dict:
+    """Runs aquery over the queries with at most `concurrency` in flight"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run_query(query_str: str) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await query_engine.aquery(query_str)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_query(q) for q in queries])
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "queries": len(queries),
+        "queries_per_second": len(queries) / elapsed,
+        "latency_ms": latency_summary(latencies),
+    }
+
+
+async def benchmark_configuration(
+    index_manager: OfflineIndexManager,
+    prompts: Prompts,
+    configuration: dict,
+    queries: list[str],
+    concurrency_levels: list[int],
+) -> dict:
+    start = time.perf_counter()
+    query_engine = index_manager.get_query_engine(prompts=prompts, **configuration)
+    build_seconds = time.perf_counter() - start
+
+    # Warm up lazily loaded state (e.g. the BM25 index) outside the timings
+    await query_engine.aquery(queries[0])
+
+    labels = config_labels(llm_name="fake", **configuration)
+    stage_timings: dict[str, list[float]] = {}
+    for query_str in queries:
+        timings = await run_staged_query(query_engine, query_str, labels)
+        for stage, seconds in timings.items():
+            stage_timings.setdefault(stage, []).append(seconds)
+
+    throughput = []
+    for concurrency in concurrency_levels:
+        num_queries = max(len(queries), 4 * concurrency)
+        throughput.append(
+            await measure_throughput(
+                query_engine,
+                [queries[i % len(queries)] for i in range(num_queries)],
+                concurrency,
+            )
+        )
+    return configuration | {
+        "engine_build_seconds": build_seconds,
+        "stages_ms": {
+            stage: latency_summary(seconds) for stage, seconds in stage_timings.items()
+        },
+        "throughput": throughput,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def vector_recall(
+    index_manager: OfflineIndexManager, queries: list[str], top_k: int = 10
+) -> float:
+    """Mean recall@k of the base vector store against exact search"""
+    embeddings = index_manager.embeddings[BASE_INDEX_NAME]
+    vector_store = index_manager.base_index.vector_store
+    recalls = []
+    for query_str in queries:
+        query_embedding = index_manager.embed_model.embed_text(query_str)
+        scores = embeddings @ np.asarray(query_embedding, np.float32)
+        exact = np.argpartition(-scores, top_k - 1)[:top_k]
+        result = vector_store.query(
+            VectorStoreQuery(query_embedding=query_embedding, similarity_top_k=top_k)
+        )
+        # Ties at the k-th score make either node a correct answer
+        threshold = scores[exact].min()
+        hits = sum(similarity >= threshold - 1e-3 for similarity in result.similarities)
+        recalls.append(hits / top_k)
+    return float(np.mean(recalls))
+
+
+def benchmark_corpus(num_nodes: int, args: argparse.Namespace) -> dict:
+    """Benchmarks every configuration against one corpus size"""
+    # The backend modules configure INFO logging when imported
+    logging.getLogger().setLevel(args.log_level)
+    # Stages are timed by tracing, which wraps retrievers as engines are built
+    configure_tracing(True)
+    setup_seconds = {}
+    start = time.perf_counter()
+    corpus = SyntheticCorpus(num_nodes, seed=args.seed)
+    setup_seconds["corpus"] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        start = time.perf_counter()
+        index_manager = OfflineIndexManager(
+            corpus,
+            bm25_index_dir=os.path.join(index_dir, "bm25"),
+            vector_store_backend=args.vector_store_backend,
+            local_vector_index_dir=os.path.join(index_dir, "ann"),
+            embed_dim=args.embed_dim,
+            llm_latency=args.llm_latency_ms / 1000,
+            embed_latency=args.embed_latency_ms / 1000,
+            speculative_hyde=args.speculative_hyde,
+        )
+        setup_seconds["vector_indexes"] = time.perf_counter() - start
+        if any(c["hybrid_retrieval"] for c in args.configurations):
+            start = time.perf_counter()
+            index_manager.get_bm25_index()
+            setup_seconds["bm25_index"] = time.perf_counter() - start
+
+        prompts = Prompts()
+        queries = corpus.sample_queries(args.queries, seed=args.seed + 1)
+        vector_recall_at_10 = (
+            vector_recall(index_manager, queries)
+            if args.vector_store_backend == "local"
+            else 1.0
+        )
+        results = []
+        for configuration in args.configurations:
+            logger.info(f"{num_nodes} nodes: benchmarking {configuration}")
+            results.append(
+                asyncio.run(
+                    benchmark_configuration(
+                        index_manager,
+                        prompts,
+                        configuration,
+                        queries,
+                        args.concurrency,
+                    )
+                )
+            )
+
+    return {
+        "num_nodes": num_nodes,
+        "num_parents": corpus.num_parents,
+        "num_docs": corpus.num_docs,
+        "setup_seconds": setup_seconds,
+        "vector_recall_at_10": vector_recall_at_10,
+        "peak_rss_mb": peak_rss_mb(),
+        "results": results,
+    }
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict:
+    """
+    Benchmarks each corpus size in a fresh process, so peak RSS is
+    reported per corpus rather than for the largest one seen so far.
+    """
+    corpora = []
+    for num_nodes in args.num_nodes:
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            corpora.append(executor.submit(benchmark_corpus, num_nodes, args).result())
+    return {
+        "settings": {
+            key: value for key, value in vars(args).items() if key != "configurations"
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "llama_index_core": llama_index.core.__version__,
+        },
+        "corpora": corpora,
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--num-nodes",
+        type=int,
+        nargs="+",
+        default=[1000, 10_000, 100_000],
+        help="Leaf node counts of the synthetic corpora (up to 1,000,000)",
+    )
+    parser.add_argument(
+        "--retrieval-strategies",
+        nargs="+",
+        default=RETRIEVAL_STRATEGIES,
+        choices=RETRIEVAL_STRATEGIES,
+    )
+    parser.add_argument(
+        "--queries", type=int, default=20, help="Queries per configuration"
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=10.0)
+    parser.add_argument("--embed-dim", type=int, default=64)
+    parser.add_argument(
+        "--vector-store-backend",
+        choices=["vertex", "local"],
+        default="vertex",
+        help="'vertex' is stood in for by exact search, 'local' is the "
+        "LocalVectorStore",
+    )
+    parser.add_argument(
+        "--speculative-hyde",
+        action="store_true",
+        help="Retrieve on the original query while HyDE runs",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument(
+        "--output", default="-", help="Path of the JSON report, '-' for stdout"
+    )
+    args = parser.parse_args(argv)
+    args.configurations = get_configurations(args.retrieval_strategies)
+    return args
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(args.log_level)
+    report = json.dumps(run_benchmarks(args), indent=2)
+    if args.output == "-":
+        print(report)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
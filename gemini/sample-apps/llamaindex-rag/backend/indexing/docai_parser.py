@@ -1,5 +1,10 @@
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 import json
 import logging
+import queue
+import threading
 import time
 import traceback
 
@@ -11,6 +16,11 @@ from llama_index.core import Document
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Document AI limit on the number of files in one batch process request
+MAX_DOCUMENTS_PER_REQUEST = 5000
+# Put on the queue of parsed shards once every shard is parsed
+_DONE = object()
+
 
 class DocAIParser:
     """
@@ -23,12 +33,16 @@ class DocAIParser:
         location: str,
         processor_name: str,
         gcs_output_path: str,
+        download_workers: int = 16,
     ):
         self.project_id = project_id
         self.location = location
         self.processor_name = processor_name
         self.gcs_output_path = gcs_output_path
         self._client = self._initialize_client()
+        self._download_executor = ThreadPoolExecutor(
+            max_workers=download_workers, thread_name_prefix="docai-download"
+        )
 
     def _initialize_client(self):
         options = ClientOptions(
@@ -52,26 +66,25 @@ class DocAIParser:
             chunk_size: Chunk size for Document AI processing.
             include_ancestor_headings: Whether to include ancestor headings.
             timeout_sec: Timeout in seconds for the operation.
-            check_in_interval_sec: Check-in interval in seconds.
+            check_in_interval_sec: Maximum check-in interval in seconds.
 
         Returns:
             A tuple containing a list of parsed documents and a list of
             DocAIParsingResults.
         """
+        parsed_docs = []
+        results = []
         try:
-            operations = self._start_batch_process(
-                blobs, chunk_size, include_ancestor_headings
-            )
-            print(f"Number of operations started: {len(operations)}")
-            self._wait_for_operations(operations, timeout_sec, check_in_interval_sec)
-            print("Operations completed successfully")
-
-            for i, operation in enumerate(operations):
-                print(f"Operation {i + 1} metadata: {operation.metadata}")
-
-            results = self._get_results(operations)
+            for shard_docs, shard_results in self.iter_batch_parse(
+                blobs,
+                chunk_size=chunk_size,
+                include_ancestor_headings=include_ancestor_headings,
+                timeout_sec=timeout_sec,
+                max_check_in_interval_sec=check_in_interval_sec,
+            ):
+                parsed_docs.extend(shard_docs)
+                results.extend(shard_results)
             print(f"Number of results: {len(results)}")
-            parsed_docs = self._parse_from_results(results)
             print(f"Number of parsed documents: {len(parsed_docs)}")
             return parsed_docs, results
         except Exception as e:
@@ -80,7 +93,163 @@ class DocAIParser:
             traceback.print_exc()
             # Return any successfully parsed documents
             # instead of raising an exception
-            return [], []
+            return parsed_docs, results
+
+    def iter_batch_parse(
+        self,
+        blobs: list[Blob],
+        chunk_size: int = 500,
+        include_ancestor_headings: bool = True,
+        timeout_sec: int = 3600,
+        shard_size: int = 500,
+        max_concurrent_operations: int = 5,
+        min_check_in_interval_sec: float = 5,
+        max_check_in_interval_sec: float = 60,
+        max_ready_shards: int | None = None,
+    ) -> Iterator[tuple[list[Document], list["DocAIParsingResults"]]]:  # noqa: F821
+        """
+        Parses blobs in shards of `shard_size`, keeping up to
+        `max_concurrent_operations` Document AI batch operations running.
+
+        Operations are started and polled on a background thread, so new
+        shards keep starting while the consumer processes the yielded ones.
+        As each operation finishes, its output JSON is downloaded and parsed
+        concurrently while the other operations keep running, and the parsed
+        documents are yielded with their DocAIParsingResults. Up to
+        `max_ready_shards` parsed shards (defaults to
+        `max_concurrent_operations`) wait for the consumer. Operations are
+        polled every `min_check_in_interval_sec`, backing off up to
+        `max_check_in_interval_sec` while nothing finishes.
+        Failed operations are logged and skipped.
+        """
+        if not 0 < shard_size <= MAX_DOCUMENTS_PER_REQUEST:
+            raise ValueError(
+                f"shard_size must be between 1 and {MAX_DOCUMENTS_PER_REQUEST}"
+            )
+        pending_shards = deque(
+            blobs[start : start + shard_size]
+            for start in range(0, len(blobs), shard_size)
+        )
+        logger.info(f"Parsing {len(blobs)} blobs in {len(pending_shards)} shards")
+        ready: queue.Queue = queue.Queue(
+            maxsize=max_ready_shards or max_concurrent_operations
+        )
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._run_batch_parse,
+            args=(
+                pending_shards,
+                ready,
+                stop,
+                chunk_size,
+                include_ancestor_headings,
+                time.monotonic() + timeout_sec,
+                max_concurrent_operations,
+                min_check_in_interval_sec,
+                max_check_in_interval_sec,
+            ),
+            name="docai-batch-parse",
+            daemon=True,
+        )
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Lets the thread exit if the consumer stops early
+            stop.set()
+
+    @staticmethod
+    def _put(ready: queue.Queue, item, stop: threading.Event) -> bool:
+        """Puts an item on the queue of parsed shards unless the consumer
+        stopped, returning whether it was put"""
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run_batch_parse(
+        self,
+        pending_shards: deque,
+        ready: queue.Queue,
+        stop: threading.Event,
+        chunk_size: int,
+        include_ancestor_headings: bool,
+        deadline: float,
+        max_concurrent_operations: int,
+        min_check_in_interval_sec: float,
+        max_check_in_interval_sec: float,
+    ) -> None:
+        """Runs the operations of iter_batch_parse, putting each parsed
+        shard, then _DONE or the error that stopped it, on `ready`"""
+        check_in_interval = min_check_in_interval_sec
+        running_operations = []
+        parsing: dict[Future, list[DocAIParsingResults]] = {}
+
+        try:
+            with ThreadPoolExecutor(
+                max_workers=max_concurrent_operations,
+                thread_name_prefix="docai-parse",
+            ) as parse_executor:
+                while (
+                    pending_shards or running_operations or parsing
+                ) and not stop.is_set():
+                    while (
+                        pending_shards
+                        and len(running_operations) < max_concurrent_operations
+                    ):
+                        running_operations.extend(
+                            self._start_batch_process(
+                                pending_shards.popleft(),
+                                chunk_size,
+                                include_ancestor_headings,
+                            )
+                        )
+
+                    finished = [op for op in running_operations if op.done()]
+                    for operation in finished:
+                        running_operations.remove(operation)
+                        if operation.exception():
+                            logger.error(f"Operation failed: {operation.exception()}")
+                            continue
+                        logger.info(f"Operation finished: {operation.operation.name}")
+                        results = self._get_results([operation])
+                        future = parse_executor.submit(
+                            self._parse_from_results, results
+                        )
+                        parsing[future] = results
+
+                    parsed = [future for future in parsing if future.done()]
+                    for future in parsed:
+                        if not self._put(
+                            ready, (future.result(), parsing.pop(future)), stop
+                        ):
+                            return
+
+                    if finished or parsed:
+                        check_in_interval = min_check_in_interval_sec
+                        continue
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("Timeout exceeded!")
+                    if parsing:
+                        # Wake up as soon as a shard's output is parsed
+                        wait(parsing, timeout=check_in_interval)
+                    elif stop.wait(check_in_interval):
+                        return
+                    check_in_interval = min(
+                        check_in_interval * 1.5, max_check_in_interval_sec
+                    )
+            self._put(ready, _DONE, stop)
+        except BaseException as e:
+            self._put(ready, e, stop)
 
     def _start_batch_process(
         self, blobs: list[Blob], chunk_size: int, include_ancestor_headings: bool
@@ -127,19 +296,6 @@ class DocAIParser:
             print(f"Error starting batch process: {str(e)}")
             raise
 
-    def _wait_for_operations(self, operations, timeout_sec, check_in_interval_sec):
-        time_elapsed = 0
-        while any(not operation.done() for operation in operations):
-            time.sleep(check_in_interval_sec)
-            time_elapsed += check_in_interval_sec
-            if time_elapsed > timeout_sec:
-                raise TimeoutError("Timeout exceeded!")
-
-        # Check for errors in completed operations
-        for operation in operations:
-            if operation.exception():
-                raise KeyError(f"Operation failed: {operation.exception()}")
-
     def _get_results(self, operations) -> list["DocAIParsingResults"]:  # noqa: F821
         results = []
         for operation in operations:
@@ -156,65 +312,77 @@ class DocAIParser:
                 print(f"Warning: Unexpected metadata structure: {metadata}")
         return results
 
-    def _parse_from_results(self, results: list["DocAIParsingResults"]):  # noqa: F821
-        documents = []
+    def _parse_from_results(
+        self, results: list["DocAIParsingResults"]  # noqa: F821
+    ) -> list[Document]:
+        """Downloads and parses the output of each result concurrently"""
         storage_client = storage.Client()
+        documents = [
+            doc
+            for docs in self._download_executor.map(
+                lambda result: self._parse_result(storage_client, result), results
+            )
+            for doc in docs
+        ]
+        print(f"Total documents created: {len(documents)}")
+        return documents
 
-        for result in results:
+    def _parse_result(
+        self,
+        storage_client: storage.Client,
+        result: "DocAIParsingResults",  # noqa: F821
+    ) -> list[Document]:
+        documents = []
+        print(
+            f"Processing result: source_path={result.source_path}, "
+            f"parsed_path={result.parsed_path}"
+        )
+        if not result.parsed_path:
             print(
-                f"Processing result: source_path={result.source_path}, "
-                f"parsed_path={result.parsed_path}"
+                "Warning: Empty parsed_path for source "
+                f"{result.source_path}. Skipping."
             )
-            if not result.parsed_path:
-                print(
-                    "Warning: Empty parsed_path for source "
-                    f"{result.source_path}. Skipping."
-                )
-                continue
-
-            try:
-                bucket_name, prefix = result.parsed_path.replace("gs://", "").split(
-                    "/", 1
-                )
-            except ValueError:
-                print(
-                    f"Error: Invalid parsed_path format for {result.source_path}. Skipping."
-                )
-                continue
-
-            bucket = storage_client.bucket(bucket_name)
-            blobs = list(bucket.list_blobs(prefix=prefix))
-            print(f"Found {len(blobs)} blobs in {result.parsed_path}")
-
-            for blob in blobs:
-                if blob.name.endswith(".json"):
-                    print(f"Processing JSON blob: {blob.name}")
-                    try:
-                        content = blob.download_as_text()
-                        doc_data = json.loads(content)
+            return documents
 
-                        if (
-                            "chunkedDocument" in doc_data
-                            and "chunks" in doc_data["chunkedDocument"]
-                        ):
-                            for chunk in doc_data["chunkedDocument"]["chunks"]:
-                                doc = Document(
-                                    text=chunk["content"],
-                                    metadata={
-                                        "chunk_id": chunk["chunkId"],
-                                        "source": result.source_path,
-                                    },
-                                )
-                                documents.append(doc)
-                        else:
-                            print(
-                                "Warning: Expected 'chunkedDocument' "
-                                f"structure not found in {blob.name}"
+        try:
+            bucket_name, prefix = result.parsed_path.replace("gs://", "").split("/", 1)
+        except ValueError:
+            print(
+                f"Error: Invalid parsed_path format for {result.source_path}. Skipping."
+            )
+            return documents
+
+        bucket = storage_client.bucket(bucket_name)
+        blobs = list(bucket.list_blobs(prefix=prefix))
+        print(f"Found {len(blobs)} blobs in {result.parsed_path}")
+
+        for blob in blobs:
+            if blob.name.endswith(".json"):
+                print(f"Processing JSON blob: {blob.name}")
+                try:
+                    content = blob.download_as_text()
+                    doc_data = json.loads(content)
+
+                    if (
+                        "chunkedDocument" in doc_data
+                        and "chunks" in doc_data["chunkedDocument"]
+                    ):
+                        for chunk in doc_data["chunkedDocument"]["chunks"]:
+                            doc = Document(
+                                text=chunk["content"],
+                                metadata={
+                                    "chunk_id": chunk["chunkId"],
+                                    "source": result.source_path,
+                                },
                             )
-                    except Exception as e:
-                        print(f"Error processing blob {blob.name}: {str(e)}")
-
-        print(f"Total documents created: {len(documents)}")
+                            documents.append(doc)
+                    else:
+                        print(
+                            "Warning: Expected 'chunkedDocument' "
+                            f"structure not found in {blob.name}"
+                        )
+                except Exception as e:
+                    print(f"Error processing blob {blob.name}: {str(e)}")
         return documents
 
 
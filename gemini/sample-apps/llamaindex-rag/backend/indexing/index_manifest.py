@@ -0,0 +1,104 @@
+"""
+Manifest of the source files indexed into a docstore namespace, recording
+the content hash of each source and the ids of the nodes it produced, so
+that run_parse_embed_index only re-indexes new or changed sources
+"""
+from collections.abc import Callable, Iterable
+from dataclasses import asdict, dataclass, field
+import hashlib
+import logging
+
+from llama_index.core.storage.kvstore.types import BaseKVStore
+
+logging.basicConfig(level=logging.INFO)  # Set the desired logging level
+logger = logging.getLogger(__name__)
+
+
+def index_manifest_collection(namespace: str) -> str:
+    """Collection holding the index manifest of a docstore namespace"""
+    return f"{namespace}/index_manifest"
+
+
+@dataclass
+class ManifestEntry:
+    """A source file and the nodes indexed from it"""
+
+    source: str
+    content_hash: str | None
+    # Nodes written to the docstore
+    node_ids: list[str] = field(default_factory=list)
+    # Nodes embedded into the vector index and the QA index
+    vector_ids: list[str] = field(default_factory=list)
+    qa_vector_ids: list[str] = field(default_factory=list)
+
+
+@dataclass
+class ManifestDiff:
+    """Sources to index, and entries whose nodes are stale"""
+
+    to_index: list = field(default_factory=list)
+    stale: list[ManifestEntry] = field(default_factory=list)
+    unchanged: int = 0
+
+
+class IndexManifest:
+    """Index manifest stored in the docstore's key-value store"""
+
+    def __init__(self, kvstore: BaseKVStore, namespace: str, batch_size: int = 100):
+        self._kvstore = kvstore
+        self._batch_size = batch_size
+        self._collection = index_manifest_collection(namespace)
+
+    @staticmethod
+    def _key(source: str) -> str:
+        # Source paths contain slashes, which Firestore document ids can't
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def load(self) -> dict[str, ManifestEntry]:
+        entries = self._kvstore.get_all(collection=self._collection)
+        return {value["source"]: ManifestEntry(**value) for value in entries.values()}
+
+    def diff(
+        self, blobs: Iterable, on_index: Callable[[object], None] | None = None
+    ) -> ManifestDiff:
+        """
+        Compares source blobs (with `path` and `content_hash` attributes)
+        against the manifest. Blobs that are new, changed or have no content
+        hash are to be indexed, and entries of changed or deleted sources are
+        stale. `on_index` is called with each blob to index as soon as it is
+        seen, e.g. to download it while `blobs` is still being listed.
+        """
+        entries = self.load()
+        diff = ManifestDiff()
+        for blob in blobs:
+            entry = entries.pop(blob.path, None)
+            if (
+                entry is not None
+                and blob.content_hash is not None
+                and blob.content_hash == entry.content_hash
+            ):
+                diff.unchanged += 1
+                continue
+            diff.to_index.append(blob)
+            if on_index is not None:
+                on_index(blob)
+            if entry is not None:
+                diff.stale.append(entry)
+        # Whatever is left was deleted from the bucket
+        diff.stale.extend(entries.values())
+        logger.info(
+            f"Index manifest: {len(diff.to_index)} sources to index, "
+            f"{len(diff.stale)} stale and {diff.unchanged} unchanged"
+        )
+        return diff
+
+    def put(self, entries: Iterable[ManifestEntry]) -> None:
+        self._kvstore.put_all(
+            [(self._key(entry.source), asdict(entry)) for entry in entries],
+            collection=self._collection,
+            batch_size=self._batch_size,
+        )
+
+    def delete(self, sources: Iterable[str]) -> None:
+        for source in sources:
+            self._kvstore.delete(self._key(source), collection=self._collection)
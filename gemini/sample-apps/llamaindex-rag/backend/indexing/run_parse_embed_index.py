@@ -2,31 +2,51 @@
 and indexing data living in a GCS bucket"""
 
 import asyncio
+from collections import defaultdict
 import logging
 import os
+import random
 
 from backend.indexing.docai_parser import DocAIParser
+from backend.indexing.index_manifest import IndexManifest, ManifestEntry
 from backend.indexing.prompts import QA_EXTRACTION_PROMPT, QA_PARSER_PROMPT
 from backend.indexing.vector_search_utils import (
     get_or_create_existing_index,
 )  # noqa: E501
-from common.utils import (
-    create_pdf_blob_list,
-    download_bucket_with_transfer_manager,
-    link_nodes,
+from backend.rag.bm25_index import (
+    bm25_index_dir,
+    bm25_index_prefix,
+    load_bm25_index,
+    upload_bm25_index,
 )
+from backend.rag.docstore_cache import read_index_version, write_index_version
+from backend.rag.local_vector_store import (
+    LocalVectorStore,
+    MirroredVectorStore,
+    load_local_vector_store,
+    local_vector_index_prefix,
+    upload_local_vector_store,
+)
+from backend.rag.quota import QuotaBackoff, is_quota_error
+from common.utils import BlobDownloader, iter_pdf_blobs, link_nodes
 from google.cloud import aiplatform
 from llama_index.core import Document, Settings, StorageContext, VectorStoreIndex
 from llama_index.core.extractors import QuestionsAnsweredExtractor
 from llama_index.core.node_parser import HierarchicalNodeParser, SentenceSplitter
 from llama_index.core.program import LLMTextCompletionProgram
-from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.schema import (
+    BaseNode,
+    NodeRelationship,
+    RelatedNodeInfo,
+    TextNode,
+)
 from llama_index.embeddings.vertex import VertexTextEmbedding
 from llama_index.llms.vertex import Vertex
 from llama_index.storage.docstore.firestore import FirestoreDocumentStore
+from llama_index.storage.kvstore.firestore import FirestoreKVStore
 from llama_index.vector_stores.vertexaivectorsearch import VertexAIVectorStore
 from pydantic import BaseModel
-from tqdm.asyncio import tqdm_asyncio
+from tqdm import tqdm
 import yaml
 
 logging.basicConfig(level=logging.INFO)  # Set the desired logging level
@@ -69,6 +89,13 @@ FIRESTORE_DB_NAME = config.get("firestore_db_name")
 FIRESTORE_NAMESPACE = config.get("firestore_namespace")
 QA_INDEX_NAME = config.get("qa_index_name")
 QA_ENDPOINT_NAME = config.get("qa_endpoint_name")
+BM25_INDEX_DIR = config.get("bm25_index_dir", "/tmp/bm25_index")
+QA_EXTRACTION_CONCURRENCY = config.get("qa_extraction_concurrency", 16)
+QA_EXTRACTION_MAX_RETRIES = config.get("qa_extraction_max_retries", 6)
+QA_UPSERT_BATCH_SIZE = config.get("qa_upsert_batch_size", 500)
+VECTOR_STORE_BACKEND = config.get("vector_store_backend", "vertex")
+BUILD_LOCAL_VECTOR_INDEX = config.get("build_local_vector_index", False)
+LOCAL_VECTOR_INDEX_DIR = config.get("local_vector_index_dir", "/tmp/local_vector_index")
 
 
 class QuesionsAnswered(BaseModel):
@@ -77,69 +104,151 @@ class QuesionsAnswered(BaseModel):
     questions_list: list[str]
 
 
-def create_qa_index(li_docs, docstore, embed_model, llm):
-    """creates index of hypothetical questions"""
-    qa_index, qa_endpoint = get_or_create_existing_index(
-        QA_INDEX_NAME, QA_ENDPOINT_NAME, APPROXIMATE_NEIGHBORS_COUNT
+def get_local_vector_store(index_name: str) -> LocalVectorStore:
+    return load_local_vector_store(
+        DOCSTORE_BUCKET_NAME,
+        prefix=local_vector_index_prefix(
+            VECTOR_DATA_PREFIX, FIRESTORE_NAMESPACE, index_name
+        ),
+        local_dir=LOCAL_VECTOR_INDEX_DIR,
     )
-    qa_vector_store = VertexAIVectorStore(
+
+
+def get_vector_store(index_name: str, endpoint_name: str):
+    """
+    Vector store to index into: a local vector index, a Vertex AI Vector
+    Search index, or both when build_local_vector_index is set
+    """
+    if VECTOR_STORE_BACKEND == "local":
+        return get_local_vector_store(index_name)
+    vs_index, vs_endpoint = get_or_create_existing_index(
+        index_name, endpoint_name, APPROXIMATE_NEIGHBORS_COUNT
+    )
+    vector_store = VertexAIVectorStore(
         project_id=PROJECT_ID,
         region=LOCATION,
-        index_id=qa_index.name,  # Use .name instead of .resource_name
-        endpoint_id=qa_endpoint.name,
+        index_id=vs_index.name,  # Use .name instead of .resource_name
+        endpoint_id=vs_endpoint.name,  # Use .name instead of .resource_name
         gcs_bucket_name=DOCSTORE_BUCKET_NAME,
     )
+    if BUILD_LOCAL_VECTOR_INDEX:
+        return MirroredVectorStore(vector_store, get_local_vector_store(index_name))
+    return vector_store
+
+
+def get_qa_vector_store():
+    return get_vector_store(QA_INDEX_NAME, QA_ENDPOINT_NAME)
+
+
+async def extract_questions(doc, qa_extractor, program, backoff) -> list[str] | None:
+    """Extracts and parses the questions answered by a document. Quota errors
+    pause every extraction with a shared backoff, and other errors are retried
+    after a jittered delay. Returns None if every attempt fails."""
+    for attempt in range(QA_EXTRACTION_MAX_RETRIES + 1):
+        await backoff.wait()
+        try:
+            metadata = await qa_extractor._aextract_questions_from_node(doc)
+            questions = await program.acall(questions_list=metadata)
+            backoff.record_success()
+            return questions.questions_list
+        except Exception as e:
+            if attempt == QA_EXTRACTION_MAX_RETRIES:
+                logger.warning(f"Unparsable questions for {doc.doc_id}: {e}")
+                return None
+            if is_quota_error(e):
+                delay = backoff.record_quota_error()
+                logger.warning(f"Quota error, backing off {delay:.1f}s: {e}")
+            else:
+                await asyncio.sleep(random.uniform(0, 2**attempt))
+
+
+async def build_qa_index(li_docs, qa_index, qa_extractor, program):
+    """
+    Extracts questions with at most `QA_EXTRACTION_CONCURRENCY` documents in
+    flight, embedding and upserting them in batches of `QA_UPSERT_BATCH_SIZE`
+    as they arrive. Returns the ids of the questions of each document.
+    """
+    docs = iter(li_docs)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=QA_UPSERT_BATCH_SIZE)
+    backoff = QuotaBackoff()
+    question_ids = defaultdict(list)
+    failed_docs = 0
+    progress = tqdm(total=len(li_docs), desc="Extracting questions")
+
+    async def extract_worker():
+        nonlocal failed_docs
+        for doc in docs:
+            questions = await extract_questions(doc, qa_extractor, program, backoff)
+            progress.update()
+            if questions is None:
+                failed_docs += 1
+                continue
+            for q in questions:
+                q_doc = Document(text=q)
+                q_doc.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(
+                    node_id=doc.doc_id
+                )
+                await queue.put(q_doc)
+
+    async def upsert_batches():
+        batch = []
+        while True:
+            q_doc = await queue.get()
+            if q_doc is not None:
+                batch.append(q_doc)
+            if batch and (q_doc is None or len(batch) >= QA_UPSERT_BATCH_SIZE):
+                # Embedding and upserting is blocking, so run it off the loop
+                await asyncio.to_thread(qa_index.insert_nodes, batch)
+                for question in batch:
+                    question_ids[question.ref_doc_id].append(question.doc_id)
+                batch = []
+            if q_doc is None:
+                return
+
+    async def extract_all():
+        await asyncio.gather(
+            *[extract_worker() for _ in range(QA_EXTRACTION_CONCURRENCY)]
+        )
+        await queue.put(None)
+
+    extractor = asyncio.create_task(extract_all())
+    upserter = asyncio.create_task(upsert_batches())
+    try:
+        # Awaited together, so an upsert error cancels the workers (which
+        # would otherwise block on the full queue) and is re-raised
+        await asyncio.gather(extractor, upserter)
+    finally:
+        extractor.cancel()
+        upserter.cancel()
+        progress.close()
+    if failed_docs:
+        logger.warning(f"No questions extracted for {failed_docs} documents")
+    return question_ids
+
+
+def create_qa_index(li_docs, docstore, qa_vector_store, embed_model, llm):
+    """creates index of hypothetical questions. Returns the documents
+    written to the docstore and the ids of the questions of each document"""
     qa_extractor = QuestionsAnsweredExtractor(
         llm, questions=5, prompt_template=QA_EXTRACTION_PROMPT
     )
-
-    async def extract_batch(li_docs):
-        return await tqdm_asyncio.gather(
-            *[qa_extractor._aextract_questions_from_node(doc) for doc in li_docs]
-        )
-
-    loop = asyncio.get_event_loop()
-    metadata_list = loop.run_until_complete(extract_batch(li_docs))
-
     program = LLMTextCompletionProgram.from_defaults(
         output_cls=QuesionsAnswered,
         prompt_template_str=QA_PARSER_PROMPT,
         verbose=True,
     )
-
-    async def parse_batch(metadata_list):
-        return await asyncio.gather(
-            *[program.acall(questions_list=x) for x in metadata_list],
-            return_exceptions=True,
-        )
-
-    parsed_questions = loop.run_until_complete(parse_batch(metadata_list))
-
-    loop.close()
-
-    q_docs = []
-    for doc, questions in zip(li_docs, parsed_questions):
-        if isinstance(questions, Exception):
-            logger.info(f"Unparsable questions exception {questions}")
-            continue
-        else:
-            for q in questions.questions_list:
-                logger.info(f"Question extracted: {q}")
-                q_doc = Document(text=q)
-                q_doc.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(
-                    node_id=doc.doc_id
-                )
-                q_docs.append(q_doc)
     docstore.add_documents(li_docs)
     storage_context = StorageContext.from_defaults(
         docstore=docstore, vector_store=qa_vector_store
     )
-    VectorStoreIndex(
-        nodes=q_docs,
+    qa_index = VectorStoreIndex(
+        nodes=[],
         storage_context=storage_context,
         embed_model=embed_model,
         llm=llm,
     )
+    question_ids = asyncio.run(build_qa_index(li_docs, qa_index, qa_extractor, program))
+    return li_docs, question_ids
 
 
 def create_hierarchical_index(li_docs, docstore, vector_store, embed_model, llm):
@@ -161,6 +270,7 @@ def create_hierarchical_index(li_docs, docstore, vector_store, embed_model, llm)
         embed_model=embed_model,
         llm=llm,
     )
+    return nodes, leaf_nodes
 
 
 def create_flat_index(li_docs, docstore, vector_store, embed_model, llm):
@@ -206,6 +316,87 @@ def create_flat_index(li_docs, docstore, vector_store, embed_model, llm):
         embed_model=embed_model,
         llm=llm,
     )
+    return li_docs, nodes
+
+
+def group_by_source(
+    nodes: list[BaseNode], doc_sources: dict[str, str]
+) -> dict[str, list[str]]:
+    """Groups node ids by the source file of the node or of its document"""
+    node_ids = defaultdict(list)
+    for node in nodes:
+        source = node.metadata.get("source") or doc_sources.get(node.ref_doc_id)
+        if source:
+            node_ids[source].append(node.node_id)
+    return node_ids
+
+
+def delete_vectors(vector_store, node_ids: list[str], batch_size=1000):
+    if isinstance(vector_store, MirroredVectorStore):
+        delete_vectors(vector_store.primary, node_ids, batch_size)
+        delete_vectors(vector_store.mirror, node_ids, batch_size)
+    elif isinstance(vector_store, VertexAIVectorStore):
+        for start in range(0, len(node_ids), batch_size):
+            vector_store.index.remove_datapoints(
+                datapoint_ids=node_ids[start : start + batch_size]
+            )
+    else:
+        vector_store.delete_nodes(node_ids)
+
+
+def publish_local_vector_store(vector_store, index_name: str) -> None:
+    """Rebuilds the local vector index, if any, and uploads it to GCS"""
+    if isinstance(vector_store, MirroredVectorStore):
+        vector_store = vector_store.mirror
+    if not isinstance(vector_store, LocalVectorStore):
+        return
+    vector_store.persist()
+    upload_local_vector_store(
+        vector_store,
+        DOCSTORE_BUCKET_NAME,
+        local_vector_index_prefix(VECTOR_DATA_PREFIX, FIRESTORE_NAMESPACE, index_name),
+    )
+
+
+def delete_stale_sources(
+    manifest, stale, docstore, vector_store, qa_vector_store
+) -> list[str]:
+    """Removes the vectors and docstore entries of changed or deleted sources,
+    then their manifest entries. Returns the deleted docstore node ids."""
+    node_ids = [node_id for entry in stale for node_id in entry.node_ids]
+    vector_ids = [node_id for entry in stale for node_id in entry.vector_ids]
+    qa_vector_ids = [node_id for entry in stale for node_id in entry.qa_vector_ids]
+    logger.info(
+        f"Deleting {len(node_ids)} docstore nodes, {len(vector_ids)} vectors "
+        f"and {len(qa_vector_ids)} QA vectors of {len(stale)} stale sources"
+    )
+    delete_vectors(vector_store, vector_ids)
+    if qa_vector_ids and qa_vector_store is not None:
+        delete_vectors(qa_vector_store, qa_vector_ids)
+    for node_id in node_ids:
+        docstore.delete_document(node_id, raise_error=False)
+    manifest.delete(entry.source for entry in stale)
+    return node_ids
+
+
+def update_bm25_index(kvstore, docstore, docstore_nodes, deleted_node_ids=()):
+    """Applies docstore deletions and additions to the persisted BM25 index
+    for the namespace and uploads the changed segments to GCS. If there is
+    no index yet, it is built from every node in the docstore."""
+    prefix = bm25_index_prefix(VECTOR_DATA_PREFIX, FIRESTORE_NAMESPACE)
+    # A local copy is only reused if no other run re-indexed since
+    local_dir = bm25_index_dir(
+        BM25_INDEX_DIR, read_index_version(kvstore, FIRESTORE_NAMESPACE)
+    )
+    bm25_index = load_bm25_index(
+        DOCSTORE_BUCKET_NAME, prefix=prefix, local_dir=local_dir
+    )
+    if len(bm25_index) == 0:
+        logger.info("No BM25 index found, building one from the docstore")
+        docstore_nodes = list(docstore.docs.values())
+    deleted = bm25_index.delete_nodes(deleted_node_ids)
+    if bm25_index.add_nodes(docstore_nodes) or deleted:
+        upload_bm25_index(bm25_index, DOCSTORE_BUCKET_NAME, prefix)
 
 
 def main():
@@ -213,23 +404,11 @@ def main():
     # Initialize Vertex AI and create index and endpoint
     aiplatform.init(project=PROJECT_ID, location=LOCATION)
 
-    # Creating Vector Search Index
-    vs_index, vs_endpoint = get_or_create_existing_index(
-        VECTOR_INDEX_NAME, INDEX_ENDPOINT_NAME, APPROXIMATE_NEIGHBORS_COUNT
-    )
-
-    # Vertex AI Vector Search Vector DB and Firestore Docstore
-    vector_store = VertexAIVectorStore(
-        project_id=PROJECT_ID,
-        region=LOCATION,
-        index_id=vs_index.name,  # Use .name instead of .resource_name
-        endpoint_id=vs_endpoint.name,  # Use .name instead of .resource_name
-        gcs_bucket_name=DOCSTORE_BUCKET_NAME,
-    )
+    # Vertex AI Vector Search Vector DB (and/or local index) and Firestore Docstore
+    vector_store = get_vector_store(VECTOR_INDEX_NAME, INDEX_ENDPOINT_NAME)
 
-    docstore = FirestoreDocumentStore.from_database(
-        project=PROJECT_ID, database=FIRESTORE_DB_NAME, namespace=FIRESTORE_NAMESPACE
-    )
+    kvstore = FirestoreKVStore(project=PROJECT_ID, database=FIRESTORE_DB_NAME)
+    docstore = FirestoreDocumentStore(kvstore, namespace=FIRESTORE_NAMESPACE)
 
     # Setup embedding model and LLM
     embed_model = VertexTextEmbedding(
@@ -249,49 +428,119 @@ def main():
         gcs_output_path=GCS_OUTPUT_PATH,
     )
 
-    # Download data from specified bucket and parse
+    # Only index sources which are new or changed since the last run. The
+    # bucket is listed once, and new and changed data is downloaded from the
+    # specified bucket while later pages are still being listed
+    manifest = IndexManifest(kvstore, FIRESTORE_NAMESPACE)
     local_data_path = os.path.join("/tmp", BUCKET_PREFIX)
     os.makedirs(local_data_path, exist_ok=True)
-    blobs = create_pdf_blob_list(INPUT_BUCKET_NAME, BUCKET_PREFIX)
-    logger.info("downloading data")
-    download_bucket_with_transfer_manager(
-        INPUT_BUCKET_NAME, prefix=BUCKET_PREFIX, destination_directory=local_data_path
-    )
-
-    # Parse documents using Document AI
-    try:
-        parsed_docs, raw_results = parser.batch_parse(
-            blobs, chunk_size=CHUNK_SIZE, include_ancestor_headings=True
+    logger.info("listing and downloading data")
+    with BlobDownloader(
+        INPUT_BUCKET_NAME, destination_directory=local_data_path
+    ) as downloader:
+        diff = manifest.diff(
+            iter_pdf_blobs(INPUT_BUCKET_NAME, BUCKET_PREFIX),
+            on_index=lambda blob: downloader.submit(
+                blob.path.removeprefix(f"gs://{INPUT_BUCKET_NAME}/")
+            ),
         )
-        print(f"Number of documents parsed by Document AI: {len(parsed_docs)}")
-        if parsed_docs:
-            print(
-                f"First parsed document text (first 100 chars): {parsed_docs[0].text[:100]}..."  # noqa: E501
-            )
-        else:
-            print("No documents were parsed by Document AI.")
-
-        # Print raw results for debugging
-        print("Raw results:")
-        for result in raw_results:
-            print(f"  Source: {result.source_path}")
-            print(f"  Parsed: {result.parsed_path}")
-    except Exception as e:
-        print(f"Error processing single document: {str(e)}")
-        parsed_docs = []
-        raw_results = []
-
-    # Turn each parsed document into a llamaindex Document
-    li_docs = [Document(text=doc.text, metadata=doc.metadata) for doc in parsed_docs]
+    if not diff.to_index and not diff.stale:
+        logger.info("Index is up to date")
+        return
 
-    if QA_INDEX_NAME or QA_ENDPOINT_NAME:
-        create_qa_index(li_docs, docstore, embed_model, llm)
+    qa_vector_store = (
+        get_qa_vector_store() if QA_INDEX_NAME or QA_ENDPOINT_NAME else None
+    )
+    deleted_node_ids = delete_stale_sources(
+        manifest, diff.stale, docstore, vector_store, qa_vector_store
+    )
 
-    if INDEXING_METHOD == "hierarchical":
-        create_hierarchical_index(li_docs, docstore, vector_store, embed_model, llm)
+    # Parse documents using Document AI. Shards are embedded and indexed as
+    # soon as their operation finishes, while later shards are still parsing
+    content_hashes = {blob.path: blob.content_hash for blob in diff.to_index}
+    num_docs = 0
+    # Every node written to the docstore is searchable through BM25
+    docstore_nodes = []
+    # Manifest entries of the sources indexed by this run, including the
+    # shard being indexed
+    indexed = []
+    doc_sources = {}
+    try:
+        for parsed_docs, raw_results in parser.iter_batch_parse(
+            diff.to_index, chunk_size=CHUNK_SIZE, include_ancestor_headings=True
+        ):
+            print(f"Number of documents parsed by Document AI: {len(parsed_docs)}")
+            for result in raw_results:
+                print(f"  Source: {result.source_path}")
+                print(f"  Parsed: {result.parsed_path}")
+
+            # Turn each parsed document into a llamaindex Document
+            li_docs = [
+                Document(text=doc.text, metadata=doc.metadata) for doc in parsed_docs
+            ]
+            num_docs += len(li_docs)
+            doc_sources = {doc.doc_id: doc.metadata["source"] for doc in li_docs}
+            entries = {
+                source: ManifestEntry(source, content_hashes.get(source))
+                for source in doc_sources.values()
+            }
+            indexed.extend(entries.values())
+
+            if qa_vector_store is not None:
+                qa_nodes, question_ids = create_qa_index(
+                    li_docs, docstore, qa_vector_store, embed_model, llm
+                )
+                docstore_nodes.extend(qa_nodes)
+                for source, node_ids in group_by_source(qa_nodes, doc_sources).items():
+                    entries[source].node_ids.extend(node_ids)
+                for doc_id, node_ids in question_ids.items():
+                    entries[doc_sources[doc_id]].qa_vector_ids.extend(node_ids)
+
+            nodes, vector_nodes = [], []
+            if INDEXING_METHOD == "hierarchical":
+                nodes, vector_nodes = create_hierarchical_index(
+                    li_docs, docstore, vector_store, embed_model, llm
+                )
 
-    elif INDEXING_METHOD == "flat":
-        create_flat_index(li_docs, docstore, vector_store, embed_model, llm)
+            elif INDEXING_METHOD == "flat":
+                nodes, vector_nodes = create_flat_index(
+                    li_docs, docstore, vector_store, embed_model, llm
+                )
+            docstore_nodes.extend(nodes)
+            for source, node_ids in group_by_source(nodes, doc_sources).items():
+                entries[source].node_ids.extend(node_ids)
+            for source, node_ids in group_by_source(vector_nodes, doc_sources).items():
+                entries[source].vector_ids.extend(node_ids)
+
+            # Record the shard's sources once their nodes are indexed
+            for entry in entries.values():
+                entry.node_ids = list(dict.fromkeys(entry.node_ids))
+            manifest.put(entries.values())
+    except Exception as e:
+        print(f"Error processing documents: {str(e)}")
+        # Nothing is published, so remove what this run indexed and restore
+        # the stale entries, so that the next run indexes the sources again
+        # and deletes the stale nodes from the BM25 and local vector indexes.
+        # The documents of a failing shard may be in the docstore already
+        for entry in indexed:
+            entry.node_ids.extend(
+                doc_id
+                for doc_id, source in doc_sources.items()
+                if source == entry.source
+            )
+        delete_stale_sources(manifest, indexed, docstore, vector_store, qa_vector_store)
+        manifest.put(diff.stale)
+        raise
+
+    if not num_docs:
+        print("No documents were parsed by Document AI.")
+
+    update_bm25_index(kvstore, docstore, docstore_nodes, deleted_node_ids)
+    publish_local_vector_store(vector_store, VECTOR_INDEX_NAME)
+    if qa_vector_store is not None:
+        publish_local_vector_store(qa_vector_store, QA_INDEX_NAME)
+    # Serving docstore caches for the namespace are dropped on the new stamp
+    write_index_version(kvstore, FIRESTORE_NAMESPACE)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,13 @@
 """Extensions to Llamaindex Base classes to allow for asynchronous execution"""
-from collections.abc import Sequence
+import asyncio
+from collections.abc import AsyncGenerator, Iterator, Sequence
 import logging
+import threading
 
+from backend.rag.tracing import trace_stage
+from cachetools import TTLCache
 from llama_index.core.base.response.schema import RESPONSE_TYPE
-from llama_index.core.callbacks import CallbackManager
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
 from llama_index.core.indices.query.query_transform.base import BaseQueryTransform
 from llama_index.core.prompts import BasePromptTemplate
 from llama_index.core.prompts.default_prompts import DEFAULT_HYDE_PROMPT
@@ -12,12 +16,73 @@ from llama_index.core.query_engine import BaseQueryEngine, RetrieverQueryEngine
 from llama_index.core.schema import NodeWithScore, QueryBundle, QueryType
 from llama_index.core.service_context_elements.llm_predictor import LLMPredictorType
 from llama_index.core.settings import Settings
+from llama_index.llms.vertex import Vertex
 from pydantic import Field
 
 logging.basicConfig(level=logging.INFO)  # Set the desired logging level
 logger = logging.getLogger(__name__)
 
 
+def supports_async_streaming(llm: LLMPredictorType) -> bool:
+    """The Vertex integration does not implement astream_complete/astream_chat"""
+    return not isinstance(llm, Vertex)
+
+
+async def aiter_in_thread(token_gen: Iterator[str]) -> AsyncGenerator[str, None]:
+    """Iterate a blocking token generator without blocking the event loop"""
+    sentinel = object()
+    while True:
+        token = await asyncio.to_thread(next, token_gen, sentinel)
+        if token is sentinel:
+            break
+        yield token
+
+
+def reciprocal_rank_fusion(
+    results: list[list[NodeWithScore]], k: float = 60.0
+) -> list[NodeWithScore]:
+    """
+    Fuses ranked result lists by reciprocal rank, as QueryFusionRetriever
+    does, keeping as many nodes as the longest list.
+    """
+    fused_scores: dict[str, float] = {}
+    nodes_by_id: dict[str, NodeWithScore] = {}
+    for nodes in results:
+        for rank, node in enumerate(nodes):
+            node_id = node.node.node_id
+            nodes_by_id.setdefault(node_id, node)
+            fused_scores[node_id] = fused_scores.get(node_id, 0.0) + 1.0 / (rank + k)
+    ranked_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)
+    return [
+        NodeWithScore(node=nodes_by_id[node_id].node, score=fused_scores[node_id])
+        for node_id in ranked_ids[: max(len(nodes) for nodes in results)]
+    ]
+
+
+class HyDECache:
+    """Thread-safe TTL cache of hypothetical documents, keyed by normalized query"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(query_str: str) -> str:
+        return " ".join(query_str.lower().split())
+
+    def get(self, key: tuple) -> str | None:
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key: tuple, hypothetical_doc: str) -> None:
+        with self._lock:
+            self._cache[key] = hypothetical_doc
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
 class AsyncTransformQueryEngine(BaseQueryEngine):
     """Transform query engine.
 
@@ -30,6 +95,10 @@ class AsyncTransformQueryEngine(BaseQueryEngine):
         transform_metadata (Optional[dict]): metadata to pass to the
             query transform.
         callback_manager (Optional[CallbackManager]): A callback manager.
+        speculative_retrieval (bool): With an AsyncRetrieverQueryEngine and a
+            HyDE transform, retrieve on the original query while the
+            hypothetical document is generated, then retrieve on the
+            hypothetical document and fuse both result sets.
 
     """
 
@@ -43,10 +112,16 @@ class AsyncTransformQueryEngine(BaseQueryEngine):
         query_transform: BaseQueryTransform,
         transform_metadata: dict | None = None,
         callback_manager: CallbackManager | None = None,
+        speculative_retrieval: bool = False,
     ) -> None:
         self._query_engine = query_engine
         self._query_transform = query_transform
         self._transform_metadata = transform_metadata
+        self._speculative_retrieval = (
+            speculative_retrieval
+            and isinstance(query_engine, AsyncRetrieverQueryEngine)
+            and isinstance(query_transform, AsyncHyDEQueryTransform)
+        )
         super().__init__(callback_manager)
 
     def _get_prompt_modules(self) -> PromptMixinType:
@@ -56,10 +131,41 @@ class AsyncTransformQueryEngine(BaseQueryEngine):
             "query_engine": self._query_engine,
         }
 
-    async def aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
-        query_bundle = await self._query_transform._arun(
-            query_bundle, metadata=self._transform_metadata
+    async def _atransform(self, query_bundle: QueryBundle) -> QueryBundle:
+        with trace_stage("hyde"):
+            return await self._query_transform._arun(
+                query_bundle, metadata=self._transform_metadata
+            )
+
+    async def _aretrieve_speculative(
+        self, query_bundle: QueryBundle
+    ) -> list[NodeWithScore]:
+        """
+        Retrieves on the original query while HyDE runs, then on the
+        hypothetical document alone, and fuses the two result sets before
+        the node postprocessors run once over the fused nodes.
+        """
+        original_task = asyncio.create_task(
+            self._query_engine.aretrieve_nodes(query_bundle)
         )
+        try:
+            hyde_bundle = await self._atransform(query_bundle)
+        except BaseException:
+            original_task.cancel()
+            raise
+        # The hypothetical document is the transform's first embedding string
+        hypothetical_bundle = QueryBundle(
+            query_str=query_bundle.query_str,
+            custom_embedding_strs=hyde_bundle.embedding_strs[:1],
+        )
+        hyde_nodes = await self._query_engine.aretrieve_nodes(hypothetical_bundle)
+        nodes = reciprocal_rank_fusion([await original_task, hyde_nodes])
+        return await self._query_engine.apostprocess_nodes(nodes, query_bundle)
+
+    async def aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        if self._speculative_retrieval:
+            return await self._aretrieve_speculative(query_bundle)
+        query_bundle = await self._atransform(query_bundle)
         return await self._query_engine.aretrieve(query_bundle)
 
     def synthesize(
@@ -100,9 +206,7 @@ class AsyncTransformQueryEngine(BaseQueryEngine):
         nodes: list[NodeWithScore],
         additional_source_nodes: Sequence[NodeWithScore] | None = None,
     ) -> RESPONSE_TYPE:
-        query_bundle = await self._query_transform._arun(
-            query_bundle, metadata=self._transform_metadata
-        )
+        query_bundle = await self._atransform(query_bundle)
         return await self._query_engine.asynthesize(
             query_bundle=query_bundle,
             nodes=nodes,
@@ -118,11 +222,22 @@ class AsyncTransformQueryEngine(BaseQueryEngine):
 
     async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
         """Answer a query."""
-        query_bundle = await self._query_transform._arun(
-            query_bundle, metadata=self._transform_metadata
-        )
+        if self._speculative_retrieval:
+            nodes = await self._aretrieve_speculative(query_bundle)
+            with trace_stage("synthesize"):
+                return await self._query_engine.asynthesize(query_bundle, nodes)
+        query_bundle = await self._atransform(query_bundle)
         return await self._query_engine.aquery(query_bundle)
 
+    async def astream_synthesize(
+        self, query_bundle: QueryBundle, nodes: list[NodeWithScore]
+    ) -> AsyncGenerator[str, None]:
+        """Stream response tokens for nodes returned by aretrieve.
+        The transform only changes the embedding strings, so the wrapped
+        engine synthesizes from the original query without re-running it."""
+        async for token in self._query_engine.astream_synthesize(query_bundle, nodes):
+            yield token
+
 
 class AsyncHyDEQueryTransform(BaseQueryTransform):
     """Hypothetical Document Embeddings (HyDE) query transform.
@@ -140,6 +255,8 @@ class AsyncHyDEQueryTransform(BaseQueryTransform):
         llm: LLMPredictorType | None = None,
         hyde_prompt: BasePromptTemplate | None = None,
         include_original: bool = True,
+        cache: HyDECache | None = None,
+        cache_namespace: str = "",
     ) -> None:
         """Initialize HyDEQueryTransform.
 
@@ -149,12 +266,16 @@ class AsyncHyDEQueryTransform(BaseQueryTransform):
             hyde_prompt (Optional[BasePromptTemplate]): Custom prompt for HyDE
             include_original (bool): Whether to include original query
                 string as one of the embedding strings
+            cache (Optional[HyDECache]): Cache of hypothetical documents
+            cache_namespace (str): Identifies the LLM configuration in cache keys
         """
         super().__init__()
 
         self._llm = llm or Settings.llm
         self._hyde_prompt = hyde_prompt or DEFAULT_HYDE_PROMPT
         self._include_original = include_original
+        self._cache = cache
+        self._cache_namespace = cache_namespace
 
     def _get_prompts(self) -> PromptDictType:
         """Get prompts."""
@@ -165,33 +286,53 @@ class AsyncHyDEQueryTransform(BaseQueryTransform):
         if "hyde_prompt" in prompts:
             self._hyde_prompt = prompts["hyde_prompt"]
 
-    def _run(self, query_bundle: QueryBundle, metadata: dict) -> QueryBundle:
-        """Run query transform."""
-        # TODO: support generating multiple hypothetical docs
-        query_str = query_bundle.query_str
-        hypothetical_doc = self._llm.predict(self._hyde_prompt, context_str=query_str)
+    def _cache_key(self, query_str: str) -> tuple:
+        return (
+            self._cache_namespace,
+            self._hyde_prompt.get_template(),
+            HyDECache.normalize(query_str),
+        )
+
+    def _build_query_bundle(
+        self, query_bundle: QueryBundle, hypothetical_doc: str
+    ) -> QueryBundle:
         embedding_strs = [hypothetical_doc]
         if self._include_original:
             embedding_strs.extend(query_bundle.embedding_strs)
         return QueryBundle(
-            query_str=query_str,
+            query_str=query_bundle.query_str,
             custom_embedding_strs=embedding_strs,
         )
 
-    async def _arun(self, query_bundle: QueryBundle) -> QueryBundle:
+    def _run(self, query_bundle: QueryBundle, metadata: dict) -> QueryBundle:
         """Run query transform."""
         # TODO: support generating multiple hypothetical docs
         query_str = query_bundle.query_str
-        hypothetical_doc = await self._llm.apredict(
-            self._hyde_prompt, context_str=query_str
-        )
-        embedding_strs = [hypothetical_doc]
-        if self._include_original:
-            embedding_strs.extend(query_bundle.embedding_strs)
-        return QueryBundle(
-            query_str=query_str,
-            custom_embedding_strs=embedding_strs,
-        )
+        cache_key = self._cache_key(query_str)
+        hypothetical_doc = self._cache.get(cache_key) if self._cache else None
+        if hypothetical_doc is None:
+            hypothetical_doc = self._llm.predict(
+                self._hyde_prompt, context_str=query_str
+            )
+            if self._cache:
+                self._cache.set(cache_key, hypothetical_doc)
+        return self._build_query_bundle(query_bundle, hypothetical_doc)
+
+    async def _arun(
+        self, query_bundle: QueryBundle, metadata: dict | None = None
+    ) -> QueryBundle:
+        """Run query transform."""
+        # TODO: support generating multiple hypothetical docs
+        query_str = query_bundle.query_str
+        cache_key = self._cache_key(query_str)
+        hypothetical_doc = self._cache.get(cache_key) if self._cache else None
+        if hypothetical_doc is None:
+            hypothetical_doc = await self._llm.apredict(
+                self._hyde_prompt, context_str=query_str
+            )
+            if self._cache:
+                self._cache.set(cache_key, hypothetical_doc)
+        return self._build_query_bundle(query_bundle, hypothetical_doc)
 
 
 class AsyncRetrieverQueryEngine(RetrieverQueryEngine):
@@ -208,9 +349,63 @@ class AsyncRetrieverQueryEngine(RetrieverQueryEngine):
             )
         return nodes
 
-    async def aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
-        """Retrieve nodes"""
-        nodes = await self._retriever.aretrieve(query_bundle)
+    async def aretrieve_nodes(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        """Retrieve nodes without applying the node postprocessors"""
+        with trace_stage("retrieve"):
+            nodes = await self._retriever.aretrieve(query_bundle)
         num_nodes = len(nodes)
         logger.info(f"Total nodes retrieved {num_nodes}")
-        return await self._apply_node_postprocessors(nodes, query_bundle=query_bundle)
+        return nodes
+
+    async def apostprocess_nodes(
+        self, nodes: list[NodeWithScore], query_bundle: QueryBundle
+    ) -> list[NodeWithScore]:
+        """Apply the node postprocessors (e.g. the LLM reranker)"""
+        if not self._node_postprocessors:
+            return nodes
+        with trace_stage("rerank"):
+            return await self._apply_node_postprocessors(
+                nodes, query_bundle=query_bundle
+            )
+
+    async def aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        """Retrieve nodes"""
+        nodes = await self.aretrieve_nodes(query_bundle)
+        return await self.apostprocess_nodes(nodes, query_bundle)
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        """Answer a query, tracing synthesis as its own stage."""
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            nodes = await self.aretrieve(query_bundle)
+
+            with trace_stage("synthesize"):
+                response = await self._response_synthesizer.asynthesize(
+                    query=query_bundle,
+                    nodes=nodes,
+                )
+
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+
+        return response
+
+    async def astream_synthesize(
+        self, query_bundle: QueryBundle, nodes: list[NodeWithScore]
+    ) -> AsyncGenerator[str, None]:
+        """Stream response tokens for nodes returned by aretrieve.
+        Requires a response synthesizer created with streaming=True."""
+        synthesizer = self._response_synthesizer
+        with trace_stage("synthesize"):
+            if supports_async_streaming(synthesizer._llm):
+                response = await synthesizer.asynthesize(
+                    query=query_bundle, nodes=nodes
+                )
+                async for token in response.async_response_gen():
+                    yield token
+            else:
+                response = await asyncio.to_thread(
+                    synthesizer.synthesize, query=query_bundle, nodes=nodes
+                )
+                async for token in aiter_in_thread(response.response_gen):
+                    yield token
@@ -0,0 +1,482 @@
+"""Persistent, incrementally updated BM25 index
+and a retriever which reads nodes from a docstore"""
+from collections import Counter
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from typing import Callable
+
+from bm25s.stopwords import STOPWORDS_EN
+from common.utils import download_bucket_with_transfer_manager, upload_directory_to_gcs
+from google.cloud import storage
+from llama_index.core import QueryBundle
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import BaseNode, NodeWithScore
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+import numpy as np
+import Stemmer
+
+logging.basicConfig(level=logging.INFO)  # Set the desired logging level
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+# Segments are merged, purging deleted documents, once this share is deleted
+MAX_DELETED_RATIO = 0.2
+_TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+_STOPWORDS = frozenset(STOPWORDS_EN)
+
+
+def bm25_index_prefix(vector_data_prefix: str, firestore_namespace: str) -> str:
+    """GCS prefix (and relative local path) of the BM25 index for a namespace"""
+    return f"{vector_data_prefix}/bm25/{firestore_namespace}"
+
+
+def bm25_index_dir(local_dir: str, index_version: str | None) -> str:
+    """
+    Local directory for the BM25 indexes downloaded for an index version
+    stamp, so a re-indexed namespace is downloaded again
+    """
+    return os.path.join(local_dir, index_version or "unversioned")
+
+
+class BM25Segment:
+    """
+    An immutable slice of the BM25 index stored as a term dictionary
+    plus CSR-style postings arrays. Postings for term id `t` live in
+    `indices[indptr[t]:indptr[t + 1]]` (document positions) and
+    `tfs[indptr[t]:indptr[t + 1]]` (term frequencies).
+    Arrays are memory-mapped when loaded from disk.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        vocab: dict[str, int],
+        node_ids: list[str],
+        doc_lens: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        tfs: np.ndarray,
+    ):
+        self.path = path
+        self.vocab = vocab
+        self.node_ids = node_ids
+        self.doc_lens = doc_lens
+        self.indptr = indptr
+        self.indices = indices
+        self.tfs = tfs
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    @property
+    def total_len(self) -> int:
+        return int(self.doc_lens.sum())
+
+    def document_frequency(self, term: str) -> int:
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return 0
+        return int(self.indptr[term_id + 1] - self.indptr[term_id])
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.indices[start:end], self.tfs[start:end]
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Segment":
+        with open(os.path.join(path, "vocab.json")) as f:
+            vocab = json.load(f)
+        with open(os.path.join(path, "node_ids.json")) as f:
+            node_ids = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ("doc_lens", "indptr", "indices", "tfs")
+        }
+        return cls(path=path, vocab=vocab, node_ids=node_ids, **arrays)
+
+    @classmethod
+    def write(
+        cls,
+        path: str,
+        vocab: dict[str, int],
+        node_ids: list[str],
+        doc_lens: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        tfs: np.ndarray,
+    ) -> "BM25Segment":
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "vocab.json"), "w") as f:
+            json.dump(vocab, f)
+        with open(os.path.join(path, "node_ids.json"), "w") as f:
+            json.dump(node_ids, f)
+        np.save(os.path.join(path, "doc_lens.npy"), doc_lens.astype(np.int32))
+        np.save(os.path.join(path, "indptr.npy"), indptr.astype(np.int64))
+        np.save(os.path.join(path, "indices.npy"), indices.astype(np.int32))
+        np.save(os.path.join(path, "tfs.npy"), tfs.astype(np.int32))
+        return cls.load(path)
+
+    @classmethod
+    def build(
+        cls, path: str, node_ids: list[str], token_lists: list[list[str]]
+    ) -> "BM25Segment":
+        """Builds a segment from tokenized documents and writes it to disk"""
+        vocab: dict[str, int] = {}
+        term_ids, doc_idxs, tfs = [], [], []
+        for doc_idx, tokens in enumerate(token_lists):
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_idxs.append(doc_idx)
+                tfs.append(tf)
+        return cls._from_triples(
+            path,
+            vocab,
+            node_ids,
+            np.array([len(tokens) for tokens in token_lists], dtype=np.int32),
+            np.array(term_ids, dtype=np.int64),
+            np.array(doc_idxs, dtype=np.int32),
+            np.array(tfs, dtype=np.int32),
+        )
+
+    @classmethod
+    def merge(
+        cls,
+        path: str,
+        segments: list["BM25Segment"],
+        deleted: set[str] | None = None,
+    ) -> "BM25Segment":
+        """Merges several segments into one without re-tokenizing,
+        dropping the documents in `deleted`"""
+        deleted = deleted or set()
+        vocab: dict[str, int] = {}
+        node_ids: list[str] = []
+        term_ids, doc_idxs, tfs, doc_lens = [], [], [], []
+        for segment in segments:
+            # Map local term ids to merged term ids
+            local_to_merged = np.empty(len(segment.vocab), dtype=np.int64)
+            for term, local_id in segment.vocab.items():
+                local_to_merged[local_id] = vocab.setdefault(term, len(vocab))
+            # Map local document positions of kept documents to merged positions
+            keep = np.array(
+                [node_id not in deleted for node_id in segment.node_ids], dtype=bool
+            )
+            local_to_merged_doc = np.cumsum(keep) - 1 + len(node_ids)
+            indices = np.asarray(segment.indices)
+            live = keep[indices]
+            counts = np.diff(segment.indptr)
+            term_ids.append(np.repeat(local_to_merged, counts)[live])
+            doc_idxs.append(local_to_merged_doc[indices[live]])
+            tfs.append(np.asarray(segment.tfs)[live])
+            doc_lens.append(np.asarray(segment.doc_lens)[keep])
+            node_ids.extend(
+                node_id for node_id, kept in zip(segment.node_ids, keep) if kept
+            )
+        return cls._from_triples(
+            path,
+            vocab,
+            node_ids,
+            np.concatenate(doc_lens),
+            np.concatenate(term_ids),
+            np.concatenate(doc_idxs),
+            np.concatenate(tfs),
+        )
+
+    @classmethod
+    def _from_triples(
+        cls,
+        path: str,
+        vocab: dict[str, int],
+        node_ids: list[str],
+        doc_lens: np.ndarray,
+        term_ids: np.ndarray,
+        doc_idxs: np.ndarray,
+        tfs: np.ndarray,
+    ) -> "BM25Segment":
+        order = np.argsort(term_ids, kind="stable")
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+        return cls.write(
+            path, vocab, node_ids, doc_lens, indptr, doc_idxs[order], tfs[order]
+        )
+
+
+class PersistentBM25Index:
+    """
+    BM25 index persisted as a list of segments under `persist_dir`.
+    New documents are written as a new segment, so updates never
+    re-tokenize the existing corpus. Deleted documents are tombstoned
+    until the next merge. Segments are merged once there are more than
+    `max_segments` of them, or once too many documents are deleted.
+    """
+
+    def __init__(
+        self,
+        persist_dir: str,
+        language: str = "english",
+        k1: float = 1.2,
+        b: float = 0.75,
+        max_segments: int = 8,
+    ):
+        self.persist_dir = persist_dir
+        self.language = language
+        self.k1 = k1
+        self.b = b
+        self.max_segments = max_segments
+        self.version = 0
+        self._stemmer = Stemmer.Stemmer(language)
+        self._segments: list[BM25Segment] = []
+        self._node_ids: set[str] = set()
+        # Deleted documents still stored in segments, and their positions
+        self._deleted: set[str] = set()
+        self._tombstones: dict[str, np.ndarray] = {}
+        self._total_len = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def exists(cls, persist_dir: str) -> bool:
+        return os.path.exists(os.path.join(persist_dir, MANIFEST_FILE))
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "PersistentBM25Index":
+        """Loads the index, memory-mapping the postings of every segment"""
+        with open(os.path.join(persist_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        index = cls(
+            persist_dir=persist_dir,
+            language=manifest["language"],
+            k1=manifest["k1"],
+            b=manifest["b"],
+            max_segments=manifest["max_segments"],
+        )
+        index.version = manifest["version"]
+        index._deleted = set(manifest.get("deleted", []))
+        for name in manifest["segments"]:
+            index._attach(BM25Segment.load(os.path.join(persist_dir, name)))
+        logger.info(
+            f"Loaded BM25 index from {persist_dir} with {len(index)} "
+            f"documents in {len(index._segments)} segments"
+        )
+        return index
+
+    def __len__(self) -> int:
+        return len(self._node_ids)
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self._node_ids
+
+    def tokenize(self, text: str) -> list[str]:
+        tokens = [
+            t for t in _TOKEN_PATTERN.findall(text.lower()) if t not in _STOPWORDS
+        ]
+        return self._stemmer.stemWords(tokens)
+
+    def add_nodes(self, nodes: list[BaseNode]) -> int:
+        """Adds nodes not already in the index as a new segment
+        and persists it. Returns the number of nodes added."""
+        with self._lock:
+            new_nodes = {}
+            for node in nodes:
+                if node.node_id not in self._node_ids:
+                    new_nodes[node.node_id] = node
+            if not new_nodes:
+                return 0
+            if self._deleted & new_nodes.keys():
+                # Purge tombstones which would otherwise hide re-added nodes
+                self._merge_segments()
+            segment = BM25Segment.build(
+                os.path.join(self.persist_dir, f"seg_{self.version + 1:06d}"),
+                list(new_nodes),
+                [self.tokenize(node.get_content()) for node in new_nodes.values()],
+            )
+            self._attach(segment)
+            self.version += 1
+            if len(self._segments) > self.max_segments:
+                self._merge_segments()
+            self._write_manifest()
+        logger.info(f"Added {len(new_nodes)} documents to BM25 index")
+        return len(new_nodes)
+
+    def delete_nodes(self, node_ids: list[str]) -> int:
+        """Tombstones nodes in the index and persists the deletion.
+        Returns the number of nodes deleted."""
+        with self._lock:
+            deleted = self._node_ids.intersection(node_ids)
+            if not deleted:
+                return 0
+            self._deleted |= deleted
+            self._node_ids -= deleted
+            for segment in self._segments:
+                self._tombstone(segment)
+            self._total_len = sum(self._live_len(s) for s in self._segments)
+            self.version += 1
+            num_stored = len(self._node_ids) + len(self._deleted)
+            if len(self._deleted) > MAX_DELETED_RATIO * num_stored:
+                self._merge_segments()
+            self._write_manifest()
+        logger.info(f"Deleted {len(deleted)} documents from BM25 index")
+        return len(deleted)
+
+    def query(self, query_str: str, top_k: int) -> list[tuple[str, float]]:
+        """Returns the `top_k` (node_id, score) pairs for a query"""
+        num_docs = len(self._node_ids)
+        if num_docs == 0:
+            return []
+        avg_doc_len = self._total_len / num_docs
+        terms = set(self.tokenize(query_str))
+        idfs = {}
+        # Document frequencies include deleted documents until the next merge
+        for term in terms:
+            df = sum(s.document_frequency(term) for s in self._segments)
+            if df:
+                idfs[term] = np.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+
+        candidates: list[tuple[str, float]] = []
+        for segment in self._segments:
+            scores = np.zeros(len(segment), dtype=np.float32)
+            norms = self.k1 * (
+                1 - self.b + self.b * np.asarray(segment.doc_lens) / avg_doc_len
+            )
+            for term, idf in idfs.items():
+                doc_idxs, tfs = segment.postings(term)
+                if len(doc_idxs) == 0:
+                    continue
+                scores[doc_idxs] += idf * tfs * (self.k1 + 1) / (tfs + norms[doc_idxs])
+            tombstones = self._tombstones.get(segment.path)
+            if tombstones is not None:
+                scores[tombstones] = 0
+            k = min(top_k, len(segment))
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates.extend(
+                (segment.node_ids[i], float(scores[i])) for i in top if scores[i] > 0
+            )
+        return sorted(candidates, key=lambda x: x[1], reverse=True)[:top_k]
+
+    def _attach(self, segment: BM25Segment) -> None:
+        self._segments.append(segment)
+        self._tombstone(segment)
+        self._node_ids.update(
+            node_id for node_id in segment.node_ids if node_id not in self._deleted
+        )
+        self._total_len += self._live_len(segment)
+
+    def _tombstone(self, segment: BM25Segment) -> None:
+        positions = [
+            i for i, node_id in enumerate(segment.node_ids) if node_id in self._deleted
+        ]
+        if positions:
+            self._tombstones[segment.path] = np.array(positions, dtype=np.int64)
+        else:
+            self._tombstones.pop(segment.path, None)
+
+    def _live_len(self, segment: BM25Segment) -> int:
+        positions = self._tombstones.get(segment.path)
+        if positions is None:
+            return segment.total_len
+        return segment.total_len - int(np.asarray(segment.doc_lens)[positions].sum())
+
+    def _merge_segments(self) -> None:
+        # A new version keeps the merged segment's path unique
+        self.version += 1
+        old_segments = self._segments
+        merged = BM25Segment.merge(
+            os.path.join(self.persist_dir, f"seg_{self.version:06d}_merged"),
+            old_segments,
+            deleted=self._deleted,
+        )
+        self._segments = [merged]
+        self._deleted = set()
+        self._tombstones = {}
+        self._write_manifest()
+        for segment in old_segments:
+            shutil.rmtree(segment.path, ignore_errors=True)
+
+    def _write_manifest(self) -> None:
+        manifest = {
+            "version": self.version,
+            "language": self.language,
+            "k1": self.k1,
+            "b": self.b,
+            "max_segments": self.max_segments,
+            "segments": [os.path.basename(s.path) for s in self._segments],
+            "deleted": sorted(self._deleted),
+        }
+        tmp_path = os.path.join(self.persist_dir, f"{MANIFEST_FILE}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(self.persist_dir, MANIFEST_FILE))
+
+
+def load_bm25_index(
+    bucket_name: str, prefix: str, local_dir: str
+) -> PersistentBM25Index:
+    """
+    Loads the BM25 index stored under `prefix`, downloading it from GCS
+    into `local_dir` if it isn't there yet. Returns an empty index
+    persisted at the same location if none exists.
+    """
+    persist_dir = os.path.join(local_dir, prefix)
+    if not PersistentBM25Index.exists(persist_dir):
+        download_bucket_with_transfer_manager(
+            bucket_name, prefix=f"{prefix}/", destination_directory=local_dir
+        )
+    if PersistentBM25Index.exists(persist_dir):
+        return PersistentBM25Index.from_persist_dir(persist_dir)
+    return PersistentBM25Index(persist_dir)
+
+
+def upload_bm25_index(
+    bm25_index: PersistentBM25Index, bucket_name: str, prefix: str
+) -> None:
+    """
+    Uploads the segments of a persisted BM25 index under `prefix`, then its
+    manifest, so readers never download a manifest whose segments are missing
+    """
+    upload_directory_to_gcs(
+        bm25_index.persist_dir, bucket_name, prefix, exclude=(MANIFEST_FILE,)
+    )
+    storage.Client().bucket(bucket_name).blob(
+        f"{prefix}/{MANIFEST_FILE}"
+    ).upload_from_filename(os.path.join(bm25_index.persist_dir, MANIFEST_FILE))
+
+
+class BM25IndexRetriever(BaseRetriever):
+    """Retrieves nodes by BM25 score from a PersistentBM25Index,
+    fetching only the top scoring nodes from the docstore.
+
+    `bm25_index` may be a callable returning the current index, so that
+    long-lived retrievers pick up an index reloaded after re-indexing."""
+
+    def __init__(
+        self,
+        bm25_index: PersistentBM25Index | Callable[[], PersistentBM25Index],
+        docstore: BaseDocumentStore,
+        similarity_top_k: int = 5,
+    ) -> None:
+        self._bm25_index = bm25_index
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        bm25_index = (
+            self._bm25_index
+            if isinstance(self._bm25_index, PersistentBM25Index)
+            else self._bm25_index()
+        )
+        hits = bm25_index.query(query_bundle.query_str, self._similarity_top_k)
+        # Nodes deleted by a re-index may still be in a stale BM25 index
+        nodes = self._docstore.get_nodes(
+            [node_id for node_id, _ in hits], raise_error=False
+        )
+        return [
+            NodeWithScore(node=node, score=score)
+            for node, (_, score) in zip(nodes, hits)
+            if node is not None
+        ]
@@ -4,6 +4,7 @@ from typing import Any
 from anthropic import AnthropicVertex, AsyncAnthropicVertex
 from llama_index.core.llms import (
     CompletionResponse,
+    CompletionResponseAsyncGen,
     CompletionResponseGen,
     CustomLLM,
     LLMMetadata,
@@ -54,7 +55,7 @@ class ClaudeVertexLLM(CustomLLM):
                 }
             ],
         )
-        return CompletionResponse(text=message.content[0].text)
+        return CompletionResponse(text=message.content[0].text, raw=message)
 
     @llm_completion_callback()
     async def acomplete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
@@ -69,7 +70,7 @@ class ClaudeVertexLLM(CustomLLM):
                 }
             ],
         )
-        return CompletionResponse(text=message.content[0].text)
+        return CompletionResponse(text=message.content[0].text, raw=message)
 
     @llm_completion_callback()
     def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
@@ -80,6 +81,34 @@ class ClaudeVertexLLM(CustomLLM):
             messages=[{"role": "user", "content": prompt}],
         ) as stream:
             response = ""
+            completion = None
             for text in stream.text_stream:
                 response += text
-                yield CompletionResponse(text=response, delta=text)
+                completion = CompletionResponse(text=response, delta=text)
+                yield completion
+            if completion is not None:
+                # The end event reports the usage of the last response
+                completion.raw = stream.get_final_message()
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self, prompt: str, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        async def gen() -> CompletionResponseAsyncGen:
+            async with self.async_client.messages.stream(
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                system=self.system_prompt,
+                messages=[{"role": "user", "content": prompt}],
+            ) as stream:
+                response = ""
+                completion = None
+                async for text in stream.text_stream:
+                    response += text
+                    completion = CompletionResponse(text=response, delta=text)
+                    yield completion
+                if completion is not None:
+                    # The end event reports the usage of the last response
+                    completion.raw = await stream.get_final_message()
+
+        return gen()
@@ -0,0 +1,413 @@
+"""
+Write-through caching docstore, with an in-memory LRU and an optional
+on-disk second tier, invalidated by the index version stamp written
+by run_parse_embed_index
+"""
+import asyncio
+from collections import OrderedDict
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+import uuid
+import weakref
+
+from backend.rag.tracing import record_docstore_cache_lookups
+from llama_index.core.schema import BaseNode
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.core.storage.kvstore.types import BaseKVStore
+
+logging.basicConfig(level=logging.INFO)  # Set the desired logging level
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION_KEY = "index_version"
+
+
+def index_version_collection(namespace: str) -> str:
+    """Collection holding the index version stamp of a docstore namespace"""
+    return f"{namespace}/index_version"
+
+
+def write_index_version(kvstore: BaseKVStore, namespace: str) -> str:
+    """Stamps the namespace with a new index version, invalidating caches"""
+    version = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    kvstore.put(
+        INDEX_VERSION_KEY,
+        {"version": version},
+        collection=index_version_collection(namespace),
+    )
+    logger.info(f"Wrote index version {version} for namespace {namespace}")
+    return version
+
+
+def read_index_version(kvstore: BaseKVStore, namespace: str) -> str | None:
+    """Returns the namespace's index version stamp, if one was written"""
+    stamp = kvstore.get(
+        INDEX_VERSION_KEY, collection=index_version_collection(namespace)
+    )
+    return stamp["version"] if stamp else None
+
+
+class DiskNodeCache:
+    """SQLite-backed node cache that survives restarts of the backend"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS nodes (id TEXT PRIMARY KEY, doc TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def get_many(self, node_ids: list[str]) -> dict[str, BaseNode]:
+        rows = []
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(node_ids), 500):
+            batch = node_ids[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            with self._lock:
+                rows.extend(
+                    self._conn.execute(
+                        f"SELECT id, doc FROM nodes WHERE id IN ({placeholders})",
+                        batch,
+                    ).fetchall()
+                )
+        return {node_id: json_to_doc(json.loads(doc)) for node_id, doc in rows}
+
+    def put_many(self, nodes: Sequence[BaseNode]) -> None:
+        rows = [(node.node_id, json.dumps(doc_to_json(node))) for node in nodes]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO nodes VALUES (?, ?)", rows)
+
+    def delete_many(self, node_ids: list[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM nodes WHERE id = ?", [(i,) for i in node_ids]
+            )
+
+    @property
+    def version(self) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+        return (row[0] or None) if row else None
+
+    def reset(self, version: str | None) -> None:
+        """Drops every cached node and records the version they belong to"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM nodes")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version or "",)
+            )
+
+
+class CachingDocumentStore:
+    """
+    Caches the nodes read from a docstore, delegating everything else to it.
+    The corpus only changes at indexing time, so nodes are kept until they
+    are evicted from the LRU or the index version stamp changes; the stamp
+    is re-read at most every `version_check_interval` seconds.
+
+    Lookups check memory, then disk, then fetch all missing ids from the
+    wrapped docstore concurrently, at most `fetch_concurrency` at a time
+    (per event loop for async lookups). Concurrent lookups of the same id, from
+    any thread or event loop, share a single fetch. Writes go through to the
+    wrapped docstore and update the cache.
+    """
+
+    def __init__(
+        self,
+        docstore: BaseDocumentStore,
+        max_nodes: int = 10_000,
+        disk_cache_path: str | None = None,
+        get_version: Callable[[], str | None] | None = None,
+        version_check_interval: float = 60.0,
+        fetch_concurrency: int = 16,
+    ):
+        self._docstore = docstore
+        self.max_nodes = max_nodes
+        self._nodes: OrderedDict[str, BaseNode] = OrderedDict()
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._disk = DiskNodeCache(disk_cache_path) if disk_cache_path else None
+        self._get_version = get_version
+        self.version_check_interval = version_check_interval
+        self._version: str | None = self._disk.version if self._disk else None
+        self._version_checked_at = float("-inf")
+        self._version_lock = threading.Lock()
+        self.fetch_concurrency = fetch_concurrency
+        self._executor = ThreadPoolExecutor(
+            max_workers=fetch_concurrency, thread_name_prefix="docstore-fetch"
+        )
+        # Semaphores are bound to the event loop they are used on
+        self._fetch_semaphores: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._docstore, name)
+
+    def clear(self) -> None:
+        """Drops every cached node from both tiers"""
+        with self._lock:
+            self._nodes.clear()
+        if self._disk:
+            self._disk.reset(self._version)
+
+    @property
+    def index_version(self) -> str | None:
+        """
+        The index version stamp the cached nodes belong to, re-read at most
+        every `version_check_interval` seconds
+        """
+        self._check_version()
+        return self._version
+
+    def _claim_version_check(self) -> float | None:
+        """
+        Returns the time of the check, with the version lock held, if the
+        stamp is due to be re-read. Only one caller re-reads the stamp, the
+        others keep using the cache.
+        """
+        if self._get_version is None:
+            return None
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval:
+            return None
+        if not self._version_lock.acquire(blocking=False):
+            return None
+        return now
+
+    def _set_version(self, version: str | None, checked_at: float) -> None:
+        self._version_checked_at = checked_at
+        if version != self._version:
+            logger.info(f"Index version changed to {version}, clearing cache")
+            self._version = version
+            self.clear()
+
+    def _check_version(self) -> None:
+        """Clears the cache if the index was rebuilt since the last check"""
+        checked_at = self._claim_version_check()
+        if checked_at is None:
+            return
+        try:
+            self._set_version(self._get_version(), checked_at)
+        except Exception:
+            logger.exception("Could not read the index version")
+        finally:
+            self._version_lock.release()
+
+    async def _acheck_version(self) -> None:
+        """Like `_check_version`, reading the stamp off the event loop"""
+        checked_at = self._claim_version_check()
+        if checked_at is None:
+            return
+        try:
+            version = await asyncio.to_thread(self._get_version)
+            self._set_version(version, checked_at)
+        except Exception:
+            logger.exception("Could not read the index version")
+        finally:
+            self._version_lock.release()
+
+    def _lookup(
+        self, node_ids: list[str]
+    ) -> tuple[dict[str, BaseNode], list[str], dict[str, Future]]:
+        """
+        Splits ids into cached nodes, ids this caller must fetch (registered
+        as in flight) and ids already being fetched by another caller.
+        """
+        found: dict[str, BaseNode] = {}
+        with self._lock:
+            for node_id in node_ids:
+                node = self._nodes.get(node_id)
+                if node is not None:
+                    self._nodes.move_to_end(node_id)
+                    found[node_id] = node
+        if self._disk:
+            disk_nodes = self._disk.get_many([i for i in node_ids if i not in found])
+            self._remember(disk_nodes.values())
+            found.update(disk_nodes)
+
+        to_fetch: list[str] = []
+        waiting: dict[str, Future] = {}
+        with self._lock:
+            for node_id in node_ids:
+                if node_id in found:
+                    continue
+                if node_id in self._in_flight:
+                    waiting[node_id] = self._in_flight[node_id]
+                else:
+                    self._in_flight[node_id] = Future()
+                    to_fetch.append(node_id)
+        record_docstore_cache_lookups(hits=len(found), misses=len(to_fetch))
+        return found, to_fetch, waiting
+
+    def _remember(self, nodes) -> None:
+        with self._lock:
+            for node in nodes:
+                self._nodes[node.node_id] = node
+                self._nodes.move_to_end(node.node_id)
+            while len(self._nodes) > self.max_nodes:
+                self._nodes.popitem(last=False)
+
+    def _complete(
+        self,
+        node_ids: list[str],
+        fetched: dict[str, BaseNode | None] | None,
+        error: BaseException | None = None,
+    ) -> None:
+        """Caches fetched nodes and resolves the in-flight futures of node_ids"""
+        if fetched:
+            nodes = [node for node in fetched.values() if node is not None]
+            self._remember(nodes)
+            if self._disk and nodes:
+                self._disk.put_many(nodes)
+        with self._lock:
+            futures = [self._in_flight.pop(node_id) for node_id in node_ids]
+        for node_id, future in zip(node_ids, futures):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(fetched.get(node_id))
+
+    def _fetch(self, node_ids: list[str]) -> dict[str, BaseNode | None]:
+        def get(node_id: str) -> BaseNode | None:
+            return self._docstore.get_document(node_id, raise_error=False)
+
+        if len(node_ids) == 1:
+            return {node_ids[0]: get(node_ids[0])}
+        return dict(zip(node_ids, self._executor.map(get, node_ids)))
+
+    async def _afetch(self, node_ids: list[str]) -> dict[str, BaseNode | None]:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._fetch_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.fetch_concurrency)
+                self._fetch_semaphores[loop] = semaphore
+
+        async def get(node_id: str) -> BaseNode | None:
+            async with semaphore:
+                return await self._docstore.aget_document(node_id, raise_error=False)
+
+        docs = await asyncio.gather(*[get(node_id) for node_id in node_ids])
+        return dict(zip(node_ids, docs))
+
+    @staticmethod
+    def _ordered(
+        node_ids: list[str], found: dict[str, BaseNode | None], raise_error: bool
+    ) -> list[BaseNode | None]:
+        for node_id in node_ids:
+            if found.get(node_id) is None and raise_error:
+                raise ValueError(f"doc_id {node_id} not found.")
+        return [found.get(node_id) for node_id in node_ids]
+
+    def get_nodes(
+        self, node_ids: list[str], raise_error: bool = True
+    ) -> list[BaseNode | None]:
+        self._check_version()
+        found, to_fetch, waiting = self._lookup(list(dict.fromkeys(node_ids)))
+        if to_fetch:
+            try:
+                fetched = self._fetch(to_fetch)
+            except BaseException as e:
+                self._complete(to_fetch, None, error=e)
+                raise
+            self._complete(to_fetch, fetched)
+            found.update(fetched)
+        for node_id, future in waiting.items():
+            found[node_id] = future.result()
+        return self._ordered(node_ids, found, raise_error)
+
+    async def aget_nodes(
+        self, node_ids: list[str], raise_error: bool = True
+    ) -> list[BaseNode | None]:
+        await self._acheck_version()
+        found, to_fetch, waiting = self._lookup(list(dict.fromkeys(node_ids)))
+        if to_fetch:
+            try:
+                fetched = await self._afetch(to_fetch)
+            except BaseException as e:
+                self._complete(to_fetch, None, error=e)
+                raise
+            self._complete(to_fetch, fetched)
+            found.update(fetched)
+        for node_id, future in waiting.items():
+            found[node_id] = await asyncio.wrap_future(future)
+        return self._ordered(node_ids, found, raise_error)
+
+    def get_document(self, doc_id: str, raise_error: bool = True) -> BaseNode | None:
+        return self.get_nodes([doc_id], raise_error=raise_error)[0]
+
+    async def aget_document(
+        self, doc_id: str, raise_error: bool = True
+    ) -> BaseNode | None:
+        return (await self.aget_nodes([doc_id], raise_error=raise_error))[0]
+
+    def get_node(self, node_id: str, raise_error: bool = True) -> BaseNode | None:
+        return self.get_document(node_id, raise_error=raise_error)
+
+    async def aget_node(
+        self, node_id: str, raise_error: bool = True
+    ) -> BaseNode | None:
+        return await self.aget_document(node_id, raise_error=raise_error)
+
+    def document_exists(self, doc_id: str) -> bool:
+        return self.get_document(doc_id, raise_error=False) is not None
+
+    async def adocument_exists(self, doc_id: str) -> bool:
+        return await self.aget_document(doc_id, raise_error=False) is not None
+
+    def add_documents(self, nodes: Sequence[BaseNode], *args, **kwargs) -> None:
+        self._docstore.add_documents(nodes, *args, **kwargs)
+        self._write_through(nodes)
+
+    async def async_add_documents(
+        self, nodes: Sequence[BaseNode], *args, **kwargs
+    ) -> None:
+        await self._docstore.async_add_documents(nodes, *args, **kwargs)
+        self._write_through(nodes)
+
+    def _write_through(self, nodes: Sequence[BaseNode]) -> None:
+        self._remember(nodes)
+        if self._disk:
+            self._disk.put_many(nodes)
+
+    def _evict(self, node_ids: list[str]) -> None:
+        with self._lock:
+            for node_id in node_ids:
+                self._nodes.pop(node_id, None)
+        if self._disk:
+            self._disk.delete_many(node_ids)
+
+    def delete_document(self, doc_id: str, raise_error: bool = True) -> None:
+        self._evict([doc_id])
+        self._docstore.delete_document(doc_id, raise_error=raise_error)
+
+    async def adelete_document(self, doc_id: str, raise_error: bool = True) -> None:
+        self._evict([doc_id])
+        await self._docstore.adelete_document(doc_id, raise_error=raise_error)
+
+    def delete_ref_doc(self, ref_doc_id: str, raise_error: bool = True) -> None:
+        ref_doc_info = self._docstore.get_ref_doc_info(ref_doc_id)
+        node_ids = ref_doc_info.node_ids if ref_doc_info else []
+        self._evict([ref_doc_id, *node_ids])
+        self._docstore.delete_ref_doc(ref_doc_id, raise_error=raise_error)
+
+    async def adelete_ref_doc(self, ref_doc_id: str, raise_error: bool = True) -> None:
+        ref_doc_info = await self._docstore.aget_ref_doc_info(ref_doc_id)
+        node_ids = ref_doc_info.node_ids if ref_doc_info else []
+        self._evict([ref_doc_id, *node_ids])
+        await self._docstore.adelete_ref_doc(ref_doc_id, raise_error=raise_error)
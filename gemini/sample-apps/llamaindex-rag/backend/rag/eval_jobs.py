@@ -0,0 +1,416 @@
+"""Resumable background batch evaluation jobs"""
+import asyncio
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+
+from backend.rag.evaluate import LLMEvaluator, write_results_to_bq
+from backend.rag.quota import QuotaBackoff, is_quota_error
+from backend.rag.response_scorer import bind_judge_metrics
+from common.utils import download_blob
+from datasets import Dataset
+from google.cloud import bigquery
+import pandas as pd
+from ragas import evaluate
+from ragas.metrics import (
+    answer_correctness,
+    answer_relevancy,
+    answer_similarity,
+    context_precision,
+    context_recall,
+    context_relevancy,
+    faithfulness,
+)
+from ragas.run_config import RunConfig
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RAGAS_METRICS = {
+    "context_precision": context_precision,
+    "answer_relevancy": answer_relevancy,
+    "faithfulness": faithfulness,
+    "context_relevancy": context_relevancy,
+    "context_recall": context_recall,
+    "answer_similarity": answer_similarity,
+    "answer_correctness": answer_correctness,
+}
+
+JOB_FILE = "job.json"
+DATASET_FILE = "ground_truth.csv"
+ANSWERS_DIR = "answers"
+SCORES_DIR = "scores"
+# Marks a scored batch as written to BigQuery
+BQ_MARKER_SUFFIX = ".bq"
+
+
+def write_parquet_atomic(df: pd.DataFrame, path: str) -> None:
+    """Writes a Parquet file so a crash never leaves a partial checkpoint."""
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+class EvalJobManager:
+    """
+    Runs /eval_batch evaluations as resumable background jobs.
+
+    Each job is checkpointed under `jobs_dir/<job_id>`:
+    - job.json: request and progress
+    - ground_truth.csv: the evaluation dataset
+    - answers/: one Parquet file per answered and judged question
+    - scores/: one Parquet file per RAGAS-scored batch, with a `.bq` marker
+      once the batch has been written to BigQuery
+
+    Job IDs are derived from the request and the dataset contents, so
+    resubmitting an interrupted or failed job resumes it and skips the rows
+    that are already done.
+    """
+
+    def __init__(
+        self,
+        jobs_dir: str,
+        concurrency: int = 8,
+        batch_size: int = 100,
+        max_retries: int = 6,
+        max_jobs: int = 2,
+    ):
+        self.jobs_dir = jobs_dir
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_jobs, thread_name_prefix="eval-job"
+        )
+        # Status of the jobs queued or running in this process
+        self._jobs: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    def download_dataset(self, dataset_uri: str) -> str:
+        """Downloads a `bucket/path.csv` dataset to a unique local path."""
+        bucket_name, _, file_name = dataset_uri.partition("/")
+        dataset_path = os.path.join(self.jobs_dir, f".download-{uuid.uuid4()}.csv")
+        download_blob(bucket_name, file_name, dataset_path)
+        return dataset_path
+
+    @staticmethod
+    def get_job_id(request: dict, dataset_path: str) -> str:
+        digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode())
+        with open(dataset_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()[:16]
+
+    def submit(
+        self,
+        request: dict,
+        dataset_path: str,
+        retrieval_qa_func: Callable,
+        llm_evaluator: LLMEvaluator,
+    ) -> dict:
+        """
+        Starts or resumes the job for a request and dataset, returning its status.
+        Takes ownership of `dataset_path`. Running and completed jobs are
+        returned as they are.
+        """
+        job_id = self.get_job_id(request, dataset_path)
+        job_dir = self.job_dir(job_id)
+        with self._lock:
+            if job_id in self._jobs:
+                os.remove(dataset_path)
+                return dict(self._jobs[job_id])
+            status = self._read_status(job_id)
+            if status is not None and status["status"] == "completed":
+                os.remove(dataset_path)
+                return status
+            os.makedirs(os.path.join(job_dir, ANSWERS_DIR), exist_ok=True)
+            os.makedirs(os.path.join(job_dir, SCORES_DIR), exist_ok=True)
+            os.replace(dataset_path, os.path.join(job_dir, DATASET_FILE))
+            if status is None:
+                status = {
+                    "job_id": job_id,
+                    "eval_uuid": str(uuid.uuid4()),
+                    "request": request,
+                    "created_at": datetime.now().isoformat(),
+                }
+            else:
+                logger.info(f"Resuming eval job {job_id}")
+            status.update(status="queued", error=None)
+            self._jobs[job_id] = status
+            self._write_status(job_id, status)
+        self._executor.submit(self._run_job, job_id, retrieval_qa_func, llm_evaluator)
+        return dict(status)
+
+    def get_status(self, job_id: str) -> dict | None:
+        """Returns the status and progress of a job, or None if unknown."""
+        with self._lock:
+            if job_id in self._jobs:
+                return dict(self._jobs[job_id])
+        status = self._read_status(job_id)
+        if status is not None and status["status"] in ("queued", "running"):
+            # Left behind by a previous process; resubmit to resume
+            status["status"] = "interrupted"
+        return status
+
+    def get_results(self, job_id: str) -> pd.DataFrame:
+        """Returns the scored rows of a job so far, in dataset order."""
+        paths = sorted(
+            glob.glob(os.path.join(self.job_dir(job_id), SCORES_DIR, "*.parquet"))
+        )
+        if not paths:
+            return pd.DataFrame()
+        results_df = pd.concat([pd.read_parquet(p) for p in paths])
+        results_df = results_df.sort_values("question_idx").reset_index(drop=True)
+        # Parquet lists are read back as numpy arrays
+        results_df["contexts"] = results_df["contexts"].map(
+            lambda x: None if x is None else list(x)
+        )
+        return results_df
+
+    def _read_status(self, job_id: str) -> dict | None:
+        try:
+            with open(os.path.join(self.job_dir(job_id), JOB_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_status(self, job_id: str, status: dict) -> None:
+        path = os.path.join(self.job_dir(job_id), JOB_FILE)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(status, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _update_status(self, job_id: str, increment: dict | None = None, **fields):
+        with self._lock:
+            status = self._jobs[job_id]
+            for key, value in (increment or {}).items():
+                status[key] = status.get(key, 0) + value
+            status.update(fields, updated_at=datetime.now().isoformat())
+            self._write_status(job_id, status)
+
+    def _run_job(
+        self, job_id: str, retrieval_qa_func: Callable, llm_evaluator: LLMEvaluator
+    ) -> None:
+        try:
+            asyncio.run(self._arun_job(job_id, retrieval_qa_func, llm_evaluator))
+            self._update_status(job_id, status="completed")
+        except Exception as e:
+            logger.exception(f"Eval job {job_id} failed")
+            self._update_status(job_id, status="failed", error=str(e))
+        finally:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+
+    async def _arun_job(
+        self, job_id: str, retrieval_qa_func: Callable, llm_evaluator: LLMEvaluator
+    ) -> None:
+        job_dir = self.job_dir(job_id)
+        request = self._jobs[job_id]["request"]
+        eval_df = pd.read_csv(os.path.join(job_dir, DATASET_FILE))
+        eval_df = eval_df[["question", "ground_truth"]]
+        eval_df = eval_df.astype({"question": str, "ground_truth": str})
+
+        answer_paths = glob.glob(os.path.join(job_dir, ANSWERS_DIR, "*.parquet"))
+        answers = []
+        for path in answer_paths:
+            answer = pd.read_parquet(path).iloc[0].to_dict()
+            answer["question_idx"] = int(answer["question_idx"])
+            if answer["contexts"] is not None:
+                answer["contexts"] = list(answer["contexts"])
+            answers.append(answer)
+        answered_idx = {answer["question_idx"] for answer in answers}
+        scored_idx = set()
+        written_rows = 0
+        unwritten_paths = []
+        for path in glob.glob(os.path.join(job_dir, SCORES_DIR, "*.parquet")):
+            batch_idx = pd.read_parquet(path, columns=["question_idx"])["question_idx"]
+            scored_idx.update(int(idx) for idx in batch_idx)
+            if os.path.exists(path + BQ_MARKER_SUFFIX):
+                written_rows += len(batch_idx)
+            else:
+                unwritten_paths.append(path)
+        self._update_status(
+            job_id,
+            status="running",
+            total_rows=len(eval_df),
+            answered_rows=len(answered_idx),
+            scored_rows=len(scored_idx),
+            written_rows=written_rows,
+            failed_rows=0,
+            quota_retries=0,
+        )
+
+        metrics = bind_judge_metrics(
+            [RAGAS_METRICS[m] for m in request["ragas_metrics"]],
+            request["eval_model_name"],
+            request["embedding_model_name"],
+        )
+        bq_client = bigquery.Client() if request.get("write_to_bq") else None
+        for path in unwritten_paths:
+            await asyncio.to_thread(self._write_batch_to_bq, job_id, path, bq_client)
+
+        # Rows are scored with RAGAS in batches while later rows are still answered
+        queue: asyncio.Queue = asyncio.Queue()
+        for answer in answers:
+            if answer["question_idx"] not in scored_idx:
+                queue.put_nowait(answer)
+        scorer = asyncio.create_task(
+            self._score_batches(job_id, queue, metrics, bq_client)
+        )
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        backoff = QuotaBackoff()
+
+        async def answer_row(idx: int, question: str, ground_truth: str) -> None:
+            async with semaphore:
+                # Retried separately, so a judge quota error doesn't re-run the query
+                response = await self._call_with_backoff(
+                    job_id, backoff, lambda: retrieval_qa_func(question)
+                )
+                answer, contexts = llm_evaluator.parse_response(response)
+                eval_result = await self._call_with_backoff(
+                    job_id,
+                    backoff,
+                    lambda: llm_evaluator.async_eval_answer(
+                        llm_evaluator.eval_model,
+                        question,
+                        answer,
+                        ground_truth,
+                        contexts,
+                    ),
+                )
+            record = {
+                "question_idx": idx,
+                "question": question,
+                "ground_truth": ground_truth,
+                "answer": None if answer is None else str(answer),
+                "contexts": contexts,
+                "eval_result": eval_result,
+                "score": llm_evaluator.extract_score(eval_result),
+            }
+            write_parquet_atomic(
+                pd.DataFrame([record]),
+                os.path.join(job_dir, ANSWERS_DIR, f"row_{idx:06d}.parquet"),
+            )
+            self._update_status(job_id, increment={"answered_rows": 1})
+            queue.put_nowait(record)
+
+        results = await asyncio.gather(
+            *[
+                answer_row(idx, x["question"], x["ground_truth"])
+                for idx, x in eval_df.iterrows()
+                if idx not in answered_idx
+            ],
+            return_exceptions=True,
+        )
+        queue.put_nowait(None)
+        await scorer
+
+        errors = [r for r in results if isinstance(r, Exception)]
+        self._update_status(job_id, failed_rows=len(errors))
+        if errors:
+            raise RuntimeError(
+                f"{len(errors)} of {len(eval_df)} questions failed, "
+                f"resubmit the job to retry them. First error: {errors[0]}"
+            )
+
+    async def _call_with_backoff(
+        self, job_id: str, backoff: QuotaBackoff, func: Callable[[], Awaitable]
+    ):
+        for attempt in range(self.max_retries + 1):
+            await backoff.wait()
+            try:
+                result = await func()
+                backoff.record_success()
+                return result
+            except Exception as e:
+                if not is_quota_error(e) or attempt == self.max_retries:
+                    raise
+                delay = backoff.record_quota_error()
+                self._update_status(job_id, increment={"quota_retries": 1})
+                logger.warning(
+                    f"Eval job {job_id} hit a quota error, backing off {delay:.1f}s: {e}"
+                )
+
+    async def _score_batches(
+        self,
+        job_id: str,
+        queue: asyncio.Queue,
+        metrics: list,
+        bq_client: bigquery.Client | None,
+    ) -> None:
+        batch = []
+        while True:
+            record = await queue.get()
+            if record is not None:
+                batch.append(record)
+            if batch and (record is None or len(batch) >= self.batch_size):
+                await asyncio.to_thread(
+                    self._score_batch, job_id, batch, metrics, bq_client
+                )
+                batch = []
+            if record is None:
+                return
+
+    def _score_batch(
+        self,
+        job_id: str,
+        records: list[dict],
+        metrics: list,
+        bq_client: bigquery.Client | None,
+    ) -> None:
+        status = self._jobs[job_id]
+        request = status["request"]
+        batch_df = pd.DataFrame(records).sort_values("question_idx")
+        batch_df = batch_df.reset_index(drop=True)
+        result = evaluate(
+            Dataset.from_pandas(
+                batch_df[["question", "ground_truth", "answer", "contexts"]]
+            ),
+            metrics=metrics,
+            run_config=RunConfig(max_workers=self.concurrency),
+        )
+        ragas_results_df = result.to_pandas()[request["ragas_metrics"]].fillna(0)
+
+        batch_df["date_time"] = datetime.now()
+        batch_df["eval_uuid"] = status["eval_uuid"]
+        batch_df["retrieval_strategy"] = request["retrieval_strategy"]
+        batch_df["eval_model_name"] = request["eval_model_name"]
+        batch_df["similarity_top_k"] = request["similarity_top_k"]
+        batch_df["llm_model_name"] = request["llm_name"]
+        batch_df = pd.concat([batch_df, ragas_results_df], axis=1)
+
+        path = os.path.join(
+            self.job_dir(job_id),
+            SCORES_DIR,
+            f"batch_{batch_df['question_idx'].iloc[0]:06d}.parquet",
+        )
+        write_parquet_atomic(batch_df, path)
+        self._update_status(job_id, increment={"scored_rows": len(batch_df)})
+        self._write_batch_to_bq(job_id, path, bq_client)
+
+    def _write_batch_to_bq(
+        self, job_id: str, path: str, bq_client: bigquery.Client | None
+    ) -> None:
+        if bq_client is None:
+            return
+        request = self._jobs[job_id]["request"]
+        batch_df = pd.read_parquet(path)
+        write_results_to_bq(batch_df, request["bq_eval_results_table_id"], bq_client)
+        # Rows are written at least once: a crash before the marker rewrites the batch
+        open(path + BQ_MARKER_SUFFIX, "w").close()
+        self._update_status(job_id, increment={"written_rows": len(batch_df)})
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
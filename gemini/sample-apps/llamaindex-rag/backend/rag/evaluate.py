@@ -24,6 +24,7 @@ class LLMEvaluator:
     """
     LLMEvaluator.evaluate
     LLMEvaluator.async_eval_retrieval
+    LLMEvaluator.parse_response
     LLMEvaluator.extract_score
     LLMEvaluator.async_eval_question_answer_pair
     LLMEvaluator.async_eval_answer
@@ -100,17 +101,26 @@ class LLMEvaluator:
         LLMEvaluator.async_eval_question_answer_pair
         """
         response = await retrieval_qa_func(question)
+        answer, retrieved_context = self.parse_response(response)
+
+        score = await self.async_eval_answer(
+            eval_model, question, answer, ground_truth, retrieved_context
+        )
+        return answer, score, retrieved_context
+
+    @staticmethod
+    def parse_response(response) -> tuple:
+        """
+        LLMEvaluator.parse_response
+        Returns the answer and the retrieved context of a RAG response.
+        """
         if (type(response) == Response) or (type(response) == AgentChatResponse):
             answer = response.response
             retrieved_context = [r.node.text for r in response.source_nodes]
         else:
             retrieved_context = None
             answer = response
-
-        score = await self.async_eval_answer(
-            eval_model, question, answer, ground_truth, retrieved_context
-        )
-        return answer, score, retrieved_context
+        return answer, retrieved_context
 
     @staticmethod
     def extract_score(text: str) -> str | None:
@@ -164,13 +174,16 @@ class LLMEvaluator:
 
 
 def write_results_to_bq(
-    pd_dataframe: pd.DataFrame, table_id: str = "eval_results.eval_results_table"
+    pd_dataframe: pd.DataFrame,
+    table_id: str = "eval_results.eval_results_table",
+    client: bigquery.Client | None = None,
 ):
     """
     write_results_to_bq
+    Pass `client` to reuse one BigQuery client across batches.
     """
     logger.info("Writing results to BQ...")
-    client = bigquery.Client()
+    client = client or bigquery.Client()
 
     # Define the job configuration
     job_config = bigquery.LoadJobConfig(
@@ -1,19 +1,39 @@
 """Main state management class for indices and prompts for
 experimentation UI"""
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import functools
 import logging
+import os
+import shutil
+import threading
 
-import Stemmer
 from backend.rag.async_extensions import (
     AsyncHyDEQueryTransform,
     AsyncRetrieverQueryEngine,
     AsyncTransformQueryEngine,
+    HyDECache,
+)
+from backend.rag.bm25_index import (
+    BM25IndexRetriever,
+    PersistentBM25Index,
+    bm25_index_dir,
+    bm25_index_prefix,
+    load_bm25_index,
 )
 from backend.rag.claude_vertex import ClaudeVertexLLM
+from backend.rag.docstore_cache import CachingDocumentStore, read_index_version
+from backend.rag.local_vector_store import (
+    load_local_vector_store,
+    local_vector_index_prefix,
+)
 from backend.rag.node_reranker import CustomLLMRerank
 from backend.rag.parent_retriever import ParentRetriever
 from backend.rag.prompts import Prompts
 from backend.rag.qa_followup_retriever import QAFollowupRetriever, QARetriever
+from backend.rag.tracing import traced_docstore, traced_retriever
+from cachetools import TTLCache
 from google.cloud import aiplatform
 from llama_index.core import (
     PromptTemplate,
@@ -27,8 +47,8 @@ from llama_index.core.retrievers import AutoMergingRetriever, QueryFusionRetriev
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from llama_index.embeddings.vertex import VertexTextEmbedding
 from llama_index.llms.vertex import Vertex
-from llama_index.retrievers.bm25 import BM25Retriever
 from llama_index.storage.docstore.firestore import FirestoreDocumentStore
+from llama_index.storage.kvstore.firestore import FirestoreKVStore
 from llama_index.vector_stores.vertexaivectorsearch import VertexAIVectorStore
 
 logging.basicConfig(level=logging.INFO)  # Set the desired logging level
@@ -59,6 +79,20 @@ class IndexManager:
         firestore_db_name: str | None,
         firestore_namespace: str | None,
         vs_bucket_name: str,
+        query_engine_cache_size: int = 8,
+        vector_data_prefix: str = "vector_data",
+        bm25_index_dir: str = "/tmp/bm25_index",
+        speculative_hyde: bool = False,
+        hyde_cache_size: int = 1024,
+        hyde_cache_ttl: float = 3600.0,
+        docstore_cache_size: int = 10_000,
+        docstore_disk_cache_dir: str | None = None,
+        docstore_version_check_interval: float = 60.0,
+        index_pool_size: int = 4,
+        index_id_cache_ttl: float = 600.0,
+        vector_store_backend: str = "vertex",
+        local_vector_index_dir: str = "/tmp/local_vector_index",
+        local_vector_nprobe: int = 16,
     ):
         self.project_id = project_id
         self.location = location
@@ -70,26 +104,56 @@ class IndexManager:
         self.firestore_db_name = firestore_db_name
         self.firestore_namespace = firestore_namespace
         self.vs_bucket_name = vs_bucket_name
-        self.embed_model = VertexTextEmbedding(
-            model_name=self.embeddings_model_name,
-            project=self.project_id,
-            location=self.location,
+        self.query_engine_cache_size = query_engine_cache_size
+        self.query_engine = None
+        self.vector_data_prefix = vector_data_prefix
+        self.bm25_index_dir = bm25_index_dir
+        # Loaded lazily on the first hybrid retrieval request
+        self._bm25_index: PersistentBM25Index | None = None
+        # Index version stamp the loaded BM25 index belongs to
+        self._bm25_version: str | None = None
+        self._bm25_lock = threading.Lock()
+        # LRU of built query engines keyed on their full configuration
+        self._query_engine_cache: OrderedDict = OrderedDict()
+        self._query_engine_cache_lock = threading.Lock()
+        self.speculative_hyde = speculative_hyde
+        # Hypothetical documents only depend on the LLM, prompt and query,
+        # so they are shared by every query engine and survive index changes
+        self.hyde_cache = (
+            HyDECache(maxsize=hyde_cache_size, ttl=hyde_cache_ttl)
+            if hyde_cache_size > 0
+            else None
         )
-        self.base_index = self.get_vector_index(
-            index_name=self.base_index_name,
-            endpoint_name=self.base_endpoint_name,
-            firestore_db_name=self.firestore_db_name,
-            firestore_namespace=self.firestore_namespace,
+        self.docstore_cache_size = docstore_cache_size
+        self.docstore_disk_cache_dir = docstore_disk_cache_dir
+        self.docstore_version_check_interval = docstore_version_check_interval
+        # Cached docstores per (database, namespace), shared by the base and QA
+        # indexes and reused when switching back to an earlier namespace
+        self._docstores: dict[tuple[str, str], CachingDocumentStore] = {}
+        self._docstores_lock = threading.Lock()
+        # Resource IDs of Vector Search indexes and endpoints by display name
+        self._resource_ids: TTLCache = TTLCache(maxsize=256, ttl=index_id_cache_ttl)
+        self._resource_ids_lock = threading.Lock()
+        self._aiplatform_initialized = False
+        # LRU of recently used index handles, so switching back is instant
+        self.index_pool_size = index_pool_size
+        self._index_pool: OrderedDict[tuple, VectorStoreIndex] = OrderedDict()
+        self._index_pool_lock = threading.Lock()
+        self._index_loader = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="index-loader"
         )
-        if self.qa_endpoint_name and self.qa_index_name:
-            self.qa_index = self.get_vector_index(
-                index_name=self.qa_index_name,
-                endpoint_name=self.qa_endpoint_name,
-                firestore_db_name=self.firestore_db_name,
-                firestore_namespace=self.firestore_namespace,
-            )
-        else:
-            self.qa_index = None
+        # Separate from the loader, whose tasks wait on resolutions
+        self._resource_resolver = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="index-resolver"
+        )
+        # "vertex" for Vertex AI Vector Search, or "local" for a LocalVectorStore
+        # built by run_parse_embed_index and downloaded from GCS
+        self.vector_store_backend = vector_store_backend
+        self.local_vector_index_dir = local_vector_index_dir
+        self.local_vector_nprobe = local_vector_nprobe
+        self._qa_index_future: Future | None = None
+        self.embed_model = self.get_embed_model()
+        self._load_indexes()
 
     def get_current_index_info(self) -> dict:
         """Return the indices currently being used"""
@@ -102,6 +166,14 @@ class IndexManager:
             "firestore_namespace": self.firestore_namespace,
         }
 
+    def get_embed_model(self) -> VertexTextEmbedding:
+        """Return the embedding model shared by the vector indexes"""
+        return VertexTextEmbedding(
+            model_name=self.embeddings_model_name,
+            project=self.project_id,
+            location=self.location,
+        )
+
     def get_vertex_llm(
         self, llm_name: str, temperature: float, system_prompt: str
     ) -> Vertex | ClaudeVertexLLM:
@@ -121,9 +193,51 @@ class IndexManager:
                 max_tokens=3000,
                 system_prompt=system_prompt,
             )
-        Settings.llm = llm
         return llm
 
+    def get_reranker_llm(self, temperature: float, system_prompt: str) -> Vertex:
+        """Return the LLM used to rerank retrieved nodes"""
+        return Vertex(
+            model="gemini-1.5-flash",
+            max_tokens=8192,
+            temperature=temperature,
+            system_prompt=system_prompt,
+        )
+
+    def clear_query_engine_cache(self) -> None:
+        """Drop all cached query engines, e.g. after an index or prompt change"""
+        with self._query_engine_cache_lock:
+            self._query_engine_cache.clear()
+
+    @property
+    def qa_index(self) -> VectorStoreIndex | None:
+        """
+        The QA index is loaded in the background while the base index loads,
+        and is only waited for when a qa_followup engine first needs it.
+        """
+        if self._qa_index_future is None:
+            return None
+        return self._qa_index_future.result()
+
+    def _load_indexes(self) -> None:
+        """Loads the base index, and starts loading the QA index concurrently"""
+        if self.qa_endpoint_name and self.qa_index_name:
+            self._qa_index_future = self._index_loader.submit(
+                self.get_pooled_vector_index,
+                index_name=self.qa_index_name,
+                endpoint_name=self.qa_endpoint_name,
+                firestore_db_name=self.firestore_db_name,
+                firestore_namespace=self.firestore_namespace,
+            )
+        else:
+            self._qa_index_future = None
+        self.base_index = self.get_pooled_vector_index(
+            index_name=self.base_index_name,
+            endpoint_name=self.base_endpoint_name,
+            firestore_db_name=self.firestore_db_name,
+            firestore_namespace=self.firestore_namespace,
+        )
+
     def set_current_indexes(
         self,
         base_index_name,
@@ -140,21 +254,106 @@ class IndexManager:
         self.qa_endpoint_name = qa_endpoint_name
         self.firestore_db_name = firestore_db_name
         self.firestore_namespace = firestore_namespace
-        self.base_index = self.get_vector_index(
-            index_name=self.base_index_name,
-            endpoint_name=self.base_endpoint_name,
-            firestore_db_name=self.firestore_db_name,
-            firestore_namespace=self.firestore_namespace,
+        self._load_indexes()
+        self._bm25_index = None
+        self.clear_query_engine_cache()
+
+    def get_bm25_index(self) -> PersistentBM25Index:
+        """
+        Returns the persisted BM25 index for the current docstore namespace.
+        The index is downloaded from GCS if it isn't available locally, and
+        again when run_parse_embed_index stamps a new index version. The
+        index is built by run_parse_embed_index, so it is empty until then.
+        """
+        docstore = self.base_index.docstore
+        version = (
+            docstore.index_version
+            if isinstance(docstore, CachingDocumentStore)
+            else None
         )
-        if self.qa_endpoint_name and self.qa_index_name:
-            self.qa_index = self.get_vector_index(
-                index_name=self.qa_index_name,
-                endpoint_name=self.qa_endpoint_name,
-                firestore_db_name=self.firestore_db_name,
-                firestore_namespace=self.firestore_namespace,
+        with self._bm25_lock:
+            if self._bm25_index is not None and version == self._bm25_version:
+                return self._bm25_index
+            bm25_index = load_bm25_index(
+                self.vs_bucket_name,
+                prefix=bm25_index_prefix(
+                    self.vector_data_prefix, self.firestore_namespace
+                ),
+                local_dir=bm25_index_dir(self.bm25_index_dir, version),
+            )
+            if len(bm25_index) == 0:
+                # Building it here would read the whole namespace per instance
+                logger.warning(
+                    f"No BM25 index found for {self.firestore_namespace}, "
+                    "run run_parse_embed_index to build it"
+                )
+            previous = self._bm25_index
+            if previous is not None and previous.persist_dir != bm25_index.persist_dir:
+                # Segments are memory-mapped, so queries still running on the
+                # previous index keep reading the unlinked files
+                shutil.rmtree(previous.persist_dir, ignore_errors=True)
+            self._bm25_index = bm25_index
+            self._bm25_version = version
+            return bm25_index
+
+    def resolve_resource_id(self, resource_type: str, display_name: str) -> str:
+        """
+        Returns the ID of the Vector Search index or endpoint
+        (resource_type "index" or "endpoint") with the given display name.
+        Resolutions are cached for index_id_cache_ttl seconds.
+        """
+        key = (resource_type, display_name)
+        with self._resource_ids_lock:
+            resource_id = self._resource_ids.get(key)
+        if resource_id is not None:
+            return resource_id
+
+        if not self._aiplatform_initialized:
+            aiplatform.init(project=self.project_id, location=self.location)
+            self._aiplatform_initialized = True
+        if resource_type == "index":
+            resources = aiplatform.MatchingEngineIndex.list(
+                filter=f'display_name="{display_name}"'
             )
         else:
-            self.qa_index = None
+            resources = aiplatform.MatchingEngineIndexEndpoint.list(
+                filter=f'display_name="{display_name}"'
+            )
+        if not resources:
+            raise ValueError(
+                f"No {resource_type} found with display name: {display_name}"
+            )
+        resource_id = resources[0].resource_name.split("/")[-1]
+        with self._resource_ids_lock:
+            self._resource_ids[key] = resource_id
+        return resource_id
+
+    def get_pooled_vector_index(
+        self,
+        index_name: str,
+        endpoint_name: str,
+        firestore_db_name: str | None,
+        firestore_namespace: str | None,
+    ) -> VectorStoreIndex:
+        """Returns a recently used index handle, or loads it with get_vector_index"""
+        key = (index_name, endpoint_name, firestore_db_name, firestore_namespace)
+        with self._index_pool_lock:
+            vector_index = self._index_pool.get(key)
+            if vector_index is not None:
+                self._index_pool.move_to_end(key)
+                return vector_index
+
+        vector_index = self.get_vector_index(
+            index_name=index_name,
+            endpoint_name=endpoint_name,
+            firestore_db_name=firestore_db_name,
+            firestore_namespace=firestore_namespace,
+        )
+        with self._index_pool_lock:
+            self._index_pool[key] = vector_index
+            while len(self._index_pool) > self.index_pool_size:
+                self._index_pool.popitem(last=False)
+        return vector_index
 
     def get_vector_index(
         self,
@@ -167,38 +366,38 @@ class IndexManager:
         Returns a llamaindex VectorStoreIndex object which contains a storage context,
         with an accompanying local document store from google cloud storage.
         """
-        # Initialize Vertex AI
-        aiplatform.init(project=self.project_id, location=self.location)
-        # Get the Vector Search index
-        indexes = aiplatform.MatchingEngineIndex.list(
-            filter=f'display_name="{index_name}"'
-        )
-        if not indexes:
-            raise ValueError(f"No index found with display name: {index_name}")
-        vs_index = indexes[0]
-        # Get the Vector Search endpoint
-        endpoints = aiplatform.MatchingEngineIndexEndpoint.list(
-            filter=f'display_name="{endpoint_name}"'
-        )
-        if not endpoints:
-            raise ValueError(f"No endpoint found with display name: {endpoint_name}")
-        vs_endpoint = endpoints[0]
-        # Create the vector store
-        vector_store = VertexAIVectorStore(
-            project_id=self.project_id,
-            region=self.location,
-            index_id=vs_index.resource_name.split("/")[-1],
-            endpoint_id=vs_endpoint.resource_name.split("/")[-1],
-            gcs_bucket_name=self.vs_bucket_name,
-        )
         if firestore_db_name and firestore_namespace:
-            docstore = FirestoreDocumentStore.from_database(
-                project=self.project_id,
-                database=firestore_db_name,
-                namespace=firestore_namespace,
-            )
+            docstore = self.get_docstore(firestore_db_name, firestore_namespace)
         else:
             docstore = None
+        if self.vector_store_backend == "local":
+            vector_store = load_local_vector_store(
+                self.vs_bucket_name,
+                prefix=local_vector_index_prefix(
+                    self.vector_data_prefix, firestore_namespace, index_name
+                ),
+                local_dir=self.local_vector_index_dir,
+                nprobe=self.local_vector_nprobe,
+                # Pooled handles pick up versions published by later runs
+                get_index_version=(
+                    (lambda: docstore.index_version) if docstore is not None else None
+                ),
+            )
+        else:
+            # Resolve the Vector Search index and endpoint concurrently
+            index_id, endpoint_id = self._resource_resolver.map(
+                self.resolve_resource_id,
+                ["index", "endpoint"],
+                [index_name, endpoint_name],
+            )
+            # Create the vector store
+            vector_store = VertexAIVectorStore(
+                project_id=self.project_id,
+                region=self.location,
+                index_id=index_id,
+                endpoint_id=endpoint_id,
+                gcs_bucket_name=self.vs_bucket_name,
+            )
         # Create storage context
         storage_context = StorageContext.from_defaults(
             vector_store=vector_store, docstore=docstore
@@ -209,6 +408,42 @@ class IndexManager:
         )
         return vector_store_index
 
+    def get_docstore(
+        self, firestore_db_name: str, firestore_namespace: str
+    ) -> CachingDocumentStore:
+        """
+        Returns the cached Firestore docstore for a namespace. The cache is
+        cleared when run_parse_embed_index stamps a new index version.
+        """
+        key = (firestore_db_name, firestore_namespace)
+        with self._docstores_lock:
+            if key not in self._docstores:
+                kvstore = FirestoreKVStore(
+                    project=self.project_id, database=firestore_db_name
+                )
+                docstore = FirestoreDocumentStore(
+                    kvstore, namespace=firestore_namespace
+                )
+                disk_cache_path = (
+                    os.path.join(
+                        self.docstore_disk_cache_dir,
+                        f"{firestore_db_name}_{firestore_namespace}.sqlite",
+                    )
+                    if self.docstore_disk_cache_dir
+                    else None
+                )
+                # Tracing sits below the cache, so it counts actual Firestore reads
+                self._docstores[key] = CachingDocumentStore(
+                    traced_docstore(docstore),
+                    max_nodes=self.docstore_cache_size,
+                    disk_cache_path=disk_cache_path,
+                    get_version=functools.partial(
+                        read_index_version, kvstore, firestore_namespace
+                    ),
+                    version_check_interval=self.docstore_version_check_interval,
+                )
+            return self._docstores[key]
+
     def get_query_engine(
         self,
         prompts: Prompts,
@@ -221,40 +456,111 @@ class IndexManager:
         use_node_rerank: bool = False,
         qa_followup: bool = True,
         hybrid_retrieval: bool = True,
+        streaming: bool = False,
+    ) -> AsyncRetrieverQueryEngine:
+        """
+        Returns a llamaindex QueryEngine given a
+        VectorStoreIndex and hyperparameters.
+        Engines are cached per configuration and prompt version
+        so repeated requests reuse the same retrieval graph.
+        With streaming=True the engine's synthesizer streams tokens,
+        see astream_synthesize.
+        """
+        cache_key = (
+            llm_name,
+            temperature,
+            similarity_top_k,
+            retrieval_strategy,
+            use_hyde,
+            use_refine,
+            use_node_rerank,
+            qa_followup,
+            hybrid_retrieval,
+            streaming,
+            prompts.version,
+        )
+        with self._query_engine_cache_lock:
+            query_engine = self._query_engine_cache.get(cache_key)
+            if query_engine is not None:
+                self._query_engine_cache.move_to_end(cache_key)
+
+        if query_engine is None:
+            logger.info(f"Building query engine for {cache_key}")
+            query_engine = self._build_query_engine(
+                prompts=prompts,
+                llm_name=llm_name,
+                temperature=temperature,
+                similarity_top_k=similarity_top_k,
+                retrieval_strategy=retrieval_strategy,
+                use_hyde=use_hyde,
+                use_refine=use_refine,
+                use_node_rerank=use_node_rerank,
+                qa_followup=qa_followup,
+                hybrid_retrieval=hybrid_retrieval,
+                streaming=streaming,
+            )
+            if self.query_engine_cache_size > 0:
+                with self._query_engine_cache_lock:
+                    self._query_engine_cache[cache_key] = query_engine
+                    while len(self._query_engine_cache) > self.query_engine_cache_size:
+                        self._query_engine_cache.popitem(last=False)
+
+        # The ReAct agent tool wraps the last non-streaming engine
+        if not streaming:
+            self.query_engine = query_engine
+        return query_engine
+
+    def _build_query_engine(
+        self,
+        prompts: Prompts,
+        llm_name: str,
+        temperature: float,
+        similarity_top_k: int,
+        retrieval_strategy: str,
+        use_hyde: bool,
+        use_refine: bool,
+        use_node_rerank: bool,
+        qa_followup: bool,
+        hybrid_retrieval: bool,
+        streaming: bool = False,
     ) -> AsyncRetrieverQueryEngine:
         """
         Creates a llamaindex QueryEngine given a
         VectorStoreIndex and hyperparameters
         """
+        # The LLM is passed explicitly to every component rather than set on
+        # the global Settings, so cached engines don't affect each other
         llm = self.get_vertex_llm(
             llm_name=llm_name,
             temperature=temperature,
             system_prompt=Prompts.system_prompt,
         )
-        Settings.llm = llm
 
         qa_prompt = PromptTemplate(prompts.qa_prompt_tmpl)
         refine_prompt = PromptTemplate(prompts.refine_prompt_tmpl)
 
         if use_refine:
             synth = get_response_synthesizer(
+                llm=llm,
                 text_qa_template=qa_prompt,
                 refine_template=refine_prompt,
                 response_mode="compact",
                 use_async=True,
+                streaming=streaming,
             )
         else:
             synth = get_response_synthesizer(
-                text_qa_template=qa_prompt, response_mode="compact", use_async=True
+                llm=llm,
+                text_qa_template=qa_prompt,
+                response_mode="compact",
+                use_async=True,
+                streaming=streaming,
             )
 
-        base_retriever = self.base_index.as_retriever(similarity_top_k=similarity_top_k)
-        if self.qa_index:
-            qa_vector_retriever = self.qa_index.as_retriever(
-                similarity_top_k=similarity_top_k
-            )
-        else:
-            qa_vector_retriever = None
+        base_retriever = traced_retriever(
+            self.base_index.as_retriever(similarity_top_k=similarity_top_k),
+            "vector_retrieval",
+        )
         query_engine = None  # Default initialization
 
         # Choose between retrieval strategies and configurations.
@@ -271,22 +577,32 @@ class IndexManager:
             retriever = base_retriever
 
         if qa_followup:
+            # Waits for the QA index if it is still loading
+            qa_index = self.qa_index
+            qa_vector_retriever = traced_retriever(
+                qa_index.as_retriever(similarity_top_k=similarity_top_k),
+                "qa_retrieval",
+            )
             qa_retriever = QARetriever(
-                qa_vector_retriever=qa_vector_retriever, docstore=self.qa_index.docstore
+                qa_vector_retriever=qa_vector_retriever, docstore=qa_index.docstore
             )
             retriever = QAFollowupRetriever(
                 qa_retriever=qa_retriever, base_retriever=retriever
             )
 
         if hybrid_retrieval:
-            bm25_retriever = BM25Retriever.from_defaults(
-                docstore=self.base_index.docstore,
-                similarity_top_k=similarity_top_k,
-                stemmer=Stemmer.Stemmer("english"),
-                language="english",
+            bm25_retriever = traced_retriever(
+                BM25IndexRetriever(
+                    # Resolved per query, so a reloaded index is picked up
+                    bm25_index=self.get_bm25_index,
+                    docstore=self.base_index.docstore,
+                    similarity_top_k=similarity_top_k,
+                ),
+                "bm25_retrieval",
             )
             retriever = QueryFusionRetriever(
                 [retriever, bm25_retriever],
+                llm=llm,
                 similarity_top_k=similarity_top_k,
                 num_queries=1,  # set this to 1 to disable query generation
                 mode="reciprocal_rerank",
@@ -297,11 +613,8 @@ class IndexManager:
             )
 
         if use_node_rerank:
-            reranker_llm = Vertex(
-                model="gemini-1.5-flash",
-                max_tokens=8192,
-                temperature=temperature,
-                system_prompt=prompts.system_prompt,
+            reranker_llm = self.get_reranker_llm(
+                temperature=temperature, system_prompt=prompts.system_prompt
             )
             choice_select_prompt = PromptTemplate(prompts.choice_select_prompt_tmpl)
             llm_reranker = CustomLLMRerank(
@@ -322,13 +635,18 @@ class IndexManager:
         if use_hyde:
             hyde_prompt = PromptTemplate(prompts.hyde_prompt_tmpl)
             hyde = AsyncHyDEQueryTransform(
-                include_original=True, hyde_prompt=hyde_prompt
+                llm=llm,
+                include_original=True,
+                hyde_prompt=hyde_prompt,
+                cache=self.hyde_cache,
+                cache_namespace=f"{llm_name}:{temperature}",
             )
             query_engine = AsyncTransformQueryEngine(
-                query_engine=query_engine, query_transform=hyde
+                query_engine=query_engine,
+                query_transform=hyde,
+                speculative_retrieval=self.speculative_hyde,
             )
 
-        self.query_engine = query_engine
         return query_engine
 
     def get_react_agent(
@@ -0,0 +1,665 @@
+"""In-process approximate nearest neighbour vector store over a
+memory-mapped embedding matrix, persisted next to the docstore"""
+from collections import OrderedDict, defaultdict
+import datetime
+import functools
+import json
+import logging
+import os
+import shutil
+import threading
+from typing import Any, Callable
+
+from common.utils import download_bucket_with_transfer_manager, upload_directory_to_gcs
+from google.cloud import storage
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)  # Set the desired logging level
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+# Indexes smaller than this are a single list, i.e. searched exactly
+MIN_VECTORS_FOR_IVF = 4096
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+# Rows scored per matrix product, bounding the float32 copy of the matrix
+SCORE_BLOCK_SIZE = 65_536
+FILTER_CACHE_SIZE = 32
+# Superseded versions stay in the bucket this long for instances still
+# downloading them
+VERSION_GRACE_PERIOD = datetime.timedelta(hours=1)
+
+
+def local_vector_index_prefix(
+    vector_data_prefix: str, firestore_namespace: str, index_name: str
+) -> str:
+    """GCS prefix (and relative local path) of a local vector index"""
+    return f"{vector_data_prefix}/ann/{firestore_namespace}/{index_name}"
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample of the vectors"""
+    rng = np.random.default_rng(seed)
+    num_samples = min(len(vectors), nlist * KMEANS_SAMPLES_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), num_samples, replace=False)]
+    centroids = sample[rng.choice(num_samples, nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=nlist)
+        # Empty lists keep their previous centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.maximum(norms, 1e-12)
+    return centroids
+
+
+def _match_filter(value: Any, metadata_filter: MetadataFilter) -> bool:
+    operator, target = metadata_filter.operator, metadata_filter.value
+    if value is None:
+        return operator in (FilterOperator.NE, FilterOperator.NIN)
+    if operator == FilterOperator.EQ:
+        return value == target
+    if operator == FilterOperator.NE:
+        return value != target
+    if operator == FilterOperator.GT:
+        return value > target
+    if operator == FilterOperator.LT:
+        return value < target
+    if operator == FilterOperator.GTE:
+        return value >= target
+    if operator == FilterOperator.LTE:
+        return value <= target
+    if operator == FilterOperator.IN:
+        return value in target
+    if operator == FilterOperator.NIN:
+        return value not in target
+    if operator == FilterOperator.ANY:
+        return any(v in value for v in target)
+    if operator == FilterOperator.ALL:
+        return all(v in value for v in target)
+    if operator == FilterOperator.CONTAINS:
+        return target in value
+    if operator == FilterOperator.TEXT_MATCH:
+        return target in str(value)
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+
+def matches_filters(metadata: dict, filters: MetadataFilters) -> bool:
+    """Whether node metadata satisfies (possibly nested) metadata filters"""
+    results = (
+        matches_filters(metadata, f)
+        if isinstance(f, MetadataFilters)
+        else _match_filter(metadata.get(f.key), f)
+        for f in filters.filters
+    )
+    if filters.condition == FilterCondition.OR:
+        return any(results)
+    return all(results)
+
+
+def _read_payload(payloads: np.ndarray, payload_offsets: np.ndarray, row: int) -> bytes:
+    start, end = payload_offsets[row], payload_offsets[row + 1]
+    return bytes(payloads[start:end])
+
+
+def _candidate_rows(
+    centroids: np.ndarray | None,
+    list_offsets: np.ndarray,
+    num_rows: int,
+    nprobe: int,
+    query_embedding: np.ndarray,
+) -> np.ndarray:
+    """Rows of the `nprobe` lists whose centroids are closest to the query"""
+    num_lists = len(list_offsets) - 1
+    if centroids is None or num_lists <= nprobe:
+        return np.arange(num_rows)
+    probed = np.argpartition(-(centroids @ query_embedding), nprobe - 1)[:nprobe]
+    return np.concatenate(
+        [np.arange(list_offsets[i], list_offsets[i + 1]) for i in np.sort(probed)]
+    )
+
+
+def _score_rows(
+    vectors: np.ndarray, rows: np.ndarray, query_embedding: np.ndarray
+) -> np.ndarray:
+    return np.concatenate(
+        [
+            np.asarray(vectors[rows[start : start + SCORE_BLOCK_SIZE]], np.float32)
+            @ query_embedding
+            for start in range(0, len(rows), SCORE_BLOCK_SIZE)
+        ]
+        or [np.empty(0, dtype=np.float32)]
+    )
+
+
+class LocalVectorStore(BasePydanticVectorStore):
+    """
+    Inverted-file (IVF) index over a memory-mapped float16 or float32 matrix.
+
+    Vectors are clustered into lists by k-means and stored grouped by list,
+    so a query only scores the vectors of the `nprobe` lists whose centroids
+    are closest to it. Scores are dot products, like the Vertex AI Vector
+    Search indexes. Added nodes are searched exactly and deleted nodes are
+    masked out until `persist` rebuilds the index into a new version
+    directory under `persist_dir`. Queries only hold the lock to take
+    references to the arrays, which `persist` and reloads replace rather
+    than modify.
+    """
+
+    stores_text: bool = True
+    persist_dir: str
+    nprobe: int = 16
+    dtype: str = "float16"
+    _version: int = PrivateAttr(default=0)
+    _vectors: np.ndarray | None = PrivateAttr(default=None)
+    _centroids: np.ndarray | None = PrivateAttr(default=None)
+    _list_offsets: np.ndarray | None = PrivateAttr(default=None)
+    _node_ids: list[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: list[str | None] = PrivateAttr(default_factory=list)
+    _metadata: list[dict] = PrivateAttr(default_factory=list)
+    _payloads: np.ndarray | None = PrivateAttr(default=None)
+    _payload_offsets: np.ndarray | None = PrivateAttr(default=None)
+    _rows: dict[str, int] = PrivateAttr(default_factory=dict)
+    _live: np.ndarray = PrivateAttr(default_factory=lambda: np.ones(0, dtype=bool))
+    _pending: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _filter_masks: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _reload_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _get_index_version: Callable[[], str | None] | None = PrivateAttr(default=None)
+    _sync: Callable[[], None] | None = PrivateAttr(default=None)
+    _index_version: str | None = PrivateAttr(default=None)
+
+    def __init__(self, persist_dir: str, nprobe: int = 16, dtype: str = "float16"):
+        super().__init__(persist_dir=persist_dir, nprobe=nprobe, dtype=dtype)
+        manifest_path = os.path.join(persist_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self._load(json.load(f))
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def __len__(self) -> int:
+        return int(self._live.sum()) + len(self._pending)
+
+    def __bool__(self) -> bool:
+        # StorageContext.from_defaults replaces falsy (here: empty) vector
+        # stores with a SimpleVectorStore
+        return True
+
+    @property
+    def version_dir(self) -> str | None:
+        """Directory of the persisted version, relative to persist_dir"""
+        return f"v{self._version:06d}" if self._vectors is not None else None
+
+    def _read_version(self, manifest: dict) -> dict[str, Any]:
+        """Reads the arrays of a persisted version, keyed by attribute"""
+        path = os.path.join(self.persist_dir, manifest["path"])
+        centroids_path = os.path.join(path, "centroids.npy")
+        with open(os.path.join(path, "rows.json")) as f:
+            rows = json.load(f)
+        payloads_path = os.path.join(path, "nodes.jsonl")
+        state = {
+            "_version": manifest["version"],
+            "_vectors": np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+            "_list_offsets": np.load(os.path.join(path, "list_offsets.npy")),
+            "_centroids": (
+                np.load(centroids_path) if os.path.exists(centroids_path) else None
+            ),
+            "_node_ids": rows["node_ids"],
+            "_ref_doc_ids": rows["ref_doc_ids"],
+            "_metadata": rows["metadata"],
+            # Empty files can't be memory-mapped
+            "_payloads": (
+                np.memmap(payloads_path, dtype=np.uint8, mode="r")
+                if os.path.getsize(payloads_path)
+                else None
+            ),
+            "_payload_offsets": np.load(os.path.join(path, "node_offsets.npy")),
+            "_rows": {node_id: row for row, node_id in enumerate(rows["node_ids"])},
+            "_live": np.ones(len(rows["node_ids"]), dtype=bool),
+        }
+        logger.info(
+            f"Loaded local vector index from {path} with {len(rows['node_ids'])} "
+            f"vectors in {len(state['_list_offsets']) - 1} lists"
+        )
+        return state
+
+    def _load(self, manifest: dict) -> None:
+        for name, value in self._read_version(manifest).items():
+            setattr(self, name, value)
+        self._filter_masks.clear()
+
+    def _get_payload(self, row: int) -> bytes:
+        return _read_payload(self._payloads, self._payload_offsets, row)
+
+    def sync_on_index_version(
+        self,
+        get_index_version: Callable[[], str | None],
+        sync: Callable[[], None],
+        index_version: str | None,
+    ) -> None:
+        """
+        Makes queries call `sync` to fetch the current manifest and reload
+        the index whenever `get_index_version` returns a version other than
+        the one the index was loaded at, `index_version`.
+        """
+        self._get_index_version = get_index_version
+        self._sync = sync
+        self._index_version = index_version
+
+    def _maybe_reload(self) -> None:
+        if self._get_index_version is None:
+            return
+        index_version = self._get_index_version()
+        if index_version == self._index_version:
+            return
+        with self._reload_lock:
+            if index_version == self._index_version:
+                return
+            self._sync()
+            with open(os.path.join(self.persist_dir, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+            old_dir = self.version_dir
+            if manifest["version"] != self._version:
+                # Read outside the query lock, queries keep the old version
+                state = self._read_version(manifest)
+                with self._lock:
+                    for name, value in state.items():
+                        setattr(self, name, value)
+                    self._filter_masks.clear()
+                if old_dir is not None and old_dir != manifest["path"]:
+                    # Queries still running on it keep reading the unlinked files
+                    shutil.rmtree(
+                        os.path.join(self.persist_dir, old_dir), ignore_errors=True
+                    )
+            self._index_version = index_version
+
+    def add(self, nodes: list[BaseNode], **add_kwargs: Any) -> list[str]:
+        embeddings = np.array([node.get_embedding() for node in nodes], np.float32)
+        # Embeddings are kept in the matrix, not in the serialized nodes
+        nodes = [node.copy(update={"embedding": None}) for node in nodes]
+        return self.add_embeddings(nodes, embeddings)
+
+    def add_embeddings(
+        self, nodes: list[BaseNode], embeddings: np.ndarray
+    ) -> list[str]:
+        """Adds nodes with their embeddings given as the rows of a matrix"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            for node, embedding in zip(nodes, embeddings):
+                row = self._rows.get(node.node_id)
+                if row is not None:
+                    self._live[row] = False
+                self._pending[node.node_id] = (
+                    embedding,
+                    node.ref_doc_id,
+                    dict(node.metadata),
+                    node_to_metadata_dict(node, remove_text=False),
+                )
+            self._filter_masks.clear()
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            node_ids = [
+                node_id
+                for node_id, doc_id in zip(self._node_ids, self._ref_doc_ids)
+                if doc_id == ref_doc_id
+            ] + [
+                node_id
+                for node_id, pending in self._pending.items()
+                if pending[1] == ref_doc_id
+            ]
+        self.delete_nodes(node_ids)
+
+    def delete_nodes(
+        self,
+        node_ids: list[str] | None = None,
+        filters: MetadataFilters | None = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        with self._lock:
+            if filters is not None:
+                node_ids = [
+                    node_id
+                    for node_id, metadata in zip(self._node_ids, self._metadata)
+                    if matches_filters(metadata, filters)
+                ] + [
+                    node_id
+                    for node_id, pending in self._pending.items()
+                    if matches_filters(pending[2], filters)
+                ]
+            for node_id in node_ids or []:
+                self._pending.pop(node_id, None)
+                row = self._rows.get(node_id)
+                if row is not None:
+                    self._live[row] = False
+
+    def _allowed_rows(self, query: VectorStoreQuery) -> np.ndarray | None:
+        """Mask of persisted rows passing the query's filters, or None for all"""
+        mask = None if self._live.all() else self._live
+        if query.filters is not None:
+            key = query.filters.json()
+            filter_mask = self._filter_masks.get(key)
+            if filter_mask is None:
+                filter_mask = np.array(
+                    [matches_filters(m, query.filters) for m in self._metadata],
+                    dtype=bool,
+                )
+                self._filter_masks[key] = filter_mask
+                while len(self._filter_masks) > FILTER_CACHE_SIZE:
+                    self._filter_masks.popitem(last=False)
+            mask = filter_mask if mask is None else mask & filter_mask
+        for ids, values in [
+            (query.node_ids, self._node_ids),
+            (query.doc_ids, self._ref_doc_ids),
+        ]:
+            if ids:
+                ids = set(ids)
+                id_mask = np.array([value in ids for value in values], dtype=bool)
+                mask = id_mask if mask is None else mask & id_mask
+        return mask
+
+    def _pending_matches(self, query: VectorStoreQuery, node_id: str, pending) -> bool:
+        _, ref_doc_id, metadata, _ = pending
+        if query.filters is not None and not matches_filters(metadata, query.filters):
+            return False
+        if query.node_ids and node_id not in query.node_ids:
+            return False
+        return not query.doc_ids or ref_doc_id in query.doc_ids
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        self._maybe_reload()
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        top_k = query.similarity_top_k
+        with self._lock:
+            vectors, node_ids = self._vectors, self._node_ids
+            centroids, list_offsets = self._centroids, self._list_offsets
+            payloads, payload_offsets = self._payloads, self._payload_offsets
+            allowed = self._allowed_rows(query) if vectors is not None else None
+            if allowed is self._live:
+                # Deletes write to the live mask in place
+                allowed = allowed.copy()
+            pending = {
+                node_id: entry
+                for node_id, entry in self._pending.items()
+                if self._pending_matches(query, node_id, entry)
+            }
+
+        # (score, node id, row in the persisted index or None if pending)
+        scored: list[tuple[float, str, int | None]] = []
+        if vectors is not None and len(node_ids):
+            rows = _candidate_rows(
+                centroids, list_offsets, len(node_ids), self.nprobe, query_embedding
+            )
+            if allowed is not None:
+                allowed_rows = np.flatnonzero(allowed)
+                rows = rows[allowed[rows]]
+                # Selective filters are cheaper to search exactly, and
+                # the probed lists may hold too few matches
+                if len(rows) < top_k or len(allowed_rows) <= len(rows) * 4:
+                    rows = allowed_rows
+            scores = _score_rows(vectors, rows, query_embedding)
+            k = min(top_k, len(rows))
+            if k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                scored.extend(
+                    (float(scores[i]), node_ids[rows[i]], rows[i]) for i in top
+                )
+        # Nodes added since the index was built are searched exactly
+        scored.extend(
+            (float(embedding @ query_embedding), node_id, None)
+            for node_id, (embedding, _, _, _) in pending.items()
+        )
+        scored = sorted(scored, key=lambda x: x[0], reverse=True)[:top_k]
+        node_payloads = [
+            pending[node_id][3]
+            if row is None
+            else json.loads(_read_payload(payloads, payload_offsets, row))
+            for _, node_id, row in scored
+        ]
+        return VectorStoreQueryResult(
+            nodes=[metadata_dict_to_node(payload) for payload in node_payloads],
+            similarities=[score for score, _, _ in scored],
+            ids=[node_id for _, node_id, _ in scored],
+        )
+
+    def persist(self, persist_path: str | None = None, fs: Any = None) -> None:
+        """
+        Rebuilds the index from the live and added vectors into a new
+        version directory, then switches the manifest over to it.
+        """
+        with self._lock:
+            live_rows = np.flatnonzero(self._live)
+            num_vectors = len(live_rows) + len(self._pending)
+            if num_vectors == 0 and self._vectors is None:
+                return
+            old_dir = self.version_dir
+            parts = []
+            if self._vectors is not None:
+                parts.append(np.asarray(self._vectors[live_rows], dtype=np.float32))
+            if self._pending:
+                parts.append(np.stack([p[0] for p in self._pending.values()]))
+            vectors = np.concatenate(parts)
+            node_ids = [self._node_ids[r] for r in live_rows] + list(self._pending)
+            ref_doc_ids = [self._ref_doc_ids[r] for r in live_rows] + [
+                p[1] for p in self._pending.values()
+            ]
+            metadata = [self._metadata[r] for r in live_rows] + [
+                p[2] for p in self._pending.values()
+            ]
+            payloads = [self._get_payload(r) for r in live_rows] + [
+                json.dumps(p[3]).encode() for p in self._pending.values()
+            ]
+
+            if num_vectors >= MIN_VECTORS_FOR_IVF:
+                centroids = train_centroids(vectors, int(np.sqrt(num_vectors)))
+                splits = range(SCORE_BLOCK_SIZE, num_vectors, SCORE_BLOCK_SIZE)
+                assignment = np.concatenate(
+                    [
+                        np.argmax(block @ centroids.T, axis=1)
+                        for block in np.split(vectors, splits)
+                    ]
+                )
+            else:
+                centroids = None
+                assignment = np.zeros(num_vectors, dtype=np.int64)
+            num_lists = 1 if centroids is None else len(centroids)
+            order = np.argsort(assignment, kind="stable")
+            list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+            list_sizes = np.bincount(assignment, minlength=num_lists)
+            np.cumsum(list_sizes, out=list_offsets[1:])
+
+            self._version += 1
+            path = os.path.join(self.persist_dir, f"v{self._version:06d}")
+            os.makedirs(path, exist_ok=True)
+            vectors = vectors[order].astype(self.dtype)
+            np.save(os.path.join(path, "vectors.npy"), vectors)
+            np.save(os.path.join(path, "list_offsets.npy"), list_offsets)
+            if centroids is not None:
+                np.save(os.path.join(path, "centroids.npy"), centroids)
+            with open(os.path.join(path, "rows.json"), "w") as f:
+                json.dump(
+                    {
+                        "node_ids": [node_ids[i] for i in order],
+                        "ref_doc_ids": [ref_doc_ids[i] for i in order],
+                        "metadata": [metadata[i] for i in order],
+                    },
+                    f,
+                )
+            payload_offsets = np.zeros(num_vectors + 1, dtype=np.int64)
+            with open(os.path.join(path, "nodes.jsonl"), "wb") as f:
+                for i, row in enumerate(order):
+                    f.write(payloads[row])
+                    payload_offsets[i + 1] = payload_offsets[i] + len(payloads[row])
+            np.save(os.path.join(path, "node_offsets.npy"), payload_offsets)
+
+            manifest = {"version": self._version, "path": os.path.basename(path)}
+            tmp_path = os.path.join(self.persist_dir, f"{MANIFEST_FILE}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, os.path.join(self.persist_dir, MANIFEST_FILE))
+            self._pending.clear()
+            self._load(manifest)
+        if old_dir is not None:
+            shutil.rmtree(os.path.join(self.persist_dir, old_dir), ignore_errors=True)
+        logger.info(f"Persisted local vector index with {num_vectors} vectors")
+
+
+class MirroredVectorStore(BasePydanticVectorStore):
+    """
+    Writes nodes to a primary and a mirror vector store, and queries the
+    primary, so that one embedding pass fills e.g. a Vertex AI Vector Search
+    index and a LocalVectorStore.
+    """
+
+    stores_text: bool = True
+    primary: BasePydanticVectorStore
+    mirror: BasePydanticVectorStore
+
+    def __init__(
+        self, primary: BasePydanticVectorStore, mirror: BasePydanticVectorStore
+    ):
+        super().__init__(
+            primary=primary, mirror=mirror, stores_text=primary.stores_text
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MirroredVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return self.primary.client
+
+    def add(self, nodes: list[BaseNode], **add_kwargs: Any) -> list[str]:
+        node_ids = self.primary.add(nodes, **add_kwargs)
+        self.mirror.add(nodes, **add_kwargs)
+        return node_ids
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self.primary.delete(ref_doc_id, **delete_kwargs)
+        self.mirror.delete(ref_doc_id, **delete_kwargs)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        return self.primary.query(query, **kwargs)
+
+
+def sync_local_vector_store(bucket_name: str, prefix: str, local_dir: str) -> None:
+    """
+    Downloads the version of the local vector index stored under `prefix`
+    that the manifest in GCS points to into `local_dir`, unless it is the
+    local version, and then switches the local manifest over to it
+    """
+    persist_dir = os.path.join(local_dir, prefix)
+    manifest_path = os.path.join(persist_dir, MANIFEST_FILE)
+    manifest_blob = (
+        storage.Client().bucket(bucket_name).blob(f"{prefix}/{MANIFEST_FILE}")
+    )
+    if not manifest_blob.exists():
+        return
+    manifest = json.loads(manifest_blob.download_as_text())
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f)["path"] == manifest["path"]:
+                return
+    # Older versions may still be in the bucket, skip them
+    download_bucket_with_transfer_manager(
+        bucket_name,
+        prefix=f"{prefix}/{manifest['path']}/",
+        destination_directory=local_dir,
+    )
+    os.makedirs(persist_dir, exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_local_vector_store(
+    bucket_name: str,
+    prefix: str,
+    local_dir: str,
+    nprobe: int = 16,
+    get_index_version: Callable[[], str | None] | None = None,
+) -> LocalVectorStore:
+    """
+    Loads the local vector index stored under `prefix`, downloading its
+    current version from GCS into `local_dir` if it isn't there yet.
+    Returns an empty index persisted at the same location if none exists.
+    With `get_index_version`, the index is synced with GCS again whenever
+    the index version stamp changes.
+    """
+    # Read first, so a version published while syncing is picked up later
+    index_version = get_index_version() if get_index_version else None
+    sync = functools.partial(sync_local_vector_store, bucket_name, prefix, local_dir)
+    sync()
+    vector_store = LocalVectorStore(os.path.join(local_dir, prefix), nprobe=nprobe)
+    if get_index_version is not None:
+        vector_store.sync_on_index_version(get_index_version, sync, index_version)
+    return vector_store
+
+
+def upload_local_vector_store(
+    vector_store: LocalVectorStore,
+    bucket_name: str,
+    prefix: str,
+    grace_period: datetime.timedelta = VERSION_GRACE_PERIOD,
+) -> None:
+    """
+    Uploads the persisted version of a local vector index under `prefix`.
+    The manifest is uploaded last, so readers never see a partial version.
+    Older versions are deleted once the version that superseded them has
+    been in the bucket for `grace_period`.
+    """
+    version_dir = vector_store.version_dir
+    if version_dir is None:
+        return
+    upload_directory_to_gcs(
+        os.path.join(vector_store.persist_dir, version_dir),
+        bucket_name,
+        f"{prefix}/{version_dir}",
+    )
+    bucket = storage.Client().bucket(bucket_name)
+    bucket.blob(f"{prefix}/{MANIFEST_FILE}").upload_from_filename(
+        os.path.join(vector_store.persist_dir, MANIFEST_FILE)
+    )
+    versions = defaultdict(list)
+    for blob in bucket.list_blobs(prefix=f"{prefix}/"):
+        relative_path = blob.name.removeprefix(f"{prefix}/")
+        if relative_path != MANIFEST_FILE:
+            versions[relative_path.split("/", 1)[0]].append(blob)
+    uploaded = {
+        version: max(blob.updated for blob in blobs)
+        for version, blobs in versions.items()
+    }
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - grace_period
+    ordered = sorted(versions)
+    for older, newer in zip(ordered, ordered[1:]):
+        if older < version_dir and uploaded[newer] < cutoff:
+            for blob in versions[older]:
+                blob.delete()
@@ -1,7 +1,12 @@
 """Node Re-ranker class for async execution"""
+import asyncio
 from collections.abc import Callable
+import datetime
 import logging
+import threading
+import weakref
 
+import aiohttp
 import google.auth
 import google.auth.transport.requests
 from llama_index.core import QueryBundle, Settings
@@ -20,6 +25,7 @@ from llama_index.core.service_context import ServiceContext
 from llama_index.core.settings import llm_from_settings_or_context
 from llama_index.llms.vertex import Vertex
 import requests
+import requests.adapters
 
 logging.basicConfig(level=logging.INFO)  # Set the desired logging level
 logger = logging.getLogger(__name__)
@@ -30,14 +36,96 @@ llm = Vertex(model="gemini-1.5-flash", temperature=0.0)
 Settings.llm = llm
 
 
+RERANKER_PROJECT_ID = "pr-sbx-vertex-genai"
+RERANKER_MODEL_NAME = "semantic-ranker-512@latest"
+RERANKER_URL = (
+    "https://discoveryengine.googleapis.com/v1alpha/projects/"
+    f"{RERANKER_PROJECT_ID}/locations/global/rankingConfigs/"
+    "default_ranking_config:rank"
+)
+# Refresh the access token this long before it actually expires
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+_credentials = None
+_credentials_lock = threading.Lock()
+_session_lock = threading.Lock()
+_session: requests.Session | None = None
+# aiohttp sessions are bound to the event loop they were created on
+_async_sessions: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, aiohttp.ClientSession
+] = weakref.WeakKeyDictionary()
+
+
 def authenticate_google():
-    """Authenticate using Google credentials and return the access token."""
-    credentials, project_id = google.auth.default(
-        quota_project_id="pr-sbx-vertex-genai"
-    )
-    auth_req = google.auth.transport.requests.Request()
-    credentials.refresh(auth_req)
-    return credentials.token
+    """Authenticate using Google credentials and return the access token.
+    Credentials are cached and only refreshed when close to expiry."""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials, _ = google.auth.default(quota_project_id=RERANKER_PROJECT_ID)
+        expiry = _credentials.expiry
+        if expiry is not None and expiry.tzinfo is None:
+            # google-auth reports expiry as a naive UTC datetime
+            expiry = expiry.replace(tzinfo=datetime.timezone.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if not _credentials.token or (
+            expiry is not None and expiry - now < TOKEN_REFRESH_MARGIN
+        ):
+            _credentials.refresh(google.auth.transport.requests.Request())
+        return _credentials.token
+
+
+def get_session() -> requests.Session:
+    """Returns a keep-alive session shared by all reranker calls"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+        return _session
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """Returns a keep-alive aiohttp session shared by async reranker calls
+    on the running event loop"""
+    loop = asyncio.get_running_loop()
+    with _session_lock:
+        session = _async_sessions.get(loop)
+        if session is None or session.closed:
+            # A session references its loop, so entries of finished loops
+            # (e.g. from asyncio.run) are only freed once they are removed
+            for closed_loop in [key for key in _async_sessions if key.is_closed()]:
+                del _async_sessions[closed_loop]
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16))
+            _async_sessions[loop] = session
+        return session
+
+
+async def aclose_sessions() -> None:
+    """Closes the shared sync session and the running loop's aiohttp
+    session, for application shutdown"""
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+        async_session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        session.close()
+    if async_session is not None:
+        await async_session.close()
+
+
+def _reranker_request(query, records, google_token) -> tuple[dict, dict]:
+    headers = {
+        "Authorization": "Bearer " + google_token,
+        "Content-Type": "application/json",
+        "X-Goog-User-Project": RERANKER_PROJECT_ID,
+    }
+    data = {
+        "model": RERANKER_MODEL_NAME,
+        "query": query,
+        "records": records,
+    }
+    return headers, data
 
 
 def call_reranker(query, records, google_token):
@@ -51,55 +139,78 @@ def call_reranker(query, records, google_token):
     Returns:
       The API response as a dictionary.
     """
-    # Replace 'your-project-id' with your actual Google Cloud project ID
-    project_id = "pr-sbx-vertex-genai"
-    model_name = "semantic-ranker-512@latest"
-    url = f"https://discoveryengine.googleapis.com/v1alpha/projects/{project_id}/locations/global/rankingConfigs/default_ranking_config:rank"
-
-    headers = {
-        "Authorization": "Bearer " + google_token,
-        "Content-Type": "application/json",
-        "X-Goog-User-Project": project_id,
-    }
-
-    data = {
-        "model": model_name,
-        "query": query,
-        "records": records,
-    }
-
-    response = requests.post(url, headers=headers, json=data)
-    print(response)
+    headers, data = _reranker_request(query, records, google_token)
+    response = get_session().post(RERANKER_URL, headers=headers, json=data)
+    logger.info(response)
     response.raise_for_status()  # Raise an error if the request failed
     return response.json()
 
 
+async def acall_reranker(query, records, google_token):
+    """Async version of call_reranker using the shared aiohttp session"""
+    headers, data = _reranker_request(query, records, google_token)
+    async with get_async_session().post(
+        RERANKER_URL, headers=headers, json=data
+    ) as response:
+        logger.info(response.status)
+        response.raise_for_status()  # Raise an error if the request failed
+        return await response.json()
+
+
 class GoogleReRankerSecretSauce(BaseNodePostprocessor):
-    def _postprocess_nodes(
-        self, nodes: list[NodeWithScore], query_bundle: QueryBundle | None
-    ) -> list[NodeWithScore]:
-        google_token = authenticate_google()
+    @staticmethod
+    def _to_records(nodes: list[NodeWithScore]) -> list[dict]:
+        return [
+            {
+                "id": node_wscore.node.id_,
+                "title": node_wscore.node.metadata["title"],
+                "content": node_wscore.node.text,
+            }
+            for node_wscore in nodes
+        ]
 
-        records = []
-        for node_wscore in nodes:
-            records.append(
-                {
-                    "id": node_wscore.node.id_,
-                    "title": node_wscore.node.metadata["title"],
-                    "content": node_wscore.node.text,
-                }
-            )
-        response_json = call_reranker(query_bundle.query_str, records, google_token)
-
-        records = response_json["records"]
+    @staticmethod
+    def _from_response(response_json: dict) -> list[NodeWithScore]:
         new_nodes_wscores = []
-        for r in records:
+        for r in response_json["records"]:
             node = TextNode(id_=r["id"], text=r["content"])
             node_wscore = NodeWithScore(node=node, score=r["score"])
             new_nodes_wscores.append(node_wscore)
 
         return sorted(new_nodes_wscores, key=lambda x: x.score or 0.0, reverse=True)
 
+    def _postprocess_nodes(
+        self, nodes: list[NodeWithScore], query_bundle: QueryBundle | None
+    ) -> list[NodeWithScore]:
+        google_token = authenticate_google()
+        response_json = call_reranker(
+            query_bundle.query_str, self._to_records(nodes), google_token
+        )
+        return self._from_response(response_json)
+
+    async def apostprocess_nodes(
+        self, nodes: list[NodeWithScore], query_bundle: QueryBundle
+    ) -> list[NodeWithScore]:
+        """Async version of postprocess_nodes"""
+        results = await self.apostprocess_batch([(nodes, query_bundle)])
+        return results[0]
+
+    async def apostprocess_batch(
+        self, requests_batch: list[tuple[list[NodeWithScore], QueryBundle]]
+    ) -> list[list[NodeWithScore]]:
+        """Reranks several (nodes, query) pairs concurrently, sharing one
+        access token and the pooled connection across all calls"""
+        google_token = await asyncio.to_thread(authenticate_google)
+        responses = await asyncio.gather(
+            *[
+                acall_reranker(
+                    query_bundle.query_str, self._to_records(nodes), google_token
+                )
+                for nodes, query_bundle in requests_batch
+            ]
+        )
+        return [self._from_response(r) for r in responses]
+
 
 class CustomLLMRerank(BaseNodePostprocessor):
     """LLM-based reranker."""
@@ -110,6 +221,17 @@ class CustomLLMRerank(BaseNodePostprocessor):
     )
     choice_batch_size: int = Field(description="Batch size for choice select.")
     llm: LLM = Field(description="The LLM to rerank with.")
+    max_concurrency: int = Field(
+        default=4, description="Maximum number of batches reranked at once."
+    )
+    batch_timeout: float | None = Field(
+        default=60.0,
+        description="Seconds to wait for a batch before keeping its original order.",
+    )
+    early_exit_relevance: float | None = Field(
+        default=None,
+        description="Stop once top_n nodes reach this relevance. Disabled if None.",
+    )
 
     _format_node_batch_fn: Callable = PrivateAttr()
     _parse_choice_select_answer_fn: Callable = PrivateAttr()
@@ -123,6 +245,9 @@ class CustomLLMRerank(BaseNodePostprocessor):
         parse_choice_select_answer_fn: Callable | None = None,
         service_context: ServiceContext | None = None,
         top_n: int = 10,
+        max_concurrency: int = 4,
+        batch_timeout: float | None = 60.0,
+        early_exit_relevance: float | None = None,
     ) -> None:
         choice_select_prompt = choice_select_prompt or DEFAULT_CHOICE_SELECT_PROMPT
 
@@ -141,6 +266,9 @@ class CustomLLMRerank(BaseNodePostprocessor):
             choice_batch_size=choice_batch_size,
             service_context=service_context,
             top_n=top_n,
+            max_concurrency=max_concurrency,
+            batch_timeout=batch_timeout,
+            early_exit_relevance=early_exit_relevance,
         )
 
     def _get_prompts(self) -> PromptDictType:
@@ -171,6 +299,42 @@ class CustomLLMRerank(BaseNodePostprocessor):
             pass
         return await self._postprocess_nodes(nodes, query_bundle)
 
+    async def _rerank_batch(
+        self,
+        nodes_batch: list[TextNode],
+        query_str: str,
+        semaphore: asyncio.Semaphore,
+    ) -> list[NodeWithScore]:
+        """Reranks a single batch, retrying once if the answer can't be parsed"""
+        fmt_batch_str = self._format_node_batch_fn(nodes_batch)
+        async with semaphore:
+            for attempt in range(2):
+                raw_response = await asyncio.wait_for(
+                    self.llm.apredict(
+                        self.choice_select_prompt,
+                        context_str=fmt_batch_str,
+                        query_str=query_str,
+                    ),
+                    timeout=self.batch_timeout,
+                )
+                logging.info(raw_response)
+                try:
+                    raw_choices, relevances = self._parse_choice_select_answer_fn(
+                        raw_response, len(nodes_batch)
+                    )
+                    break
+                # Try again
+                except IndexError:
+                    if attempt == 1:
+                        raise
+        choice_idxs = [int(choice) - 1 for choice in raw_choices]
+        choice_nodes = [nodes_batch[idx] for idx in choice_idxs]
+        relevances = relevances or [1.0 for _ in choice_nodes]
+        return [
+            NodeWithScore(node=node, score=relevance)
+            for node, relevance in zip(choice_nodes, relevances)
+        ]
+
     async def _postprocess_nodes(
         self,
         nodes: list[NodeWithScore],
@@ -181,46 +345,53 @@ class CustomLLMRerank(BaseNodePostprocessor):
         if len(nodes) == 0:
             return []
 
-        initial_results: list[NodeWithScore] = []
-        for idx in range(0, len(nodes), self.choice_batch_size):
-            nodes_batch = [
-                node.node for node in nodes[idx : idx + self.choice_batch_size]
-            ]
-
-            query_str = query_bundle.query_str
-            fmt_batch_str = self._format_node_batch_fn(nodes_batch)
-            # call each batch independently
-            raw_response = await self.llm.apredict(
-                self.choice_select_prompt,
-                context_str=fmt_batch_str,
-                query_str=query_str,
-            )
-
-            logging.info(raw_response)
-            try:
-                raw_choices, relevances = self._parse_choice_select_answer_fn(
-                    raw_response, len(nodes_batch)
-                )
-            # Try again
-            except IndexError:
-                raw_response = await self.llm.apredict(
-                    self.choice_select_prompt,
-                    context_str=fmt_batch_str,
-                    query_str=query_str,
+        # Dispatch every batch at once, bounded by max_concurrency
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        batches = [
+            nodes[idx : idx + self.choice_batch_size]
+            for idx in range(0, len(nodes), self.choice_batch_size)
+        ]
+        tasks = {
+            asyncio.create_task(
+                self._rerank_batch(
+                    [node.node for node in batch], query_bundle.query_str, semaphore
                 )
-                raw_choices, relevances = self._parse_choice_select_answer_fn(
-                    raw_response, len(nodes_batch)
+            ): batch_idx
+            for batch_idx, batch in enumerate(batches)
+        }
+
+        initial_results: list[NodeWithScore] = []
+        failed_batches: list[int] = []
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
                 )
-            choice_idxs = [int(choice) - 1 for choice in raw_choices]
-            choice_nodes = [nodes_batch[idx] for idx in choice_idxs]
-            relevances = relevances or [1.0 for _ in choice_nodes]
-            initial_results.extend(
-                [
-                    NodeWithScore(node=node, score=relevance)
-                    for node, relevance in zip(choice_nodes, relevances)
-                ]
-            )
-
-        return sorted(initial_results, key=lambda x: x.score or 0.0, reverse=True)[
-            : self.top_n
+                for task in done:
+                    try:
+                        initial_results.extend(task.result())
+                    except (asyncio.TimeoutError, IndexError) as e:
+                        logger.warning(f"Rerank batch failed, keeping its order: {e!r}")
+                        failed_batches.append(tasks[task])
+                if self.early_exit_relevance is not None and (
+                    sum(
+                        (n.score or 0.0) >= self.early_exit_relevance
+                        for n in initial_results
+                    )
+                    >= self.top_n
+                ):
+                    logger.info("Found top_n relevant nodes, skipping other batches")
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if len(failed_batches) == len(batches):
+            logger.warning("Every rerank batch failed, returning nodes unranked")
+        # Nodes of failed batches follow the reranked ones in their original order
+        fallback_results = [
+            node for batch_idx in sorted(failed_batches) for node in batches[batch_idx]
         ]
+        reranked = sorted(initial_results, key=lambda x: x.score or 0.0, reverse=True)
+        return (reranked + fallback_results)[: self.top_n]
@@ -1,5 +1,5 @@
 """Prompt management class"""
-from dataclasses import asdict, dataclass, field
+from dataclasses import asdict, dataclass, field, fields
 
 SYSTEM_PROMPT = "You are an expert assistant specializing in \
     financial products and services. Your primary goal is to help users\
@@ -185,10 +185,20 @@ class Prompts:
     eval_prompt_wcontext_system: str = field(default=EVAL_PROMPT_WCONTEXT_SYSTEM)
     eval_prompt_wcontext_user: str = field(default=EVAL_PROMPT_WCONTEXT_USER)
 
+    def __post_init__(self) -> None:
+        # Not a dataclass field so it is left out of to_dict()
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        """Incremented on every prompt update, used to key cached engines"""
+        return self._version
+
     def update(self, prompt_name: str, new_content: str) -> None:
         """Update prompts"""
-        if hasattr(self, prompt_name):
+        if prompt_name in {f.name for f in fields(self)}:
             setattr(self, prompt_name, new_content)
+            self._version += 1
         else:
             raise ValueError(f"Invalid prompt name: {prompt_name}")
 
@@ -1,10 +1,12 @@
 """Custom retriever which implements
 retrieval based on hypothetical questions"""
+import asyncio
 import logging
 
 from llama_index.core import QueryBundle
 from llama_index.core.retrievers import BaseRetriever, VectorIndexRetriever
-from llama_index.core.schema import NodeRelationship, NodeWithScore
+from llama_index.core.schema import BaseNode, NodeRelationship, NodeWithScore
+from llama_index.core.storage.docstore.types import BaseDocumentStore
 from llama_index.storage.docstore.firestore import FirestoreDocumentStore
 
 # Set the desired logging level
@@ -12,6 +14,24 @@ logging.basicConfig(encoding="utf-8", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+async def aget_documents(
+    docstore: BaseDocumentStore, doc_ids: list[str]
+) -> list[BaseNode]:
+    """Fetches documents in one batched docstore read, requesting each unique
+    id only once, and returns them in the order of `doc_ids`. Docstores
+    without a batched aget_nodes (the default one awaits each id in turn)
+    are read concurrently instead."""
+    unique_ids = list(dict.fromkeys(doc_ids))
+    if getattr(type(docstore), "aget_nodes", None) is BaseDocumentStore.aget_nodes:
+        docs = await asyncio.gather(
+            *[docstore.aget_document(doc_id) for doc_id in unique_ids]
+        )
+    else:
+        docs = await docstore.aget_nodes(unique_ids)
+    docs_by_id = dict(zip(unique_ids, docs))
+    return [docs_by_id[i] for i in doc_ids]
+
+
 class QARetriever(BaseRetriever):
     """Retrieves nodes based on questions answered by nodes. First identifies
     document ids based on vector search and then does lookup in document store."""
@@ -30,38 +50,39 @@ class QARetriever(BaseRetriever):
         self._docstore = docstore
         super().__init__()
 
-    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
-        qa_nodes = self._qa_vector_retriever.retrieve(query_bundle)
-        og_docs = []
+    @staticmethod
+    def _source_doc_scores(qa_nodes: list[NodeWithScore]) -> dict[str, float]:
+        """Maps each source document of the matched questions to
+        the best score among its questions"""
+        source_doc_scores: dict[str, float] = {}
         for nodewscore in qa_nodes:
-            logger.info(nodewscore.node.text)
+            logger.info(f"Matched Question: {nodewscore.node.text}")
             source_doc_id = nodewscore.node.relationships[
                 NodeRelationship.SOURCE
             ].node_id
-            og_docs.append(
-                NodeWithScore(
-                    node=self._docstore.get_document(source_doc_id),
-                    score=nodewscore.score,
-                )
+            source_doc_scores[source_doc_id] = max(
+                nodewscore.score or 0.0,
+                source_doc_scores.get(source_doc_id, 0.0),
             )
+        return source_doc_scores
 
-        return og_docs
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        qa_nodes = self._qa_vector_retriever.retrieve(query_bundle)
+        source_doc_scores = self._source_doc_scores(qa_nodes)
+        docs = self._docstore.get_nodes(list(source_doc_scores))
+        return [
+            NodeWithScore(node=doc, score=score)
+            for doc, score in zip(docs, source_doc_scores.values())
+        ]
 
     async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
         qa_nodes = await self._qa_vector_retriever.aretrieve(query_bundle)
-        og_docs = []
-        for nodewscore in qa_nodes:
-            logger.info(f"Matched Question: {nodewscore.node.text}")
-            source_doc_id = nodewscore.node.relationships[
-                NodeRelationship.SOURCE
-            ].node_id
-            og_docs.append(
-                NodeWithScore(
-                    node=self._docstore.get_document(source_doc_id),
-                    score=nodewscore.score,
-                )
-            )
-        return og_docs
+        source_doc_scores = self._source_doc_scores(qa_nodes)
+        docs = await aget_documents(self._docstore, list(source_doc_scores))
+        return [
+            NodeWithScore(node=doc, score=score)
+            for doc, score in zip(docs, source_doc_scores.values())
+        ]
 
 
 class QAFollowupRetriever(BaseRetriever):
@@ -98,8 +119,10 @@ class QAFollowupRetriever(BaseRetriever):
         return retrieve_nodes
 
     async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
-        am_nodes = await self._base_retriever.aretrieve(query_bundle)
-        qa_nodes = await self._qa_retriever.aretrieve(query_bundle)
+        am_nodes, qa_nodes = await asyncio.gather(
+            self._base_retriever.aretrieve(query_bundle),
+            self._qa_retriever.aretrieve(query_bundle),
+        )
 
         am_ids = {n.node.node_id for n in am_nodes}
         qa_ids = {n.node.node_id for n in qa_nodes}
@@ -0,0 +1,54 @@
+"""Shared backoff for rate limit and quota errors of LLM calls"""
+import asyncio
+import random
+import time
+
+from google.api_core import exceptions as api_exceptions
+
+QUOTA_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.TooManyRequests,
+    api_exceptions.ServiceUnavailable,
+)
+
+
+def is_quota_error(exc: BaseException) -> bool:
+    """Whether an exception is a rate limit or quota error worth retrying."""
+    if isinstance(exc, QUOTA_ERRORS):
+        return True
+    # Anthropic and other HTTP clients expose the status code directly
+    return getattr(exc, "status_code", None) in (429, 503)
+
+
+class QuotaBackoff:
+    """
+    Exponential backoff with jitter, shared by all calls of a job.
+
+    A quota error pauses every call rather than only the one that hit it,
+    so a quota storm drains instead of each call retrying straight into it.
+    """
+
+    def __init__(self, base_delay: float = 2.0, max_delay: float = 60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._consecutive_errors = 0
+        self._resume_at = 0.0
+
+    async def wait(self) -> None:
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record_quota_error(self) -> float:
+        """Pushes back the resume time and returns the chosen delay."""
+        self._consecutive_errors += 1
+        cap = min(
+            self.max_delay,
+            self.base_delay * 2 ** min(self._consecutive_errors - 1, 16),
+        )
+        delay = random.uniform(cap / 2, cap)
+        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        return delay
+
+    def record_success(self) -> None:
+        self._consecutive_errors = 0
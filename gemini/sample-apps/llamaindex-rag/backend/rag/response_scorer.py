@@ -0,0 +1,175 @@
+"""Background RAGAS scoring of RAG responses"""
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
+import logging
+import threading
+import uuid
+
+from datasets import Dataset
+from langchain_google_vertexai import ChatVertexAI, VertexAIEmbeddings
+import pandas as pd
+from ragas import evaluate
+from ragas.embeddings import LangchainEmbeddingsWrapper
+from ragas.llms import LangchainLLMWrapper
+from ragas.metrics import answer_relevancy, context_relevancy, faithfulness
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RESPONSE_METRICS = [answer_relevancy, faithfulness, context_relevancy]
+
+
+def bind_judge_metrics(
+    metrics: list, eval_model_name: str, embedding_model_name: str
+) -> list:
+    """Returns copies of the metrics bound to new judge clients."""
+    llm = LangchainLLMWrapper(ChatVertexAI(model_name=eval_model_name))
+    embeddings = LangchainEmbeddingsWrapper(
+        VertexAIEmbeddings(model_name=embedding_model_name)
+    )
+    judge_metrics = []
+    for metric in metrics:
+        metric = copy.copy(metric)
+        metric.llm = llm
+        if hasattr(metric, "embeddings"):
+            metric.embeddings = embeddings
+        judge_metrics.append(metric)
+    return judge_metrics
+
+
+class ResponseScorer:
+    """
+    Scores RAG responses with RAGAS on a bounded background thread pool.
+
+    Judge clients are created once per (eval model, embedding model) pair and reused.
+    Each judge gets its own copies of the metrics with the clients bound, since
+    ragas.evaluate mutates the shared metric singletons when given an llm.
+    The latest `max_results` results are kept in memory, keyed by eval ID, and
+    evaluations evicted before they start are cancelled. Responses submitted
+    while `max_pending` evaluations are queued or running are skipped.
+    """
+
+    def __init__(
+        self, max_workers: int = 4, max_results: int = 1000, max_pending: int = 100
+    ):
+        self.max_results = max_results
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ragas-scorer"
+        )
+        self._pending = threading.Semaphore(max_pending)
+        self._judges: dict[tuple[str, str], list] = {}
+        self._judge_locks: dict[tuple[str, str], threading.Lock] = {}
+        # Skipped evaluations have no future
+        self._futures: OrderedDict[str, Future | None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_judge_metrics(
+        self, eval_model_name: str, embedding_model_name: str
+    ) -> list:
+        """Returns the metrics bound to the judge clients, creating them on first use."""
+        key = (eval_model_name, embedding_model_name)
+        with self._lock:
+            judge_lock = self._judge_locks.setdefault(key, threading.Lock())
+        # Creating the clients is slow, so only block callers of the same judge
+        with judge_lock:
+            metrics = self._judges.get(key)
+            if metrics is None:
+                metrics = bind_judge_metrics(
+                    RESPONSE_METRICS, eval_model_name, embedding_model_name
+                )
+                self._judges[key] = metrics
+            return metrics
+
+    def submit(
+        self,
+        question: str,
+        answer: str,
+        contexts: list[str],
+        eval_model_name: str,
+        embedding_model_name: str,
+    ) -> str:
+        """Schedules scoring of a response and returns its eval ID."""
+        eval_id = str(uuid.uuid4())
+        future = None
+        if self._pending.acquire(blocking=False):
+            future = self._executor.submit(
+                self._score,
+                question,
+                answer,
+                contexts,
+                eval_model_name,
+                embedding_model_name,
+            )
+            future.add_done_callback(lambda _: self._pending.release())
+        else:
+            logger.warning(f"Too many pending evaluations, skipping {eval_id}")
+        with self._lock:
+            self._futures[eval_id] = future
+            while len(self._futures) > self.max_results:
+                _, evicted = self._futures.popitem(last=False)
+                if evicted is not None:
+                    # No one can fetch the result anymore
+                    evicted.cancel()
+        return eval_id
+
+    def _score(
+        self,
+        question: str,
+        answer: str,
+        contexts: list[str],
+        eval_model_name: str,
+        embedding_model_name: str,
+    ) -> dict:
+        metrics = self.get_judge_metrics(eval_model_name, embedding_model_name)
+        eval_df_ds = Dataset.from_pandas(
+            pd.DataFrame(
+                {"question": [question], "answer": [answer], "contexts": [contexts]}
+            )
+        )
+        result = evaluate(eval_df_ds, metrics=metrics)
+        result_dict = (
+            result.to_pandas()[[metric.name for metric in metrics]]
+            .fillna(0)
+            .iloc[0]
+            .to_dict()
+        )
+        logger.info(result_dict)
+        return result_dict
+
+    def get_result(self, eval_id: str) -> dict | None:
+        """Returns the status and scores of an evaluation, or None if unknown."""
+        with self._lock:
+            if eval_id not in self._futures:
+                return None
+            future = self._futures[eval_id]
+        if future is None:
+            return {"eval_id": eval_id, "status": "skipped"}
+        if not future.done():
+            return {"eval_id": eval_id, "status": "pending"}
+        if future.exception() is not None:
+            logger.error(f"Evaluation {eval_id} failed: {future.exception()}")
+            return {
+                "eval_id": eval_id,
+                "status": "failed",
+                "error": str(future.exception()),
+            }
+        return {"eval_id": eval_id, "status": "completed"} | future.result()
+
+    async def wait_for_result(self, eval_id: str, timeout: float) -> dict | None:
+        """Waits up to `timeout` seconds for an evaluation to finish."""
+        with self._lock:
+            future = self._futures.get(eval_id)
+        if future is not None and timeout > 0:
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(future)), timeout
+                )
+            except Exception:
+                # Timeouts and scoring failures are reported by get_result
+                pass
+        return self.get_result(eval_id)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,376 @@
+"""Per-stage tracing and Prometheus metrics for RAG queries"""
+from collections import defaultdict
+import contextlib
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import logging
+import math
+import time
+from typing import Any
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatEndEvent,
+    LLMChatStartEvent,
+    LLMCompletionEndEvent,
+    LLMCompletionStartEvent,
+)
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+from opentelemetry import trace
+from prometheus_client import Counter, Histogram
+
+logging.basicConfig(level=logging.INFO)  # Set the desired logging level
+logger = logging.getLogger(__name__)
+
+CONFIG_LABELS = ["llm", "retrieval_strategy", "features"]
+UNKNOWN_CONFIG = {label: "unknown" for label in CONFIG_LABELS}
+# Values of the llm label; other LLM names come from request input, so they
+# are grouped to keep the number of label values bounded
+LLM_LABELS = frozenset(
+    ["gemini-1.0-pro", "gemini-1.5-flash", "gemini-1.5-pro", "claude-sonnet-3.5"]
+)
+# Stages can take anywhere from milliseconds (BM25) to tens of seconds (refine)
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)  # fmt: skip
+
+STAGE_LATENCY = Histogram(
+    "rag_stage_latency_seconds",
+    "Latency of each RAG pipeline stage",
+    ["stage", *CONFIG_LABELS],
+    buckets=LATENCY_BUCKETS,
+)
+QUERY_LATENCY = Histogram(
+    "rag_query_latency_seconds",
+    "End-to-end latency of RAG queries",
+    CONFIG_LABELS,
+    buckets=LATENCY_BUCKETS,
+)
+LLM_CALLS = Counter(
+    "rag_llm_calls_total", "LLM calls made by RAG queries", CONFIG_LABELS
+)
+LLM_TOKENS = Counter(
+    "rag_llm_tokens_total",
+    "LLM tokens used by RAG queries, as reported by the model or estimated "
+    "at 4 characters per token",
+    ["direction", *CONFIG_LABELS],
+)
+DOCSTORE_FETCHES = Counter(
+    "rag_docstore_fetches_total",
+    "Documents read or looked up in the docstore by RAG queries",
+    CONFIG_LABELS,
+)
+DOCSTORE_CACHE_LOOKUPS = Counter(
+    "rag_docstore_cache_lookups_total",
+    "Node lookups served by the docstore cache (hit) or the docstore (miss)",
+    ["result"],
+)
+
+_tracer = trace.get_tracer(__name__)
+_enabled = False
+_NULL_CONTEXT = contextlib.nullcontext()
+# Number of enclosing LLM calls, so nested calls (e.g. chat -> complete) count once
+_llm_call_depth: ContextVar[int] = ContextVar("llm_call_depth", default=0)
+
+
+@dataclass
+class QueryTrace:
+    """Stage timings and counters of a single query"""
+
+    labels: dict[str, str]
+    stage_seconds: dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    docstore_fetches: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "stage_seconds": dict(self.stage_seconds),
+            "llm_calls": self.llm_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "docstore_fetches": self.docstore_fetches,
+        }
+
+
+_current_trace: ContextVar[QueryTrace | None] = ContextVar(
+    "current_trace", default=None
+)
+
+
+def tracing_enabled() -> bool:
+    return _enabled
+
+
+def configure_tracing(enabled: bool) -> None:
+    """
+    Turns tracing on or off. Must be called before query engines and
+    indexes are built, since tracing wraps their retrievers and docstores.
+    When disabled, every hook is a flag check returning a shared null context.
+    """
+    global _enabled
+    if enabled and not _enabled:
+        get_dispatcher().add_event_handler(LLMUsageEventHandler())
+    _enabled = enabled
+
+
+def llm_label(llm_name: str) -> str:
+    """Maps an LLM name to one of a fixed set of llm label values"""
+    if llm_name in LLM_LABELS:
+        return llm_name
+    if "claude" in llm_name:
+        # Every Claude name is served by the same model
+        return "claude-sonnet-3.5"
+    return "other-gemini" if "gemini" in llm_name else "other"
+
+
+def config_labels(
+    llm_name: str,
+    retrieval_strategy: str,
+    use_hyde: bool = False,
+    qa_followup: bool = False,
+    hybrid_retrieval: bool = False,
+    use_node_rerank: bool = False,
+    use_react: bool = False,
+) -> dict[str, str]:
+    """Metric labels describing a query engine configuration"""
+    features = [
+        name
+        for name, enabled in [
+            ("hyde", use_hyde),
+            ("qa_followup", qa_followup),
+            ("hybrid", hybrid_retrieval),
+            ("rerank", use_node_rerank),
+            ("react", use_react),
+        ]
+        if enabled
+    ]
+    return {
+        "llm": llm_label(llm_name),
+        "retrieval_strategy": retrieval_strategy,
+        "features": "+".join(features) or "none",
+    }
+
+
+def _current_labels() -> dict[str, str]:
+    query_trace = _current_trace.get()
+    return query_trace.labels if query_trace is not None else UNKNOWN_CONFIG
+
+
+@contextlib.contextmanager
+def _traced_query(labels: dict[str, str]):
+    query_trace = QueryTrace(labels=labels)
+    token = _current_trace.set(query_trace)
+    start = time.perf_counter()
+    try:
+        with _tracer.start_as_current_span("rag.query", attributes=labels):
+            yield query_trace
+    finally:
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # A streaming response closed from another context after a disconnect
+            pass
+        QUERY_LATENCY.labels(**labels).observe(time.perf_counter() - start)
+        logger.info(f"Query trace {labels}: {query_trace.to_dict()}")
+
+
+def trace_query(labels: dict[str, str]):
+    """
+    Context manager collecting the stages and counters of one query.
+    Yields the QueryTrace, or None when tracing is disabled.
+    """
+    if not _enabled:
+        return _NULL_CONTEXT
+    return _traced_query(labels)
+
+
+@contextlib.contextmanager
+def _traced_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        with _tracer.start_as_current_span(f"rag.{stage}"):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        query_trace = _current_trace.get()
+        if query_trace is not None:
+            query_trace.stage_seconds[stage] += elapsed
+        STAGE_LATENCY.labels(stage=stage, **_current_labels()).observe(elapsed)
+
+
+def trace_stage(stage: str):
+    """Context manager timing a pipeline stage, e.g. `with trace_stage("hyde"):`"""
+    if not _enabled:
+        return _NULL_CONTEXT
+    return _traced_stage(stage)
+
+
+def _estimate_tokens(text: str | None) -> int:
+    return math.ceil(len(text or "") / 4)
+
+
+def _field(obj: Any, name: str) -> Any:
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def reported_tokens(raw: Any) -> tuple[int, int] | None:
+    """
+    Prompt and completion tokens from the usage metadata of a raw Vertex AI
+    or Anthropic response, or None if it has none
+    """
+    if isinstance(raw, dict) and "_raw_response" in raw:
+        # The Vertex LLM passes on the __dict__ of the GenerationResponse
+        raw = raw["_raw_response"]
+    usage = _field(raw, "usage_metadata")
+    if usage is not None and _field(usage, "prompt_token_count"):
+        return (
+            int(_field(usage, "prompt_token_count")),
+            int(_field(usage, "candidates_token_count") or 0),
+        )
+    usage = _field(raw, "usage")
+    if usage is not None and _field(usage, "input_tokens") is not None:
+        return int(_field(usage, "input_tokens")), int(_field(usage, "output_tokens"))
+    return None
+
+
+class LLMUsageEventHandler(BaseEventHandler):
+    """Counts LLM calls and tokens of the current query from LlamaIndex events"""
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LLMUsageEventHandler"
+
+    def handle(self, event: BaseEvent, **kwargs: Any) -> None:
+        if isinstance(event, (LLMChatStartEvent, LLMCompletionStartEvent)):
+            _llm_call_depth.set(_llm_call_depth.get() + 1)
+            return
+        if isinstance(event, LLMChatEndEvent):
+            prompt = "\n".join(str(m.content or "") for m in event.messages)
+            completion = event.response.message.content if event.response else ""
+            raw = event.response.raw if event.response else None
+        elif isinstance(event, LLMCompletionEndEvent):
+            prompt = event.prompt
+            completion = event.response.text
+            raw = event.response.raw
+        else:
+            return
+        # Streaming calls may end in another context than they started in
+        depth = _llm_call_depth.get() - 1
+        _llm_call_depth.set(max(depth, 0))
+        if depth > 0:
+            return
+        labels = _current_labels()
+        prompt_tokens, completion_tokens = reported_tokens(raw) or (
+            _estimate_tokens(prompt),
+            _estimate_tokens(completion),
+        )
+        LLM_CALLS.labels(**labels).inc()
+        LLM_TOKENS.labels(direction="prompt", **labels).inc(prompt_tokens)
+        LLM_TOKENS.labels(direction="completion", **labels).inc(completion_tokens)
+        query_trace = _current_trace.get()
+        if query_trace is not None:
+            query_trace.llm_calls += 1
+            query_trace.prompt_tokens += prompt_tokens
+            query_trace.completion_tokens += completion_tokens
+
+
+def record_docstore_fetches(count: int) -> None:
+    DOCSTORE_FETCHES.labels(**_current_labels()).inc(count)
+    query_trace = _current_trace.get()
+    if query_trace is not None:
+        query_trace.docstore_fetches += count
+
+
+def record_docstore_cache_lookups(hits: int, misses: int) -> None:
+    if not _enabled:
+        return
+    DOCSTORE_CACHE_LOOKUPS.labels(result="hit").inc(hits)
+    DOCSTORE_CACHE_LOOKUPS.labels(result="miss").inc(misses)
+
+
+class TracedRetriever(BaseRetriever):
+    """Times a retriever as a pipeline stage"""
+
+    def __init__(self, retriever: BaseRetriever, stage: str) -> None:
+        self._retriever = retriever
+        self._stage = stage
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        with trace_stage(self._stage):
+            return self._retriever.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        with trace_stage(self._stage):
+            return await self._retriever.aretrieve(query_bundle)
+
+
+def traced_retriever(retriever: BaseRetriever | None, stage: str):
+    """Wraps a retriever in a TracedRetriever if tracing is enabled"""
+    if not _enabled or retriever is None:
+        return retriever
+    return TracedRetriever(retriever, stage)
+
+
+class TracedDocumentStore:
+    """
+    Counts the documents a docstore reads, delegating everything to it.
+    Only the outermost call is counted, so get_nodes counts each id once.
+    """
+
+    def __init__(self, docstore: BaseDocumentStore) -> None:
+        self._docstore = docstore
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._docstore, name)
+
+    def get_document(self, doc_id: str, raise_error: bool = True) -> BaseNode | None:
+        record_docstore_fetches(1)
+        return self._docstore.get_document(doc_id, raise_error=raise_error)
+
+    async def aget_document(
+        self, doc_id: str, raise_error: bool = True
+    ) -> BaseNode | None:
+        record_docstore_fetches(1)
+        return await self._docstore.aget_document(doc_id, raise_error=raise_error)
+
+    def get_node(self, node_id: str, raise_error: bool = True) -> BaseNode:
+        record_docstore_fetches(1)
+        return self._docstore.get_node(node_id, raise_error=raise_error)
+
+    async def aget_node(self, node_id: str, raise_error: bool = True) -> BaseNode:
+        record_docstore_fetches(1)
+        return await self._docstore.aget_node(node_id, raise_error=raise_error)
+
+    def get_nodes(
+        self, node_ids: list[str], raise_error: bool = True
+    ) -> list[BaseNode]:
+        record_docstore_fetches(len(node_ids))
+        return self._docstore.get_nodes(node_ids, raise_error=raise_error)
+
+    async def aget_nodes(
+        self, node_ids: list[str], raise_error: bool = True
+    ) -> list[BaseNode]:
+        record_docstore_fetches(len(node_ids))
+        return await self._docstore.aget_nodes(node_ids, raise_error=raise_error)
+
+    def document_exists(self, doc_id: str) -> bool:
+        record_docstore_fetches(1)
+        return self._docstore.document_exists(doc_id)
+
+    async def adocument_exists(self, doc_id: str) -> bool:
+        record_docstore_fetches(1)
+        return await self._docstore.adocument_exists(doc_id)
+
+
+def traced_docstore(docstore: BaseDocumentStore | None):
+    """Wraps a docstore in a TracedDocumentStore if tracing is enabled"""
+    if not _enabled or docstore is None:
+        return docstore
+    return TracedDocumentStore(docstore)
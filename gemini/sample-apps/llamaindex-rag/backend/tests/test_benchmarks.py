@@ -0,0 +1,69 @@
+import asyncio
+
+from backend.benchmarks.fakes import OfflineIndexManager, SyntheticCorpus
+from backend.benchmarks.run_benchmarks import benchmark_corpus, parse_args
+from backend.rag.prompts import Prompts
+from backend.rag.tracing import config_labels, configure_tracing, trace_query
+
+
+def test_benchmark_corpus_reports_every_configuration():
+    args = parse_args(
+        [
+            "--num-nodes",
+            "200",
+            "--retrieval-strategies",
+            "auto_merging",
+            "--queries",
+            "2",
+            "--concurrency",
+            "2",
+            "--llm-latency-ms",
+            "0",
+            "--embed-latency-ms",
+            "0",
+        ]
+    )
+    report = benchmark_corpus(200, args)
+
+    assert report["num_nodes"] == 200
+    assert len(report["results"]) == 16
+    assert report["peak_rss_mb"] > 0
+    for result in report["results"]:
+        stages = set(result["stages_ms"])
+        assert {"retrieve", "synthesize", "total"} <= stages
+        assert ("hyde" in stages) == result["use_hyde"]
+        assert ("rerank" in stages) == result["use_node_rerank"]
+        assert result["throughput"][0]["queries_per_second"] > 0
+
+
+def test_speculative_hyde_reuses_cached_hypothetical_documents(tmp_path):
+    configure_tracing(True)
+    corpus = SyntheticCorpus(200)
+    index_manager = OfflineIndexManager(
+        corpus,
+        bm25_index_dir=str(tmp_path),
+        speculative_hyde=True,
+        hyde_cache_size=16,
+    )
+    configuration = {
+        "retrieval_strategy": "baseline",
+        "use_hyde": True,
+        "qa_followup": False,
+        "hybrid_retrieval": False,
+        "use_node_rerank": False,
+    }
+    query_engine = index_manager.get_query_engine(prompts=Prompts(), **configuration)
+    query_str = corpus.sample_queries(1)[0]
+
+    async def run_query(query_str: str):
+        with trace_query(config_labels("fake", **configuration)) as query_trace:
+            response = await query_engine.aquery(query_str)
+        return response, query_trace
+
+    response, first_trace = asyncio.run(run_query(query_str))
+    _, cached_trace = asyncio.run(run_query(f"  {query_str.upper()} "))
+
+    assert response.source_nodes
+    assert first_trace.stage_seconds["retrieve"] > 0
+    # The second query only calls the LLM for synthesis
+    assert cached_trace.llm_calls == first_trace.llm_calls - 1
@@ -0,0 +1,180 @@
+import functools
+import os
+from types import SimpleNamespace
+
+# Initializes aiplatform, which IndexManager's imports need to construct
+import backend.benchmarks  # noqa: F401
+from backend.rag import bm25_index as bm25_index_module
+from backend.rag import index_manager as index_manager_module
+from backend.rag.bm25_index import (
+    MANIFEST_FILE,
+    BM25IndexRetriever,
+    PersistentBM25Index,
+    upload_bm25_index,
+)
+from backend.rag.docstore_cache import (
+    CachingDocumentStore,
+    read_index_version,
+    write_index_version,
+)
+from backend.rag.index_manager import IndexManager
+from llama_index.core import QueryBundle
+from llama_index.core.schema import TextNode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.kvstore import SimpleKVStore
+
+TEXTS = {
+    "revenue": "Alphabet revenue grew in the first quarter driven by search ads",
+    "cloud": "Google Cloud revenue and operating income increased this quarter",
+    "pixel": "The Pixel phone lineup was refreshed with new camera features",
+    "dividend": "The board approved the first ever quarterly cash dividend",
+}
+
+
+def make_nodes(keys):
+    return [TextNode(id_=key, text=TEXTS[key]) for key in keys]
+
+
+def test_query_ranks_matching_documents(tmp_path):
+    bm25_index = PersistentBM25Index(str(tmp_path))
+    assert bm25_index.add_nodes(make_nodes(TEXTS)) == len(TEXTS)
+
+    results = bm25_index.query("cloud operating income", top_k=2)
+    assert results[0][0] == "cloud"
+    assert all(score > 0 for _, score in results)
+
+
+def test_incremental_updates_persist_and_merge(tmp_path):
+    bm25_index = PersistentBM25Index(str(tmp_path), max_segments=2)
+    bm25_index.add_nodes(make_nodes(["revenue", "cloud"]))
+    bm25_index.add_nodes(make_nodes(["pixel"]))
+    # Already indexed nodes are skipped
+    assert bm25_index.add_nodes(make_nodes(["pixel"])) == 0
+    # A third segment triggers a merge
+    bm25_index.add_nodes(make_nodes(["dividend"]))
+
+    reloaded = PersistentBM25Index.from_persist_dir(str(tmp_path))
+    assert len(reloaded) == len(TEXTS)
+    assert len(reloaded._segments) == 1
+    assert reloaded.query("pixel camera", top_k=1)[0][0] == "pixel"
+    assert reloaded.query("cash dividend", top_k=1)[0][0] == "dividend"
+
+
+def test_deleted_nodes_are_tombstoned_until_merged(tmp_path):
+    bm25_index = PersistentBM25Index(str(tmp_path))
+    bm25_index.add_nodes(make_nodes(TEXTS))
+    bm25_index.add_nodes(
+        [TextNode(id_=f"filler_{i}", text="quarterly filler") for i in range(6)]
+    )
+    assert bm25_index.delete_nodes(["cloud", "missing"]) == 1
+
+    reloaded = PersistentBM25Index.from_persist_dir(str(tmp_path))
+    assert len(reloaded) == 9
+    assert "cloud" not in reloaded
+    assert len(reloaded._segments) == 2
+    assert "cloud" not in [node_id for node_id, _ in reloaded.query("cloud", 4)]
+    # Deleting over a fifth of the stored documents merges away the tombstones
+    reloaded.delete_nodes(["pixel", "revenue"])
+    assert len(reloaded._segments) == 1
+    assert len(reloaded._segments[0]) == 7
+    # Deleted nodes can be added again
+    assert reloaded.add_nodes(make_nodes(["cloud"])) == 1
+    assert reloaded.query("cloud operating income", top_k=1)[0][0] == "cloud"
+
+
+def make_caching_docstore(kvstore, keys):
+    docstore = SimpleDocumentStore()
+    docstore.add_documents(make_nodes(keys))
+    return CachingDocumentStore(
+        docstore,
+        get_version=functools.partial(read_index_version, kvstore, "docs"),
+        version_check_interval=0,
+    )
+
+
+def test_retriever_drops_nodes_missing_from_the_docstore(tmp_path):
+    bm25_index = PersistentBM25Index(str(tmp_path))
+    bm25_index.add_nodes(make_nodes(TEXTS))
+    # "revenue" and "cloud" were deleted from the docstore by a re-index
+    docstore = make_caching_docstore(SimpleKVStore(), ["pixel", "dividend"])
+    retriever = BM25IndexRetriever(lambda: bm25_index, docstore, similarity_top_k=4)
+
+    results = retriever.retrieve(QueryBundle("quarter revenue cloud dividend"))
+    assert [result.node.node_id for result in results] == ["dividend"]
+
+
+def test_bm25_index_is_reloaded_on_new_index_version(tmp_path, monkeypatch):
+    kvstore = SimpleKVStore()
+    write_index_version(kvstore, "docs")
+    docstore = make_caching_docstore(kvstore, TEXTS)
+    loaded = []
+
+    def load_bm25_index(bucket_name, prefix, local_dir):
+        bm25_index = PersistentBM25Index(os.path.join(local_dir, prefix))
+        bm25_index.add_nodes(make_nodes(TEXTS))
+        loaded.append(bm25_index)
+        return bm25_index
+
+    monkeypatch.setattr(index_manager_module, "VertexTextEmbedding", lambda **_: None)
+    monkeypatch.setattr(index_manager_module, "load_bm25_index", load_bm25_index)
+    monkeypatch.setattr(
+        IndexManager,
+        "get_vector_index",
+        lambda self, **_: SimpleNamespace(docstore=docstore),
+    )
+    index_manager = IndexManager(
+        project_id="project",
+        location="us-central1",
+        base_index_name="base",
+        base_endpoint_name="endpoint",
+        qa_index_name=None,
+        qa_endpoint_name=None,
+        embeddings_model_name="text-embedding-004",
+        firestore_db_name="db",
+        firestore_namespace="docs",
+        vs_bucket_name="bucket",
+        bm25_index_dir=str(tmp_path),
+    )
+
+    first = index_manager.get_bm25_index()
+    assert index_manager.get_bm25_index() is first
+    write_index_version(kvstore, "docs")
+    second = index_manager.get_bm25_index()
+
+    assert second is not first
+    assert loaded == [first, second]
+    # The local copy of the previous version is removed
+    assert not os.path.exists(first.persist_dir)
+    assert os.path.exists(second.persist_dir)
+
+
+def test_manifest_is_uploaded_after_segments(tmp_path, monkeypatch):
+    bm25_index = PersistentBM25Index(str(tmp_path))
+    bm25_index.add_nodes(make_nodes(TEXTS))
+    uploads = []
+
+    def upload_directory_to_gcs(local_dir_path, bucket_name, prefix, exclude=()):
+        uploads.extend(
+            f"{prefix}/{os.path.relpath(os.path.join(root, file), local_dir_path)}"
+            for root, _, files in os.walk(local_dir_path)
+            for file in files
+            if os.path.relpath(os.path.join(root, file), local_dir_path) not in exclude
+        )
+
+    def blob(name):
+        return SimpleNamespace(
+            upload_from_filename=lambda filename: uploads.append(name)
+        )
+
+    client = SimpleNamespace(bucket=lambda _: SimpleNamespace(blob=blob))
+    monkeypatch.setattr(
+        bm25_index_module, "upload_directory_to_gcs", upload_directory_to_gcs
+    )
+    monkeypatch.setattr(
+        bm25_index_module, "storage", SimpleNamespace(Client=lambda: client)
+    )
+
+    upload_bm25_index(bm25_index, "bucket", "bm25")
+    assert uploads[-1] == f"bm25/{MANIFEST_FILE}"
+    assert uploads.count(f"bm25/{MANIFEST_FILE}") == 1
+    assert len(uploads) > 1
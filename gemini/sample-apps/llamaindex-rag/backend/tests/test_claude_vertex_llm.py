@@ -1,3 +1,5 @@
+import asyncio
+
 from backend.rag.claude_vertex import ClaudeVertexLLM
 
 
@@ -11,3 +13,21 @@ def test_claude_vertex_llm():
     )
 
     llm.complete(prompt="Tell me something interesting!")
+
+
+def test_claude_vertex_llm_astream_complete():
+    llm = ClaudeVertexLLM(
+        project_id="sysco-smarter-catalog",
+        region="us-east5",
+        model_name="claude-3-5-sonnet@20240620",
+        max_tokens=1024,
+        system_prompt="",
+    )
+
+    async def collect():
+        gen = await llm.astream_complete(prompt="Tell me something interesting!")
+        return [response async for response in gen]
+
+    responses = asyncio.run(collect())
+    assert responses
+    assert responses[-1].text == "".join(r.delta for r in responses)
@@ -0,0 +1,97 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from backend.indexing.docai_parser import DocAIParser
+from llama_index.core import Document
+import pytest
+
+
+class FakeOperation:
+    """Batch operation that finishes `duration` seconds after it starts"""
+
+    def __init__(self, shard, duration, error=None):
+        self.shard = shard
+        self.error = error
+        self.done_at = time.monotonic() + duration
+        self.operation = SimpleNamespace(name=f"operation {shard[0]}")
+
+    def done(self):
+        return time.monotonic() >= self.done_at
+
+    def exception(self):
+        return self.error
+
+
+def make_parser(monkeypatch, duration=0.05, error=None):
+    parser = DocAIParser.__new__(DocAIParser)
+    started = []
+
+    def start_batch_process(shard, chunk_size, include_ancestor_headings):
+        started.append(shard)
+        return [FakeOperation(shard, duration, error)]
+
+    monkeypatch.setattr(parser, "_start_batch_process", start_batch_process)
+    monkeypatch.setattr(parser, "_get_results", lambda ops: [ops[0].shard])
+    monkeypatch.setattr(
+        parser,
+        "_parse_from_results",
+        lambda results: [Document(text=blob) for blob in results[0]],
+    )
+    return parser, started
+
+
+def iter_shards(parser, blobs, **kwargs):
+    return parser.iter_batch_parse(
+        blobs,
+        shard_size=2,
+        max_concurrent_operations=1,
+        min_check_in_interval_sec=0.01,
+        max_check_in_interval_sec=0.01,
+        **kwargs,
+    )
+
+
+def test_shards_are_started_while_the_consumer_is_busy(monkeypatch):
+    parser, started = make_parser(monkeypatch)
+    blobs = [f"blob_{i}" for i in range(6)]
+    shards = iter_shards(parser, blobs, max_ready_shards=2)
+
+    parsed_docs, results = next(shards)
+    assert [doc.text for doc in parsed_docs] == ["blob_0", "blob_1"]
+    # The remaining shards run while the first one is processed
+    deadline = time.monotonic() + 5
+    while len(started) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(started) == 3
+
+    texts = [doc.text for parsed_docs, _ in shards for doc in parsed_docs]
+    assert texts == blobs[2:]
+
+
+def test_errors_are_raised_to_the_consumer(monkeypatch):
+    parser, _ = make_parser(monkeypatch)
+
+    def get_results(operations):
+        raise OSError("gcs")
+
+    monkeypatch.setattr(parser, "_get_results", get_results)
+
+    with pytest.raises(OSError, match="gcs"):
+        list(iter_shards(parser, ["blob_0"]))
+
+
+def test_background_thread_stops_with_the_consumer(monkeypatch):
+    parser, started = make_parser(monkeypatch)
+    shards = iter_shards(parser, [f"blob_{i}" for i in range(20)])
+
+    next(shards)
+    shards.close()
+    deadline = time.monotonic() + 5
+    while (
+        any(t.name == "docai-batch-parse" for t in threading.enumerate())
+        and time.monotonic() < deadline
+    ):
+        time.sleep(0.01)
+    assert not any(t.name == "docai-batch-parse" for t in threading.enumerate())
+    assert len(started) < 10
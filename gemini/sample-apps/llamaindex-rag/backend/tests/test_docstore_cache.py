@@ -0,0 +1,97 @@
+import asyncio
+import threading
+
+from backend.rag.docstore_cache import (
+    CachingDocumentStore,
+    read_index_version,
+    write_index_version,
+)
+from llama_index.core.schema import TextNode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.kvstore import SimpleKVStore
+
+
+class CountingDocumentStore(SimpleDocumentStore):
+    """Counts the documents read from the store"""
+
+    reads = 0
+    active = 0
+    max_active = 0
+
+    def get_document(self, doc_id, raise_error=True):
+        self.reads += 1
+        return super().get_document(doc_id, raise_error=raise_error)
+
+    async def aget_document(self, doc_id, raise_error=True):
+        self.reads += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        return super().get_document(doc_id, raise_error=raise_error)
+
+
+def make_docstore():
+    docstore = CountingDocumentStore()
+    docstore.add_documents([TextNode(id_=f"n{i}", text=f"node {i}") for i in range(10)])
+    return docstore
+
+
+def test_cache_tiers_and_version_invalidation(tmp_path):
+    docstore = make_docstore()
+    kvstore = SimpleKVStore()
+    write_index_version(kvstore, "test")
+
+    def make_cache():
+        return CachingDocumentStore(
+            docstore,
+            max_nodes=2,
+            disk_cache_path=str(tmp_path / "cache.sqlite"),
+            get_version=lambda: read_index_version(kvstore, "test"),
+        )
+
+    cache = make_cache()
+    node_ids = ["n0", "n1", "n2", "n1"]
+    assert [n.node_id for n in cache.get_nodes(node_ids)] == node_ids
+    assert docstore.reads == 3
+    # Nodes evicted from the memory LRU are still on disk, also after a restart
+    assert cache.get_document("n0").text == "node 0"
+    assert make_cache().get_nodes(["n0", "n1", "n2"])
+    assert docstore.reads == 3
+
+    write_index_version(kvstore, "test")
+    make_cache().get_document("n0")
+    assert docstore.reads == 4
+
+
+def test_concurrent_requests_share_fetches():
+    docstore = make_docstore()
+    cache = CachingDocumentStore(docstore)
+
+    async def fetch_concurrently():
+        return await asyncio.gather(*[cache.aget_nodes(["n3", "n4"]) for _ in range(5)])
+
+    results = asyncio.run(fetch_concurrently())
+    assert all([n.node_id for n in nodes] == ["n3", "n4"] for nodes in results)
+    assert docstore.reads == 2
+    assert cache.get_document("missing", raise_error=False) is None
+
+
+def test_async_lookups_read_the_version_off_the_loop_and_bound_fetches():
+    docstore = make_docstore()
+    version_threads = []
+
+    def get_version():
+        version_threads.append(threading.get_ident())
+        return "version"
+
+    cache = CachingDocumentStore(docstore, get_version=get_version, fetch_concurrency=3)
+
+    async def fetch_all():
+        nodes = await cache.aget_nodes([f"n{i}" for i in range(10)])
+        return nodes, threading.get_ident()
+
+    nodes, loop_thread = asyncio.run(fetch_all())
+    assert [n.node_id for n in nodes] == [f"n{i}" for i in range(10)]
+    assert len(version_threads) == 1 and version_threads[0] != loop_thread
+    assert docstore.max_active == 3
@@ -0,0 +1,62 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+from backend.rag import eval_jobs
+from backend.rag.eval_jobs import DATASET_FILE, EvalJobManager
+from backend.rag.evaluate import LLMEvaluator
+from backend.rag.quota import QuotaBackoff
+from google.api_core import exceptions as api_exceptions
+import pandas as pd
+
+
+def test_judge_quota_errors_do_not_rerun_the_query(tmp_path, monkeypatch):
+    monkeypatch.setattr(eval_jobs, "bind_judge_metrics", lambda *args: [])
+    monkeypatch.setattr(eval_jobs, "QuotaBackoff", lambda: QuotaBackoff(0.01))
+    scored = []
+    monkeypatch.setattr(
+        EvalJobManager,
+        "_score_batch",
+        lambda self, job_id, batch, metrics, bq_client: scored.extend(batch),
+    )
+    manager = EvalJobManager(str(tmp_path), max_retries=2)
+    job_id = "job"
+    os.makedirs(os.path.join(manager.job_dir(job_id), eval_jobs.ANSWERS_DIR))
+    pd.DataFrame({"question": ["q0", "q1"], "ground_truth": ["a0", "a1"]}).to_csv(
+        os.path.join(manager.job_dir(job_id), DATASET_FILE), index=False
+    )
+    manager._jobs[job_id] = {
+        "request": {
+            "ragas_metrics": [],
+            "eval_model_name": "judge",
+            "embedding_model_name": "embedding",
+        }
+    }
+    queries, judged = [], []
+
+    async def retrieval_qa_func(question):
+        queries.append(question)
+        return f"answer to {question}"
+
+    async def async_eval_answer(model, question, answer, ground_truth, context):
+        judged.append(question)
+        if judged.count(question) == 1:
+            raise api_exceptions.ResourceExhausted("judge quota")
+        return "90"
+
+    llm_evaluator = SimpleNamespace(
+        eval_model=None,
+        async_eval_answer=async_eval_answer,
+        parse_response=LLMEvaluator.parse_response,
+        extract_score=LLMEvaluator.extract_score,
+    )
+    asyncio.run(manager._arun_job(job_id, retrieval_qa_func, llm_evaluator))
+
+    assert sorted(queries) == ["q0", "q1"]
+    assert sorted(judged) == ["q0", "q0", "q1", "q1"]
+    assert sorted((r["answer"], r["score"]) for r in scored) == [
+        ("answer to q0", 90),
+        ("answer to q1", 90),
+    ]
+    assert manager._jobs[job_id]["quota_retries"] == 2
+    manager.shutdown()
@@ -58,3 +58,20 @@ eval_batch_params = [
 def test_eval_batch(client, payload):
     response = client.post("/eval_batch", json=payload)
     assert response.status_code == 200
+    assert "job_id" in response.json()
+
+
+def test_eval_results_unknown_id(client):
+    response = client.get("/eval_results/unknown")
+    assert response.status_code == 404
+
+
+def test_eval_batch_unknown_job(client):
+    response = client.get("/eval_batch/unknown")
+    assert response.status_code == 404
+
+
+def test_metrics(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "rag_stage_latency_seconds" in response.text
@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import os
+from types import SimpleNamespace
+
+import threading
+
+from common import utils
+from common.utils import file_matches_blob
+import google_crc32c
+
+
+def make_blob(content: bytes, md5: bool = True):
+    return SimpleNamespace(
+        size=len(content),
+        md5_hash=(
+            base64.b64encode(hashlib.md5(content).digest()).decode() if md5 else None
+        ),
+        crc32c=base64.b64encode(google_crc32c.Checksum(content).digest()).decode(),
+    )
+
+
+def test_file_matches_blob_by_md5_or_crc32c(tmp_path):
+    path = tmp_path / "segment.npz"
+    path.write_bytes(b"bm25 segment")
+
+    assert file_matches_blob(str(path), make_blob(b"bm25 segment"))
+    # Composite objects are compared by CRC32C
+    assert file_matches_blob(str(path), make_blob(b"bm25 segment", md5=False))
+    assert not file_matches_blob(str(path), make_blob(b"bm25 segmenT"))
+    assert not file_matches_blob(str(path), make_blob(b"bm25 segmenT", md5=False))
+    assert not file_matches_blob(str(path), make_blob(b"other size"))
+
+
+class FakeBucket:
+    """Bucket whose blobs are listed lazily and downloaded from memory"""
+
+    def __init__(self, contents: dict[str, bytes]):
+        self.contents = contents
+        self.listed = 0
+        self.downloaded = threading.Event()
+
+    def list_blobs(self, **kwargs):
+        for name in self.contents:
+            self.listed += 1
+            content_type = "application/pdf" if name.endswith("pdf") else None
+            yield SimpleNamespace(name=name, content_type=content_type)
+
+    def blob(self, name: str):
+        def download_to_filename(path):
+            if name not in self.contents:
+                raise FileNotFoundError(name)
+            with open(path, "wb") as f:
+                f.write(self.contents[name])
+            self.downloaded.set()
+
+        return SimpleNamespace(download_to_filename=download_to_filename)
+
+
+def test_downloads_start_while_bucket_is_listed(tmp_path, monkeypatch):
+    bucket = FakeBucket(
+        {
+            "raw/a.PDF": b"a",
+            "raw/untitled_pdf": b"b",
+            "raw/notes.txt": b"c",
+            "raw/nested/": b"",
+            "raw/nested/d.pdf": b"d",
+        }
+    )
+    monkeypatch.setattr(
+        utils.storage, "Client", lambda: SimpleNamespace(bucket=lambda _: bucket)
+    )
+
+    blobs = utils.iter_bucket_blobs(
+        "bucket", "raw/", suffixes=(".pdf",), mimetypes=("application/pdf",)
+    )
+    with utils.BlobDownloader("bucket", str(tmp_path), workers=2) as downloader:
+        downloader.submit(next(blobs).name)
+        # The first download doesn't wait for the rest of the listing
+        assert bucket.downloaded.wait(timeout=5)
+        assert bucket.listed == 1
+        for blob in blobs:
+            downloader.submit(blob.name)
+        downloader.submit("raw/missing.pdf")
+
+    assert downloader.downloaded == 3
+    assert list(downloader.failed) == ["raw/missing.pdf"]
+    assert sorted(
+        os.path.relpath(os.path.join(root, name), tmp_path)
+        for root, _, names in os.walk(tmp_path)
+        for name in names
+    ) == ["raw/a.PDF", "raw/nested/d.pdf", "raw/untitled_pdf"]
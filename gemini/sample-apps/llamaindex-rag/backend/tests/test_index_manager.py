@@ -1,6 +1,8 @@
 import os
 
+from backend.rag import index_manager as index_manager_module
 from backend.rag.index_manager import IndexManager
+from backend.rag.prompts import Prompts
 import yaml
 
 # Load configuration from config.yaml
@@ -59,3 +61,84 @@ def test_no_qa_vector_store():
     assert index_manager.qa_index == None
     assert index_manager.qa_endpoint_name == None
     assert index_manager.qa_index_name == None
+
+
+def test_query_engine_cache(monkeypatch):
+    monkeypatch.setattr(index_manager_module, "VertexTextEmbedding", lambda **_: None)
+    monkeypatch.setattr(IndexManager, "get_vector_index", lambda self, **_: object())
+    monkeypatch.setattr(IndexManager, "_build_query_engine", lambda self, **_: object())
+    index_manager = IndexManager(
+        project_id=PROJECT_ID,
+        location=LOCATION,
+        embeddings_model_name=EMBEDDINGS_MODEL_NAME,
+        base_index_name=VECTOR_INDEX_NAME,
+        base_endpoint_name=INDEX_ENDPOINT_NAME,
+        qa_index_name=QA_INDEX_NAME,
+        qa_endpoint_name=QA_ENDPOINT_NAME,
+        firestore_db_name=FIRESTORE_DB_NAME,
+        firestore_namespace=FIRESTORE_NAMESPACE,
+        vs_bucket_name=BUCKET_NAME,
+        query_engine_cache_size=2,
+    )
+    prompts = Prompts()
+    engine = index_manager.get_query_engine(prompts=prompts)
+    assert index_manager.get_query_engine(prompts=prompts) is engine
+
+    # A prompt update changes the key, so a new engine is built
+    prompts.update("qa_prompt_tmpl", "{context_str} {query_str}")
+    updated_engine = index_manager.get_query_engine(prompts=prompts)
+    assert updated_engine is not engine
+
+    # Least recently used configuration is evicted
+    index_manager.get_query_engine(prompts=prompts, similarity_top_k=10)
+    index_manager.get_query_engine(prompts=prompts, similarity_top_k=20)
+    assert index_manager.get_query_engine(prompts=prompts) is not updated_engine
+
+    # Switching indexes drops every cached engine
+    index_manager.set_current_indexes(
+        VECTOR_INDEX_NAME,
+        INDEX_ENDPOINT_NAME,
+        QA_INDEX_NAME,
+        QA_ENDPOINT_NAME,
+        FIRESTORE_DB_NAME,
+        FIRESTORE_NAMESPACE,
+    )
+    assert len(index_manager._query_engine_cache) == 0
+
+
+def test_index_handles_are_pooled(monkeypatch):
+    loaded = []
+
+    def get_vector_index(self, index_name, **_):
+        loaded.append(index_name)
+        return object()
+
+    monkeypatch.setattr(index_manager_module, "VertexTextEmbedding", lambda **_: None)
+    monkeypatch.setattr(IndexManager, "get_vector_index", get_vector_index)
+    index_manager = IndexManager(
+        project_id=PROJECT_ID,
+        location=LOCATION,
+        embeddings_model_name=EMBEDDINGS_MODEL_NAME,
+        base_index_name="base_a",
+        base_endpoint_name=INDEX_ENDPOINT_NAME,
+        qa_index_name="qa_a",
+        qa_endpoint_name=QA_ENDPOINT_NAME,
+        firestore_db_name=FIRESTORE_DB_NAME,
+        firestore_namespace=FIRESTORE_NAMESPACE,
+        vs_bucket_name=BUCKET_NAME,
+    )
+    assert index_manager.qa_index is not None
+    assert sorted(loaded) == ["base_a", "qa_a"]
+
+    # Switching back to previously used indexes reuses their handles
+    for base_index_name, qa_index_name in [("base_b", "qa_b"), ("base_a", "qa_a")]:
+        index_manager.set_current_indexes(
+            base_index_name,
+            INDEX_ENDPOINT_NAME,
+            qa_index_name,
+            QA_ENDPOINT_NAME,
+            FIRESTORE_DB_NAME,
+            FIRESTORE_NAMESPACE,
+        )
+        index_manager.qa_index
+    assert sorted(loaded) == ["base_a", "base_b", "qa_a", "qa_b"]
@@ -0,0 +1,46 @@
+from backend.indexing.index_manifest import IndexManifest, ManifestEntry
+from common.utils import Blob
+from llama_index.core.storage.kvstore import SimpleKVStore
+
+
+def make_blob(name: str, content_hash: str | None) -> Blob:
+    return Blob(f"gs://bucket/{name}", "application/pdf", content_hash=content_hash)
+
+
+def test_diff_only_indexes_new_and_changed_sources():
+    manifest = IndexManifest(SimpleKVStore(), "docs", batch_size=1)
+    manifest.put(
+        [
+            ManifestEntry("gs://bucket/same.pdf", "a", node_ids=["n1"]),
+            ManifestEntry("gs://bucket/changed.pdf", "b", node_ids=["n2"]),
+            ManifestEntry("gs://bucket/deleted.pdf", "c", node_ids=["n3"]),
+            ManifestEntry("gs://bucket/unhashed.pdf", None, node_ids=["n4"]),
+        ]
+    )
+
+    seen = []
+    diff = manifest.diff(
+        [
+            make_blob("same.pdf", "a"),
+            make_blob("changed.pdf", "b2"),
+            make_blob("new.pdf", "d"),
+            make_blob("unhashed.pdf", None),
+        ],
+        on_index=seen.append,
+    )
+
+    assert diff.unchanged == 1
+    assert seen == diff.to_index
+    assert [blob.path for blob in diff.to_index] == [
+        "gs://bucket/changed.pdf",
+        "gs://bucket/new.pdf",
+        "gs://bucket/unhashed.pdf",
+    ]
+    assert sorted(node_id for e in diff.stale for node_id in e.node_ids) == [
+        "n2",
+        "n3",
+        "n4",
+    ]
+
+    manifest.delete(entry.source for entry in diff.stale)
+    assert list(manifest.load()) == ["gs://bucket/same.pdf"]
@@ -0,0 +1,227 @@
+import datetime
+import os
+import shutil
+from types import SimpleNamespace
+
+from backend.rag import local_vector_store as local_vector_store_module
+from backend.rag.local_vector_store import (
+    MANIFEST_FILE,
+    MIN_VECTORS_FOR_IVF,
+    LocalVectorStore,
+    load_local_vector_store,
+    upload_local_vector_store,
+)
+from llama_index.core import StorageContext
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+import numpy as np
+
+
+def make_nodes(vectors, num_sources=4):
+    return [
+        TextNode(
+            id_=f"node_{i}",
+            text=f"text {i}",
+            metadata={"source": f"doc_{i % num_sources}.pdf", "page": i},
+            embedding=vector.tolist(),
+        )
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def query(vector_store, vector, top_k=5, filters=None):
+    return vector_store.query(
+        VectorStoreQuery(
+            query_embedding=vector.tolist(), similarity_top_k=top_k, filters=filters
+        )
+    )
+
+
+def unit_vectors(rng, num, dim):
+    vectors = rng.normal(size=(num, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_filters_deletes_and_persists(tmp_path):
+    vectors = unit_vectors(np.random.default_rng(0), 40, 16)
+    vector_store = LocalVectorStore(str(tmp_path))
+    vector_store.add(make_nodes(vectors))
+    # Added nodes are searchable before the index is persisted
+    result = query(vector_store, vectors[3])
+    assert result.ids[0] == "node_3"
+    assert result.nodes[0].text == "text 3"
+
+    vector_store.persist()
+    vector_store.delete_nodes(["node_3"])
+    filters = MetadataFilters(
+        filters=[
+            MetadataFilter(key="source", value="doc_1.pdf"),
+            MetadataFilter(key="page", value=20, operator=FilterOperator.LT),
+        ]
+    )
+    result = query(vector_store, vectors[3], top_k=10, filters=filters)
+    assert "node_3" not in result.ids
+    assert {node.metadata["source"] for node in result.nodes} == {"doc_1.pdf"}
+    assert len(result.ids) == 5
+
+    vector_store.persist()
+    reloaded = LocalVectorStore(str(tmp_path))
+    assert len(reloaded) == 39
+    assert query(reloaded, vectors[5]).ids[0] == "node_5"
+    # Only the current version is kept
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_inverted_lists_find_nearest_neighbours(tmp_path):
+    rng = np.random.default_rng(0)
+    num_vectors = MIN_VECTORS_FOR_IVF * 2
+    centers = unit_vectors(rng, 64, 32)
+    vectors = centers[rng.integers(0, 64, num_vectors)] + 0.3 * unit_vectors(
+        rng, num_vectors, 32
+    )
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    vector_store = LocalVectorStore(str(tmp_path), nprobe=8)
+    vector_store.add(make_nodes(vectors))
+    vector_store.persist()
+    assert vector_store._centroids is not None
+
+    recalls = []
+    for i in rng.choice(num_vectors, 20, replace=False):
+        exact = np.argsort(-(vectors @ vectors[i]))[:10]
+        result = query(vector_store, vectors[i], top_k=10)
+        recalls.append(len({f"node_{j}" for j in exact} & set(result.ids)) / 10)
+    assert np.mean(recalls) >= 0.9
+
+
+class LocalBucket:
+    """Serves blobs from a local directory, like storage.Client().bucket()"""
+
+    def __init__(self, root):
+        self.root = root
+        self.deleted = []
+
+    def blob(self, name):
+        path = os.path.join(self.root, name)
+        return SimpleNamespace(
+            exists=lambda: os.path.exists(path),
+            download_as_text=lambda: open(path).read(),
+            upload_from_filename=lambda filename: shutil.copy(filename, path),
+        )
+
+    def download(self, bucket_name, prefix, destination_directory):
+        shutil.copytree(
+            os.path.join(self.root, prefix),
+            os.path.join(destination_directory, prefix),
+            dirs_exist_ok=True,
+        )
+
+
+def test_pooled_store_reloads_on_new_index_version(tmp_path, monkeypatch):
+    bucket = LocalBucket(str(tmp_path / "bucket"))
+    monkeypatch.setattr(
+        local_vector_store_module,
+        "storage",
+        SimpleNamespace(Client=lambda: SimpleNamespace(bucket=lambda _: bucket)),
+    )
+    monkeypatch.setattr(
+        local_vector_store_module,
+        "download_bucket_with_transfer_manager",
+        bucket.download,
+    )
+    vectors = unit_vectors(np.random.default_rng(0), 40, 16)
+    nodes = make_nodes(vectors)
+    # The indexer persists straight into the bucket directory
+    writer = LocalVectorStore(str(tmp_path / "bucket" / "ann"))
+    writer.add(nodes[:20])
+    writer.persist()
+    index_version = ["first"]
+
+    reader = load_local_vector_store(
+        "bucket",
+        "ann",
+        str(tmp_path / "local"),
+        get_index_version=lambda: index_version[0],
+    )
+    assert len(reader) == 20
+    writer.add(nodes[20:])
+    writer.persist()
+    # Nothing is reloaded until the index version is stamped
+    assert query(reader, vectors[30]).ids[0] != "node_30"
+
+    index_version[0] = "second"
+    assert query(reader, vectors[30]).ids[0] == "node_30"
+    assert len(reader) == 40
+    # Only the current version is kept locally
+    assert sorted(os.listdir(tmp_path / "local" / "ann")) == [
+        MANIFEST_FILE,
+        writer.version_dir,
+    ]
+
+
+def test_superseded_versions_are_kept_for_a_grace_period(tmp_path, monkeypatch):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    uploaded = {
+        "v000001": now - datetime.timedelta(hours=3),
+        "v000002": now - datetime.timedelta(hours=2),
+        "v000003": now - datetime.timedelta(minutes=5),
+    }
+    deleted = []
+
+    def make_blob(version):
+        name = f"ann/{version}/vectors.npy"
+        return SimpleNamespace(
+            name=name, updated=uploaded[version], delete=lambda: deleted.append(name)
+        )
+
+    bucket = SimpleNamespace(
+        blob=lambda name: SimpleNamespace(upload_from_filename=lambda _: None),
+        list_blobs=lambda prefix: [
+            SimpleNamespace(name=f"ann/{MANIFEST_FILE}", updated=now)
+        ]
+        + [make_blob(version) for version in uploaded],
+    )
+    monkeypatch.setattr(
+        local_vector_store_module,
+        "storage",
+        SimpleNamespace(Client=lambda: SimpleNamespace(bucket=lambda _: bucket)),
+    )
+    monkeypatch.setattr(
+        local_vector_store_module, "upload_directory_to_gcs", lambda *args: None
+    )
+    vector_store = LocalVectorStore(str(tmp_path))
+    vector_store.add(make_nodes(unit_vectors(np.random.default_rng(0), 4, 8)))
+    vector_store._version = 2
+    vector_store.persist()
+    assert vector_store.version_dir == "v000003"
+
+    upload_local_vector_store(vector_store, "bucket", "ann")
+    # v000002 was superseded 5 minutes ago, v000001 two hours ago
+    assert deleted == ["ann/v000001/vectors.npy"]
+
+
+def test_queries_do_not_score_under_the_lock(tmp_path, monkeypatch):
+    vectors = unit_vectors(np.random.default_rng(0), 40, 16)
+    vector_store = LocalVectorStore(str(tmp_path))
+    vector_store.add(make_nodes(vectors))
+    vector_store.persist()
+    score_rows = local_vector_store_module._score_rows
+    lock_held = []
+
+    def checked_score_rows(*args):
+        lock_held.append(vector_store._lock.locked())
+        return score_rows(*args)
+
+    monkeypatch.setattr(local_vector_store_module, "_score_rows", checked_score_rows)
+    assert query(vector_store, vectors[7]).ids[0] == "node_7"
+    assert lock_held == [False]
+
+
+def test_empty_store_is_used_by_storage_contexts(tmp_path):
+    vector_store = LocalVectorStore(str(tmp_path))
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    assert storage_context.vector_store is vector_store
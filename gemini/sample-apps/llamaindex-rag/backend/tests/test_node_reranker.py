@@ -0,0 +1,198 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import re
+import threading
+import time
+import weakref
+
+# Initializes aiplatform, which the reranker's module-level Vertex LLM needs
+import backend.benchmarks  # noqa: F401
+from backend.rag import node_reranker
+from backend.rag.node_reranker import (
+    CustomLLMRerank,
+    aclose_sessions,
+    authenticate_google,
+    get_async_session,
+    get_session,
+)
+from llama_index.core import QueryBundle
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import NodeWithScore, TextNode
+import pytest
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    monkeypatch.setattr(node_reranker, "_session", None)
+    monkeypatch.setattr(node_reranker, "_async_sessions", weakref.WeakKeyDictionary())
+    return node_reranker._async_sessions
+
+
+class ScriptedLLM(MockLLM):
+    """Answers a choice select prompt after the delay scripted for the
+    batch's first node, ranking every node by the number in its text"""
+
+    _delays: dict = PrivateAttr()
+    _unparseable: set = PrivateAttr()
+    _calls: list = PrivateAttr()
+    # Shared with the copy of the LLM the reranker validates
+    _concurrency: dict = PrivateAttr()
+
+    def __init__(self, delays=None, unparseable=()):
+        super().__init__()
+        self._delays = delays or {}
+        self._unparseable = set(unparseable)
+        self._calls = []
+        self._concurrency = {"active": 0, "max_active": 0}
+
+    async def apredict(self, prompt, context_str="", query_str="", **kwargs):
+        texts = re.findall(r"Document \d+:\nnode (\d+)", context_str)
+        self._calls.append(texts[0])
+        concurrency = self._concurrency
+        concurrency["active"] += 1
+        concurrency["max_active"] = max(
+            concurrency["max_active"], concurrency["active"]
+        )
+        try:
+            await asyncio.sleep(self._delays.get(texts[0], 0.01))
+        finally:
+            concurrency["active"] -= 1
+        if texts[0] in self._unparseable:
+            # Can't be parsed the first time and is answered on the retry
+            self._unparseable.discard(texts[0])
+            return "Doc 1, Relevance 10"
+        return "\n".join(
+            f"Doc: {i}, Relevance: {int(text) % 10}"
+            for i, text in enumerate(texts, start=1)
+        )
+
+
+def make_nodes(num):
+    return [
+        NodeWithScore(node=TextNode(id_=f"node_{i}", text=f"node {i}"), score=0.5)
+        for i in range(num)
+    ]
+
+
+def rerank(llm, nodes, **kwargs):
+    reranker = CustomLLMRerank(llm=llm, choice_batch_size=4, **kwargs)
+    return asyncio.run(reranker.postprocess_nodes(nodes, QueryBundle("query")))
+
+
+def test_batches_are_reranked_concurrently():
+    llm = ScriptedLLM(delays={"0": 0.05, "4": 0.05, "8": 0.05, "12": 0.05})
+    results = rerank(llm, make_nodes(16), top_n=4, max_concurrency=2)
+
+    assert llm._concurrency["max_active"] == 2
+    assert [r.node.node_id for r in results] == ["node_9", "node_8", "node_7", "node_6"]
+    assert [r.score for r in results] == [9.0, 8.0, 7.0, 6.0]
+
+
+def test_unparseable_answers_are_retried_once():
+    llm = ScriptedLLM(unparseable={"0"})
+    results = rerank(llm, make_nodes(4), top_n=4)
+
+    assert llm._calls == ["0", "0"]
+    assert [r.node.node_id for r in results] == ["node_3", "node_2", "node_1", "node_0"]
+
+
+def test_failed_batches_keep_their_original_order():
+    llm = ScriptedLLM(delays={"4": 10.0})
+    results = rerank(llm, make_nodes(8), top_n=8, batch_timeout=0.1)
+
+    assert [r.node.node_id for r in results] == [
+        "node_3",
+        "node_2",
+        "node_1",
+        "node_0",
+        "node_4",
+        "node_5",
+        "node_6",
+        "node_7",
+    ]
+
+
+def test_nodes_are_returned_unranked_when_every_batch_fails():
+    llm = ScriptedLLM(delays={"0": 10.0, "4": 10.0})
+    nodes = make_nodes(8)
+    results = rerank(llm, nodes, top_n=5, batch_timeout=0.1)
+
+    assert results == nodes[:5]
+
+
+def test_early_exit_skips_remaining_batches():
+    llm = ScriptedLLM(delays={"4": 10.0})
+    start = time.perf_counter()
+    results = rerank(llm, make_nodes(8), top_n=2, early_exit_relevance=2)
+
+    assert time.perf_counter() - start < 5
+    assert [r.node.node_id for r in results] == ["node_3", "node_2"]
+
+
+def test_sync_session_is_created_once(sessions, monkeypatch):
+    created = []
+    barrier = threading.Barrier(8)
+
+    class SlowSession(node_reranker.requests.Session):
+        def __init__(self):
+            time.sleep(0.05)
+            created.append(self)
+            super().__init__()
+
+    def get_session_together(_):
+        barrier.wait(timeout=5)
+        return get_session()
+
+    monkeypatch.setattr(node_reranker.requests, "Session", SlowSession)
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(get_session_together, range(8)))
+
+    assert len(created) == 1
+    assert all(result is created[0] for result in results)
+
+
+def test_async_sessions_are_kept_per_loop(sessions):
+    async def first_loop():
+        session = get_async_session()
+        assert get_async_session() is session
+        return session
+
+    async def second_loop():
+        session = get_async_session()
+        # The session of the finished loop was removed
+        assert list(sessions.values()) == [session]
+        await aclose_sessions()
+        return session
+
+    first = asyncio.run(first_loop())
+    second = asyncio.run(second_loop())
+
+    assert second is not first
+    assert second.closed
+    assert len(sessions) == 0
+    asyncio.run(first.close())
+
+
+def test_credentials_are_refreshed_close_to_expiry(monkeypatch):
+    refreshed = []
+
+    class Credentials:
+        token = "token"
+        # google-auth reports expiry as a naive UTC datetime
+        expiry = datetime.datetime.now(datetime.timezone.utc).replace(
+            tzinfo=None
+        ) + datetime.timedelta(hours=1)
+
+        def refresh(self, request):
+            refreshed.append(request)
+
+    credentials = Credentials()
+    monkeypatch.setattr(node_reranker, "_credentials", credentials)
+    assert authenticate_google() == "token"
+    assert refreshed == []
+
+    credentials.expiry -= datetime.timedelta(minutes=58)
+    authenticate_google()
+    assert len(refreshed) == 1
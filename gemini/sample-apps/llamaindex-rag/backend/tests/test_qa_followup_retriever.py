@@ -0,0 +1,63 @@
+import asyncio
+
+from backend.rag.qa_followup_retriever import aget_documents
+from llama_index.core.schema import TextNode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+
+
+class RecordingDocumentStore(SimpleDocumentStore):
+    """Records the ids of every read"""
+
+    def __init__(self):
+        super().__init__()
+        self.reads = []
+
+    async def aget_nodes(self, node_ids, raise_error=True):
+        self.reads.append(list(node_ids))
+        return await super().aget_nodes(node_ids, raise_error=raise_error)
+
+    async def aget_document(self, doc_id, raise_error=True):
+        self.reads.append([doc_id])
+        return await super().aget_document(doc_id, raise_error=raise_error)
+
+
+def test_documents_are_read_once_in_a_single_batch():
+    docstore = RecordingDocumentStore()
+    docstore.add_documents(
+        [TextNode(id_=f"doc_{i}", text=f"doc {i}") for i in range(3)]
+    )
+    doc_ids = ["doc_2", "doc_0", "doc_2", "doc_1", "doc_0"]
+
+    docs = asyncio.run(aget_documents(docstore, doc_ids))
+
+    assert [doc.node_id for doc in docs] == doc_ids
+    assert docstore.reads[0] == ["doc_2", "doc_0", "doc_1"]
+
+
+class SlowDocumentStore(SimpleDocumentStore):
+    """Records the number of concurrent reads"""
+
+    def __init__(self):
+        super().__init__()
+        self.active = 0
+        self.max_active = 0
+
+    async def aget_document(self, doc_id, raise_error=True):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        return await super().aget_document(doc_id, raise_error=raise_error)
+
+
+def test_documents_are_read_concurrently_without_batched_reads():
+    docstore = SlowDocumentStore()
+    docstore.add_documents(
+        [TextNode(id_=f"doc_{i}", text=f"doc {i}") for i in range(3)]
+    )
+    doc_ids = ["doc_2", "doc_0", "doc_1", "doc_0"]
+
+    docs = asyncio.run(aget_documents(docstore, doc_ids))
+
+    assert [doc.node_id for doc in docs] == doc_ids
+    assert docstore.max_active == 3
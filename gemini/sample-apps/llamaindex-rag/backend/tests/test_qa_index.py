@@ -0,0 +1,161 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+from backend.indexing import run_parse_embed_index
+from backend.indexing.index_manifest import IndexManifest, ManifestEntry
+from backend.rag.local_vector_store import LocalVectorStore
+from llama_index.core import Document, MockEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import TextNode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.kvstore import SimpleKVStore
+import pytest
+
+
+class FakeExtractor:
+    async def _aextract_questions_from_node(self, doc):
+        await asyncio.sleep(0)
+        return doc.text
+
+
+class FakeProgram:
+    async def acall(self, questions_list):
+        return SimpleNamespace(
+            questions_list=[f"{questions_list} question {i}?" for i in range(5)]
+        )
+
+
+class RecordingIndex:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.batches = []
+
+    def insert_nodes(self, nodes):
+        if self.fail:
+            raise RuntimeError("upsert failed")
+        self.batches.append(nodes)
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(run_parse_embed_index, "QA_EXTRACTION_CONCURRENCY", 4)
+    monkeypatch.setattr(run_parse_embed_index, "QA_UPSERT_BATCH_SIZE", 3)
+
+
+def make_docs(num_docs):
+    return [Document(id_=f"doc_{i}", text=f"doc {i}") for i in range(num_docs)]
+
+
+def test_questions_are_upserted_in_batches():
+    qa_index = RecordingIndex()
+    question_ids = asyncio.run(
+        run_parse_embed_index.build_qa_index(
+            make_docs(10), qa_index, FakeExtractor(), FakeProgram()
+        )
+    )
+
+    assert sorted(question_ids) == sorted(f"doc_{i}" for i in range(10))
+    assert all(len(ids) == 5 for ids in question_ids.values())
+    assert all(len(batch) <= 3 for batch in qa_index.batches)
+    assert sum(len(batch) for batch in qa_index.batches) == 50
+
+
+def test_upsert_errors_cancel_extraction():
+    async def build():
+        # More questions than the queue holds, so workers block on it
+        return await asyncio.wait_for(
+            run_parse_embed_index.build_qa_index(
+                make_docs(50), RecordingIndex(fail=True), FakeExtractor(), FakeProgram()
+            ),
+            timeout=5,
+        )
+
+    with pytest.raises(RuntimeError, match="upsert failed"):
+        asyncio.run(build())
+
+
+class FailingVectorStore(LocalVectorStore):
+    """Fails to upsert the questions of the "broken" document"""
+
+    def add(self, nodes, **kwargs):
+        if any("broken" in node.get_content() for node in nodes):
+            raise RuntimeError("upsert failed")
+        return super().add(nodes, **kwargs)
+
+
+class FakeParser:
+    def __init__(self, **kwargs):
+        pass
+
+    def iter_batch_parse(self, blobs, **kwargs):
+        for blob in blobs:
+            doc = Document(
+                text=blob.path.split("/")[-1], metadata={"source": blob.path}
+            )
+            yield [doc], []
+
+
+def test_upsert_errors_fail_the_indexing_run(tmp_path, monkeypatch):
+    kvstore = SimpleKVStore()
+    docstore = SimpleDocumentStore()
+    vector_store = LocalVectorStore(str(tmp_path / "vectors"))
+    qa_vector_store = FailingVectorStore(str(tmp_path / "questions"))
+    stale = ManifestEntry("gs://input/deleted.pdf", "hash", node_ids=["old"])
+    # Simple key-value stores don't write in batches
+    manifest = IndexManifest(kvstore, "namespace", batch_size=1)
+    manifest.put([stale])
+    published = []
+
+    async def extract_questions(doc, *args):
+        return [f"{doc.text}?"]
+
+    def create_index(li_docs, docstore, vector_store, embed_model, llm):
+        nodes = [
+            TextNode(text=doc.text, metadata=doc.metadata, embedding=[1.0] * 8)
+            for doc in li_docs
+        ]
+        docstore.add_documents(nodes)
+        vector_store.add(nodes)
+        return nodes, nodes
+
+    module = run_parse_embed_index
+    monkeypatch.setattr(module, "FIRESTORE_NAMESPACE", "namespace")
+    monkeypatch.setattr(module, "create_hierarchical_index", create_index)
+    monkeypatch.setattr(module, "aiplatform", SimpleNamespace(init=lambda **_: None))
+    monkeypatch.setattr(module, "get_vector_store", lambda *_: vector_store)
+    monkeypatch.setattr(module, "get_qa_vector_store", lambda: qa_vector_store)
+    monkeypatch.setattr(module, "FirestoreKVStore", lambda **_: kvstore)
+    monkeypatch.setattr(module, "FirestoreDocumentStore", lambda *_, **__: docstore)
+    monkeypatch.setattr(module, "VertexTextEmbedding", lambda **_: MockEmbedding(8))
+    monkeypatch.setattr(module, "Vertex", lambda **_: MockLLM())
+    monkeypatch.setattr(module, "IndexManifest", lambda *_: manifest)
+    monkeypatch.setattr(module, "DocAIParser", FakeParser)
+    downloader = SimpleNamespace(submit=lambda path: None)
+    monkeypatch.setattr(
+        module, "BlobDownloader", lambda *_, **__: contextlib.nullcontext(downloader)
+    )
+    monkeypatch.setattr(
+        module,
+        "iter_pdf_blobs",
+        lambda *_: [
+            SimpleNamespace(path=f"gs://input/{name}.pdf", content_hash=name)
+            for name in ["first", "broken"]
+        ],
+    )
+    monkeypatch.setattr(module, "extract_questions", extract_questions)
+    for step in ["update_bm25_index", "publish_local_vector_store"]:
+        monkeypatch.setattr(module, step, lambda *_, step=step: published.append(step))
+    monkeypatch.setattr(
+        module, "write_index_version", lambda *_: published.append("stamp")
+    )
+
+    with pytest.raises(RuntimeError, match="upsert failed"):
+        module.main()
+
+    assert published == []
+    # The indexed sources are removed again, and the stale entry restored
+    assert list(manifest.load().values()) == [stale]
+    assert docstore.docs == {}
+    assert len(vector_store) == 0
+    assert len(qa_vector_store) == 0
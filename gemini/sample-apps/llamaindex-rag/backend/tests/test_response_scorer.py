@@ -0,0 +1,59 @@
+import threading
+
+from backend.rag import response_scorer
+from backend.rag.response_scorer import ResponseScorer
+
+
+def make_scorer(monkeypatch, started, release, **kwargs):
+    def score(self, question, *args):
+        started.append(question)
+        release.wait(timeout=5)
+        return {"faithfulness": 1.0}
+
+    monkeypatch.setattr(ResponseScorer, "_score", score)
+    return ResponseScorer(max_workers=1, **kwargs)
+
+
+def submit(scorer, question):
+    return scorer.submit(question, "answer", ["context"], "judge", "embedding")
+
+
+def test_responses_are_skipped_while_too_many_are_pending(monkeypatch):
+    started, release = [], threading.Event()
+    scorer = make_scorer(monkeypatch, started, release, max_pending=2)
+    eval_ids = [submit(scorer, f"q{i}") for i in range(3)]
+
+    assert scorer.get_result(eval_ids[1])["status"] == "pending"
+    assert scorer.get_result(eval_ids[2])["status"] == "skipped"
+    release.set()
+    # The single worker runs this after the evaluations and their callbacks
+    scorer._executor.submit(lambda: None).result(timeout=5)
+    assert scorer.get_result(eval_ids[1])["faithfulness"] == 1.0
+    # Finished evaluations make room for new ones
+    assert scorer.get_result(submit(scorer, "q3"))["status"] != "skipped"
+
+
+def test_evicted_evaluations_are_cancelled(monkeypatch):
+    started, release = [], threading.Event()
+    scorer = make_scorer(monkeypatch, started, release, max_results=2)
+    eval_ids = [submit(scorer, f"q{i}") for i in range(4)]
+    release.set()
+    scorer._executor.shutdown(wait=True)
+
+    assert scorer.get_result(eval_ids[0]) is None
+    assert started == ["q0", "q2", "q3"]
+    assert scorer.get_result(eval_ids[3])["status"] == "completed"
+
+
+def test_judges_are_created_outside_the_scorer_lock(monkeypatch):
+    scorer = ResponseScorer()
+    lock_held = []
+
+    def bind_judge_metrics(metrics, eval_model_name, embedding_model_name):
+        lock_held.append(scorer._lock.locked())
+        return [eval_model_name]
+
+    monkeypatch.setattr(response_scorer, "bind_judge_metrics", bind_judge_metrics)
+    assert scorer.get_judge_metrics("judge", "embedding") == ["judge"]
+    assert scorer.get_judge_metrics("judge", "embedding") == ["judge"]
+    assert lock_held == [False]
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+from backend.rag import tracing
+from backend.rag.tracing import (
+    LLM_TOKENS,
+    LLMUsageEventHandler,
+    config_labels,
+    reported_tokens,
+)
+from llama_index.core.base.llms.types import CompletionResponse
+from llama_index.core.instrumentation.events.llm import LLMCompletionEndEvent
+
+
+def tokens(direction, llm):
+    labels = config_labels(llm, "baseline")
+    return LLM_TOKENS.labels(direction=direction, **labels)._value.get()
+
+
+def complete(llm, prompt, response, monkeypatch):
+    labels = config_labels(llm, "baseline")
+    monkeypatch.setattr(tracing, "_current_labels", lambda: labels)
+    LLMUsageEventHandler().handle(
+        LLMCompletionEndEvent(prompt=prompt, response=response)
+    )
+
+
+def test_reported_tokens_from_vertex_and_anthropic_responses():
+    usage_metadata = SimpleNamespace(prompt_token_count=120, candidates_token_count=30)
+    vertex_raw = {"_raw_response": SimpleNamespace(usage_metadata=usage_metadata)}
+    anthropic_raw = SimpleNamespace(
+        usage=SimpleNamespace(input_tokens=80, output_tokens=20)
+    )
+
+    assert reported_tokens(vertex_raw) == (120, 30)
+    assert reported_tokens(anthropic_raw) == (80, 20)
+    assert reported_tokens(None) is None
+    assert reported_tokens({}) is None
+
+
+def test_reported_tokens_are_counted_with_estimate_as_fallback(monkeypatch):
+    monkeypatch.setattr(tracing, "_enabled", True)
+    prompt_before = tokens("prompt", "gemini-1.5-pro")
+    completion_before = tokens("completion", "gemini-1.5-pro")
+    raw = SimpleNamespace(usage=SimpleNamespace(input_tokens=7, output_tokens=3))
+    complete(
+        "gemini-1.5-pro", "x" * 100, CompletionResponse(text="y", raw=raw), monkeypatch
+    )
+    assert tokens("prompt", "gemini-1.5-pro") == prompt_before + 7
+    assert tokens("completion", "gemini-1.5-pro") == completion_before + 3
+
+    complete("gemini-1.5-pro", "x" * 100, CompletionResponse(text="y" * 9), monkeypatch)
+    assert tokens("prompt", "gemini-1.5-pro") == prompt_before + 7 + 25
+    assert tokens("completion", "gemini-1.5-pro") == completion_before + 3 + 3
+
+
+def test_llm_label_is_one_of_a_fixed_set():
+    def llm(name):
+        return config_labels(name, "baseline")["llm"]
+
+    assert llm("gemini-1.5-flash") == "gemini-1.5-flash"
+    assert llm("claude-3-opus") == "claude-sonnet-3.5"
+    assert llm("gemini-2.0-made-up") == "other-gemini"
+    assert llm("x" * 1000) == "other"
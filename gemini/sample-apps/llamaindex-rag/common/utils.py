@@ -17,11 +17,18 @@
 """
 GCP Download utilities
 """
+import base64
+from collections.abc import Collection, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
 import os
+import queue
 import re
+import threading
 
 from google.cloud import storage
+import google_crc32c
 from llama_index.core.schema import NodeRelationship, RelatedNodeInfo
 import yaml
 
@@ -43,9 +50,10 @@ DATA_PATH = config["data_path"]
 
 
 class Blob:
-    def __init__(self, path: str, mimetype: str):
+    def __init__(self, path: str, mimetype: str, content_hash: str | None = None):
         self.path = path
         self.mimetype = mimetype
+        self.content_hash = content_hash
 
 
 def download_blob(bucket_name, source_blob_name, destination_file_name):
@@ -76,15 +84,113 @@ def download_blob(bucket_name, source_blob_name, destination_file_name):
     )
 
 
+def iter_bucket_blobs(
+    bucket_name: str,
+    prefix: str,
+    delimiter: str | None = None,
+    suffixes: tuple[str, ...] = (),
+    mimetypes: tuple[str, ...] = (),
+    max_results: int | None = None,
+    page_size: int = 1000,
+) -> Iterator[storage.Blob]:
+    """
+    Yields the blobs under `prefix` as each page of the listing arrives,
+    so their processing starts before the whole bucket is listed. With
+    `suffixes` or `mimetypes`, only blobs whose name ends with one of the
+    (lowercase) suffixes or whose content type is one of the mimetypes
+    are yielded.
+    """
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    for blob in bucket.list_blobs(
+        prefix=prefix,
+        delimiter=delimiter,
+        max_results=max_results,
+        page_size=page_size,
+    ):
+        if (suffixes or mimetypes) and not (
+            blob.name.lower().endswith(suffixes) or blob.content_type in mimetypes
+        ):
+            continue
+        yield blob
+
+
+class BlobDownloader:
+    """
+    Downloads blobs on a pool of worker threads as they are submitted,
+    e.g. while the bucket is still being listed. At most `max_queued` blobs
+    wait for a worker, so a fast lister is throttled instead of queueing a
+    whole bucket in memory. Downloads are waited for on `close`.
+
+    The filename of each blob once downloaded is its name joined to
+    `destination_directory`, like transfer_manager.download_many_to_path.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        destination_directory: str = "",
+        workers: int = 8,
+        max_queued: int = 256,
+    ):
+        self.destination_directory = destination_directory
+        self.downloaded = 0
+        self.failed: dict[str, Exception] = {}
+        self._bucket = storage.Client().bucket(bucket_name)
+        self._queue: queue.Queue[str | None] = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._download_worker, daemon=True)
+            for _ in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, blob_name: str) -> None:
+        """Queues a blob for download, blocking while the queue is full"""
+        # Folder placeholders have nothing to download
+        if not blob_name.endswith("/"):
+            self._queue.put(blob_name)
+
+    def _download_worker(self) -> None:
+        while (blob_name := self._queue.get()) is not None:
+            path = os.path.join(self.destination_directory, blob_name)
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                self._bucket.blob(blob_name).download_to_filename(path)
+            except Exception as e:
+                logger.info(f"Failed to download {blob_name} due to exception: {e}")
+                with self._lock:
+                    self.failed[blob_name] = e
+            else:
+                logger.info(f"Downloaded {blob_name} to {path}.")
+                with self._lock:
+                    self.downloaded += 1
+
+    def close(self) -> None:
+        """Waits for the queued downloads to finish"""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def __enter__(self) -> "BlobDownloader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
 def download_bucket_with_transfer_manager(
     bucket_name,
     prefix,
     delimiter=None,
     destination_directory="",
     workers=8,
-    max_results=1000,
+    max_results=None,
+    blob_names=None,
 ):
-    """Download all of the blobs in a bucket, concurrently in a process pool.
+    """Download all of the blobs in a bucket, concurrently in a thread pool.
 
     The filename of each blob once downloaded is derived from the blob name and
     the `destination_directory `parameter. For complete control of the filename
@@ -105,49 +211,27 @@ def download_bucket_with_transfer_manager(
     # intended for unsanitized end user input.
     # destination_directory = ""
 
-    # The maximum number of processes to use for the operation. The performance
-    # impact of this value depends on the use case, but smaller files usually
-    # benefit from a higher number of processes. Each additional process occupies
-    # some CPU and memory resources until finished. Threads can be used instead
-    # of processes by passing `worker_type=transfer_manager.THREAD`.
+    # The maximum number of threads to use for the operation. Small files
+    # usually benefit from a higher number of threads.
     # workers=8
 
-    # The maximum number of results to fetch from bucket.list_blobs(). This
-    # sample code fetches all of the blobs up to max_results and queues them all
-    # for download at once. Though they will still be executed in batches up to
-    # the processes limit, queueing them all at once can be taxing on system
-    # memory if buckets are very large. Adjust max_results as needed for your
-    # system environment, or set it to None if you are sure the bucket is not
-    # too large to hold in memory easily.
-    # max_results=1000
+    # The maximum number of blobs to download, None for the whole prefix. The
+    # bucket is listed page by page, and downloads start with the first page.
+    # max_results=None
 
-    from google.cloud.storage import transfer_manager
+    # Pass `blob_names` to download only those blobs instead of listing `prefix`.
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-
-    blob_names = [
-        blob.name
-        for blob in bucket.list_blobs(
-            prefix=prefix, delimiter=delimiter, max_results=max_results
-        )
-    ]
-
-    results = transfer_manager.download_many_to_path(
-        bucket,
-        blob_names,
-        destination_directory=destination_directory,
-        max_workers=workers,
-    )
-
-    for name, result in zip(blob_names, results):
-        # The results list is either `None` or an exception for each blob in
-        # the input list, in order.
-
-        if isinstance(result, Exception):
-            logger.info(f"Failed to download {name} due to exception: {result}")
-        else:
-            logger.info(f"Downloaded {name} to {destination_directory + name}.")
+    with BlobDownloader(bucket_name, destination_directory, workers) as downloader:
+        if blob_names is None:
+            blob_names = (
+                blob.name
+                for blob in iter_bucket_blobs(
+                    bucket_name, prefix, delimiter=delimiter, max_results=max_results
+                )
+            )
+        for blob_name in blob_names:
+            downloader.submit(blob_name)
+    return downloader
 
 
 def link_nodes(node_list):
@@ -166,37 +250,125 @@ def link_nodes(node_list):
     return node_list
 
 
-def create_pdf_blob_list(bucket_name, prefix):
+def iter_pdf_blobs(bucket_name, prefix) -> Iterator[Blob]:
     """
-    Create a list of Blob objects for processing.
+    Yields a Blob for each PDF under `prefix` as the bucket is listed.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=prefix)
-    logger.info(blobs)
-    return [
-        Blob(
+    for blob in iter_bucket_blobs(
+        bucket_name, prefix, suffixes=(".pdf",), mimetypes=("application/pdf",)
+    ):
+        yield Blob(
             path=f"gs://{bucket_name}/{blob.name}",
             mimetype=blob.content_type or "application/pdf",
+            # Composite objects have no MD5 hash, only a CRC32C checksum
+            content_hash=blob.md5_hash or blob.crc32c,
         )
-        for blob in blobs
-        if blob.name.lower().endswith(".pdf")
-    ]
 
 
-def upload_directory_to_gcs(local_dir_path: str, bucket_name: str, prefix: str):
+def create_pdf_blob_list(bucket_name, prefix):
+    """
+    Create a list of Blob objects for processing.
+    """
+    return list(iter_pdf_blobs(bucket_name, prefix))
+
+
+def file_matches_blob(local_file_path: str, blob) -> bool:
+    """
+    Whether a local file has the same content as a GCS blob. Files are
+    compared by MD5 hash, or by CRC32C checksum for composite objects,
+    which have no MD5 hash.
+    """
+    if blob.size is not None and blob.size != os.path.getsize(local_file_path):
+        return False
+    if blob.md5_hash:
+        checksum, expected = hashlib.md5(), blob.md5_hash
+    elif blob.crc32c:
+        checksum, expected = google_crc32c.Checksum(), blob.crc32c
+    else:
+        return False
+    with open(local_file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(block)
+    return base64.b64encode(checksum.digest()).decode() == expected
+
+
+def upload_directory_to_gcs(
+    local_dir_path: str,
+    bucket_name: str,
+    prefix: str,
+    workers: int = 16,
+    skip_unchanged: bool = True,
+    resumable_threshold: int = 32 * 1024 * 1024,
+    chunk_size: int = 8 * 1024 * 1024,
+    exclude: Collection[str] = (),
+) -> int:
+    """
+    Uploads the files under `local_dir_path` to `prefix` concurrently and
+    returns the number of files uploaded.
+
+    With `skip_unchanged`, files whose checksum matches the blob already
+    stored under the same name are skipped. Files of `resumable_threshold`
+    bytes or more are sent as resumable uploads in chunks of `chunk_size`
+    bytes (a multiple of 256 KiB), so a failed chunk is retried on its own.
+    Files whose path relative to `local_dir_path` is in `exclude` are skipped.
+    """
+    from google.cloud.storage import transfer_manager
+
     storage_client = storage.Client()
     bucket = storage_client.bucket(bucket_name)
 
-    for root, dirs, files in os.walk(local_dir_path):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_file_path, local_dir_path)
-            gcs_blob_name = f"{prefix}/{relative_path}"
+    relative_paths = [
+        os.path.relpath(os.path.join(root, file), local_dir_path)
+        for root, dirs, filenames in os.walk(local_dir_path)
+        for file in filenames
+    ]
+    files = [
+        (os.path.join(local_dir_path, path), f"{prefix}/{path}")
+        for path in relative_paths
+        if path not in exclude
+    ]
+    existing = (
+        {blob.name: blob for blob in bucket.list_blobs(prefix=f"{prefix}/")}
+        if skip_unchanged
+        else {}
+    )
+
+    def is_unchanged(local_file_path: str, gcs_blob_name: str) -> bool:
+        blob = existing.get(gcs_blob_name)
+        return blob is not None and file_matches_blob(local_file_path, blob)
 
-            blob = bucket.blob(gcs_blob_name)
-            blob.upload_from_filename(local_file_path)
-            print(f"File {local_file_path} uploaded to {gcs_blob_name}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        unchanged = list(executor.map(lambda f: is_unchanged(*f), files))
+
+    file_blob_pairs = []
+    for (local_file_path, gcs_blob_name), skip in zip(files, unchanged):
+        if skip:
+            continue
+        blob = bucket.blob(gcs_blob_name)
+        if os.path.getsize(local_file_path) >= resumable_threshold:
+            blob.chunk_size = chunk_size
+        file_blob_pairs.append((local_file_path, blob))
+
+    results = transfer_manager.upload_many(
+        file_blob_pairs,
+        max_workers=workers,
+        worker_type=transfer_manager.THREAD,
+    )
+    # The results list is either `None` or an exception for each file, in order
+    errors = []
+    for (local_file_path, blob), result in zip(file_blob_pairs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to upload {local_file_path}: {result}")
+            errors.append(result)
+    logger.info(
+        f"Uploaded {len(file_blob_pairs) - len(errors)} files to "
+        f"gs://{bucket_name}/{prefix}, {len(files) - len(file_blob_pairs)} "
+        "unchanged files skipped"
+    )
+    if errors:
+        # Callers publish manifests after uploading, so never fail silently
+        raise errors[0]
+    return len(file_blob_pairs)
 
 
 def clean_text(text):
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 
@@ -61,8 +62,7 @@ def verify_user_input(
             )
 
 
-# Function to query FastAPI backend
-def query_fastapi(
+def build_query_payload(
     query,
     llm_name,
     temperature,
@@ -75,8 +75,7 @@ def query_fastapi(
     hybrid_retrieval,
     evaluate_response,
 ):
-    url = f"{config['fastapi_url']}/query_rag"
-    payload = {
+    return {
         "query": query,
         "llm_name": llm_name,
         "temperature": temperature,
@@ -92,6 +91,12 @@ def query_fastapi(
         "eval_model_name": "gemini-1.5-flash",
         "embedding_model_name": "text-embedding-004",
     }
+
+
+# Function to query FastAPI backend
+def query_fastapi(*args):
+    url = f"{config['fastapi_url']}/query_rag"
+    payload = build_query_payload(*args)
     headers = {"accept": "application/json", "Content-Type": "application/json"}
 
     # Adding debug statements
@@ -116,6 +121,58 @@ def query_fastapi(
     return None
 
 
+def iter_sse_events(response):
+    """Parses a Server-Sent Events stream into (event, data) tuples."""
+    event, data_lines = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if event is not None:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = None, []
+        elif line.startswith("event:"):
+            event = line[len("event:") :].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:") :].strip())
+
+
+def stream_fastapi(stream_state, *args):
+    """
+    Streams the answer from the /query_rag_stream endpoint token by token.
+    Retrieved chunks and the final payload (response, eval_id) are stored
+    in stream_state as they arrive.
+    """
+    url = f"{config['fastapi_url']}/query_rag_stream"
+    payload = build_query_payload(*args)
+    cloud_logger.debug(f"URL: {url}")
+    cloud_logger.debug(f"Payload: {payload}")
+
+    with requests.post(
+        url,
+        json=payload,
+        headers={"accept": "text/event-stream"},
+        stream=True,
+        timeout=180,
+    ) as response:
+        response.raise_for_status()
+        for event, data in iter_sse_events(response):
+            if event == "sources":
+                stream_state.update(data)
+            elif event == "token":
+                yield data["delta"]
+            elif event == "done":
+                stream_state.update(data)
+            elif event == "error":
+                stream_state["error"] = data["detail"]
+
+
+def fetch_eval_results(eval_id, wait=60):
+    """Long-polls the backend for the background RAGAS scores of a response."""
+    url = f"{config['fastapi_url']}/eval_results/{eval_id}"
+    response = requests.get(url, params={"wait": wait}, timeout=wait + 30)
+    response.raise_for_status()
+    return response.json()
+
+
 def extract_top_titles_and_content(response, num_chunks=3):
     if response and "retrieved_chunks" in response:
         chunks = []
@@ -315,6 +372,7 @@ use_refine = st.sidebar.checkbox("🔬 Use Refine", value=True)
 use_node_rerank = st.sidebar.checkbox("🔄 Use Node Rerank", value=True)
 use_react = st.sidebar.checkbox("🕵️‍♂️ Use Agent ReAct", value=True)
 evaluate_response = st.sidebar.checkbox("✅ Evaluate Response", value=True)
+stream_response = st.sidebar.checkbox("⚡ Stream Response", value=True)
 
 st.sidebar.markdown("#### Enhancements")
 qa_followup = st.sidebar.checkbox("Query Questions Answered Index", value=True)
@@ -366,7 +424,7 @@ with chat_col:
                             qa_followup=qa_followup,
                             hybrid_retrieval=hybrid_retrieval,
                         )
-                        response = query_fastapi(
+                        query_args = (
                             prompt,
                             llm_name,
                             temperature,
@@ -379,23 +437,22 @@ with chat_col:
                             hybrid_retrieval,
                             evaluate_response,
                         )
+                        if stream_response:
+                            response = {}
+                            st.write_stream(stream_fastapi(response, *query_args))
+                            if "error" in response:
+                                st.error(response["error"])
+                                response = None
+                        else:
+                            response = query_fastapi(*query_args)
 
                         if response is not None:
                             assistant_response = response.get(
                                 "response",
                                 "No response content received from the server.",
                             )
-                            st.markdown(assistant_response)
-                            if evaluate_response:
-                                st.session_state.metrics = {
-                                    "Answer Relevancy": response.get(
-                                        "answer_relevancy", "N/A"
-                                    ),
-                                    "Faithfulness": response.get("faithfulness", "N/A"),
-                                    "Context Relevancy": response.get(
-                                        "context_relevancy", "N/A"
-                                    ),
-                                }
+                            if not stream_response:
+                                st.markdown(assistant_response)
                             # st.session_state.top_titles = extract_top_titles(response)
                             st.session_state.chunks = extract_top_titles_and_content(
                                 response
@@ -403,6 +460,23 @@ with chat_col:
                             st.session_state.messages.append(
                                 {"role": "assistant", "content": assistant_response}
                             )
+                            if evaluate_response and "eval_id" in response:
+                                # Scores are computed in the background after the answer is shown
+                                with st.spinner("Evaluating response..."):
+                                    eval_results = fetch_eval_results(
+                                        response["eval_id"]
+                                    )
+                                st.session_state.metrics = {
+                                    "Answer Relevancy": eval_results.get(
+                                        "answer_relevancy", "N/A"
+                                    ),
+                                    "Faithfulness": eval_results.get(
+                                        "faithfulness", "N/A"
+                                    ),
+                                    "Context Relevancy": eval_results.get(
+                                        "context_relevancy", "N/A"
+                                    ),
+                                }
                         else:
                             st.error(
                                 "Failed to get a response from the server. Please check the server status and try again."
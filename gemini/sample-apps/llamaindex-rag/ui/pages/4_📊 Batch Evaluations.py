@@ -2,6 +2,7 @@ import json
 import logging
 import os
 from tempfile import NamedTemporaryFile
+import time
 
 import altair as alt
 from google.cloud import storage
@@ -50,7 +51,7 @@ def upload_to_gcs(source_file_name, destination_blob_name):
         raise
 
 
-# Function to call the batch evaluation API
+# Function to start a batch evaluation job
 def call_eval_batch_api(payload):
     url = f"{config['fastapi_url']}/eval_batch"
     headers = {"accept": "application/json", "Content-Type": "application/json"}
@@ -82,6 +83,33 @@ def call_eval_batch_api(payload):
     return None
 
 
+# Function to fetch the status (and optionally results) of a batch evaluation job
+def get_eval_batch_status(job_id, include_results=False):
+    url = f"{config['fastapi_url']}/eval_batch/{job_id}"
+    response = requests.get(
+        url, params={"include_results": include_results}, timeout=60
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+# Function to poll a batch evaluation job until it finishes
+def wait_for_eval_batch(job_status, poll_interval=5):
+    progress_bar = st.progress(0.0, text="Queued...")
+    while job_status["status"] in ("queued", "running"):
+        total_rows = job_status.get("total_rows") or 0
+        if total_rows:
+            progress_bar.progress(
+                job_status.get("scored_rows", 0) / total_rows,
+                text=f"Answered {job_status.get('answered_rows', 0)}/{total_rows}, "
+                f"scored {job_status.get('scored_rows', 0)}/{total_rows} questions",
+            )
+        time.sleep(poll_interval)
+        job_status = get_eval_batch_status(job_status["job_id"])
+    progress_bar.empty()
+    return job_status
+
+
 # Set up Streamlit page configuration
 st.set_page_config(
     layout="wide", page_title="RAG Batch Evaluation", page_icon=":robot_face:"
@@ -117,6 +145,7 @@ st.sidebar.markdown("#### 🔧 Advanced Options")
 use_hyde = st.sidebar.checkbox("🧠 Use HYDE", value=True)
 use_refine = st.sidebar.checkbox("🔬 Use Refine", value=True)
 use_node_rerank = st.sidebar.checkbox("🔄 Use Node Rerank", value=True)
+write_to_bq = st.sidebar.checkbox("🗃️ Write Results to BigQuery", value=False)
 
 st.sidebar.markdown("---")
 st.sidebar.warning("🚀 Powered by Google's Gemini ♊ Models & LlamaIndex🦙📊!")
@@ -156,12 +185,26 @@ if uploaded_file is not None:
             "embedding_model_name": "text-embedding-004",
             "input_eval_dataset_bucket_uri": gcs_uri,
             "bq_eval_results_table_id": "eval_results.eval_results_table",
+            "write_to_bq": write_to_bq,
             "ragas_metrics": ["faithfulness", "answer_relevancy"],
         }
 
-        # Call the API and get the response
-        with st.spinner("Evaluating... This may take a few minutes."):
-            response = call_eval_batch_api(payload)
+        # Start the evaluation job and wait for it to finish
+        response = None
+        job_status = call_eval_batch_api(payload)
+        if job_status:
+            st.info(f"Evaluation job {job_status['job_id']} started")
+            with st.spinner("Evaluating... This may take a few minutes."):
+                job_status = wait_for_eval_batch(job_status)
+            if job_status["status"] == "completed":
+                response = get_eval_batch_status(
+                    job_status["job_id"], include_results=True
+                )["results"]
+            else:
+                st.error(
+                    f"Evaluation job {job_status['status']}: {job_status.get('error')}. "
+                    "Upload the same file again to resume it."
+                )
 
         if response:
             st.success("Evaluation completed!")
@@ -1,11 +1,20 @@
-from collections.abc import Iterable
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import glob
+import hashlib
+import io
+import itertools
+import multiprocessing
 import os
+import sqlite3
+import threading
 import time
 from typing import Any
+import weakref
 
 from IPython.display import display
-import PIL
+import PIL.Image
 from colorama import Fore, Style
 import fitz
 import numpy as np
@@ -20,10 +29,276 @@ from vertexai.language_models import TextEmbeddingModel
 from vertexai.vision_models import Image as vision_model_Image
 from vertexai.vision_models import MultiModalEmbeddingModel
 
-text_embedding_model = TextEmbeddingModel.from_pretrained("textembedding-gecko@latest")
-multimodal_embedding_model = MultiModalEmbeddingModel.from_pretrained(
-    "multimodalembedding@001"
+TEXT_EMBEDDING_MODEL_NAME = "textembedding-gecko@latest"
+MULTIMODAL_EMBEDDING_MODEL_NAME = "multimodalembedding@001"
+
+# Model clients are created on first use, so that importing this module (e.g. in
+# the PDF parsing worker processes) doesn't create gRPC clients
+_embedding_models: dict[str, Any] = {}
+_embedding_models_lock = threading.Lock()
+
+
+def get_text_embedding_model() -> TextEmbeddingModel:
+    """Returns the shared text embedding model client, creating it on first use."""
+    with _embedding_models_lock:
+        if "text" not in _embedding_models:
+            _embedding_models["text"] = TextEmbeddingModel.from_pretrained(
+                TEXT_EMBEDDING_MODEL_NAME
+            )
+        return _embedding_models["text"]
+
+
+def get_multimodal_embedding_model() -> MultiModalEmbeddingModel:
+    """Returns the shared multimodal embedding model client, creating it on first use."""
+    with _embedding_models_lock:
+        if "multimodal" not in _embedding_models:
+            _embedding_models["multimodal"] = MultiModalEmbeddingModel.from_pretrained(
+                MULTIMODAL_EMBEDDING_MODEL_NAME
+            )
+        return _embedding_models["multimodal"]
+
+
+def __getattr__(name: str) -> Any:
+    # Keeps the former module-level clients available, created lazily
+    if name == "text_embedding_model":
+        return get_text_embedding_model()
+    if name == "multimodal_embedding_model":
+        return get_multimodal_embedding_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Suggested location of the on-disk embedding cache, see `set_embedding_cache`
+EMBEDDING_CACHE_PATH = os.path.expanduser(
+    "~/.cache/intro_multimodal_rag/embeddings.sqlite"
 )
+# Default maximum number of cached embeddings, about 150 MB of 768-dimensional
+# float32 vectors
+EMBEDDING_CACHE_MAX_ENTRIES = 50_000
+
+# Maximum number of texts sent in a single text embedding request
+TEXT_EMBEDDING_BATCH_SIZE = 64
+# Maximum total characters of the texts in a single text embedding request, about
+# 15,000 tokens, which keeps requests under the API's per-request token limit
+TEXT_EMBEDDING_BATCH_MAX_CHARS = 60_000
+
+# Columns of the text and image metadata DataFrames
+TEXT_METADATA_COLUMNS = [
+    "file_name",
+    "page_num",
+    "text",
+    "text_embedding_page",
+    "chunk_number",
+    "chunk_text",
+    "text_embedding_chunk",
+]
+TEXT_METADATA_EMBEDDING_COLUMNS = ["text_embedding_page", "text_embedding_chunk"]
+IMAGE_METADATA_COLUMNS = [
+    "file_name",
+    "page_num",
+    "img_num",
+    "img_path",
+    "img_desc",
+    "mm_embedding_from_img_only",
+    "text_embedding_from_image_description",
+]
+IMAGE_METADATA_EMBEDDING_COLUMNS = [
+    "mm_embedding_from_img_only",
+    "text_embedding_from_image_description",
+]
+
+# File names used by MetadataWriter and load_document_metadata
+TEXT_METADATA_FILE = "text_metadata.arrow"
+IMAGE_METADATA_FILE = "image_metadata.arrow"
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket used to stay within an API's requests-per-minute quota.
+
+    Tokens refill continuously at `requests_per_minute / 60` per second up to `burst`,
+    and `acquire` blocks until a token is available.
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int | None = None) -> None:
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive.")
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst or max(1, int(self.rate)))
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Blocks until `tokens` tokens are available and consumes them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last_refill) * self.rate
+                )
+                self._last_refill = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class EmbeddingCache:
+    """
+    Persistent SQLite cache of embeddings keyed by model name, dimension and content hash.
+
+    Embeddings are stored as float32. The cache holds at most `max_entries` embeddings
+    and evicts the least recently used ones when it grows beyond that. Hit and miss
+    counts are available from `stats`.
+    """
+
+    # Bumped when the stored format changes, which clears older caches
+    SCHEMA_VERSION = 1
+
+    def __init__(
+        self, path: str, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES
+    ) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            (schema_version,) = self._connection.execute(
+                "PRAGMA user_version"
+            ).fetchone()
+            if schema_version != self.SCHEMA_VERSION:
+                # Earlier versions stored float64 embeddings
+                self._connection.execute("DROP TABLE IF EXISTS embeddings")
+                self._connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+
+    @staticmethod
+    def make_key(model_name: str, dimension: int | None, content: str | bytes) -> str:
+        """Builds the cache key of an embedding from its model, dimension and content."""
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        content_hash = hashlib.sha256(content).hexdigest()
+        return f"{model_name}:{dimension or 'default'}:{content_hash}"
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """Returns the cached embeddings for the given keys, skipping missing ones."""
+        found: dict[str, list[float]] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start : start + 500]
+                rows = self._connection.execute(
+                    "SELECT key, embedding FROM embeddings WHERE key IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                found.update(
+                    (key, np.frombuffer(embedding, dtype=np.float32).tolist())
+                    for key, embedding in rows
+                )
+            if found:
+                now = time.time()
+                with self._connection:
+                    self._connection.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(now, key) for key in found],
+                    )
+            hits = sum(key in found for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def get(self, key: str) -> list[float] | None:
+        """Returns the cached embedding for a key, or None."""
+        return self.get_many([key]).get(key)
+
+    def put_many(self, embeddings: dict[str, list[float]]) -> None:
+        """Stores embeddings and evicts the least recently used ones above `max_entries`."""
+        if not embeddings:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) "
+                "VALUES (?, ?, ?)",
+                [
+                    (key, np.asarray(embedding, dtype=np.float32).tobytes(), now)
+                    for key, embedding in embeddings.items()
+                ],
+            )
+            (num_entries,) = self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+            if num_entries > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings "
+                    "ORDER BY last_used LIMIT ?)",
+                    (num_entries - self.max_entries,),
+                )
+
+    def put(self, key: str, embedding: list[float]) -> None:
+        """Stores one embedding."""
+        self.put_many({key: embedding})
+
+    def stats(self) -> dict[str, Any]:
+        """Returns the hit and miss counts and the number of cached embeddings."""
+        with self._lock:
+            (num_entries,) = self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": num_entries,
+            }
+
+    def close(self) -> None:
+        """Closes the SQLite connection."""
+        with self._lock:
+            self._connection.close()
+
+
+_embedding_cache: EmbeddingCache | None = None
+
+
+def set_embedding_cache(
+    path: str | None = None, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES
+) -> EmbeddingCache | None:
+    """
+    Configures the embedding cache used by the embedding helpers. Caching is off
+    until this is called with a path, e.g. `set_embedding_cache(EMBEDDING_CACHE_PATH)`.
+
+    Args:
+        path: The SQLite file of the cache, or None to disable caching.
+        max_entries: The maximum number of cached embeddings.
+
+    Returns:
+        The new EmbeddingCache, or None if caching is disabled.
+    """
+    global _embedding_cache
+    if _embedding_cache:
+        _embedding_cache.close()
+    _embedding_cache = EmbeddingCache(path, max_entries) if path else None
+    return _embedding_cache
+
+
+def get_embedding_cache() -> EmbeddingCache | None:
+    """Returns the embedding cache, or None if caching is disabled."""
+    return _embedding_cache
 
 
 # Functions for getting text and image embeddings
@@ -46,8 +321,7 @@ def get_text_embedding_from_text_embedding_model(
                                The format (list or NumPy array) depends on the
                                value of the 'return_array' parameter.
     """
-    embeddings = text_embedding_model.get_embeddings([text])
-    text_embedding = [embedding.values for embedding in embeddings][0]
+    text_embedding = get_text_embeddings_from_text_embedding_model([text])[0]
 
     if return_array:
         return np.fromiter(text_embedding, dtype=float)
@@ -56,11 +330,79 @@ def get_text_embedding_from_text_embedding_model(
     return text_embedding
 
 
+def iter_text_batches(
+    texts: list[str], batch_size: int, max_chars: int
+) -> Iterator[list[int]]:
+    """
+    Groups texts into batches of at most `batch_size` texts and `max_chars` total
+    characters, yielding the indices of each batch. A text longer than `max_chars`
+    is sent in a batch of its own.
+    """
+    batch: list[int] = []
+    batch_chars = 0
+    for i, text in enumerate(texts):
+        if batch and (len(batch) >= batch_size or batch_chars + len(text) > max_chars):
+            yield batch
+            batch, batch_chars = [], 0
+        batch.append(i)
+        batch_chars += len(text)
+    if batch:
+        yield batch
+
+
+def get_text_embeddings_from_text_embedding_model(
+    texts: list[str],
+    batch_size: int = TEXT_EMBEDDING_BATCH_SIZE,
+    rate_limiter: RateLimiter | None = None,
+    max_batch_chars: int = TEXT_EMBEDDING_BATCH_MAX_CHARS,
+) -> list[list[float]]:
+    """
+    Generates text embeddings for a list of texts, sending up to `batch_size` texts and
+    `max_batch_chars` characters per request.
+
+    Args:
+        texts: The input text strings to be embedded.
+        batch_size: The maximum number of texts per embedding request.
+        rate_limiter: Optional RateLimiter acquired once per request.
+        max_batch_chars: The maximum total characters of the texts per request.
+
+    Returns:
+        A list of 768-dimensional embeddings in the same order as `texts`.
+        Embeddings found in the embedding cache are not requested again.
+    """
+    embedding_cache = get_embedding_cache()
+    keys = [
+        EmbeddingCache.make_key(TEXT_EMBEDDING_MODEL_NAME, None, text) for text in texts
+    ]
+    cached = embedding_cache.get_many(keys) if embedding_cache else {}
+
+    # Request each distinct uncached text once
+    missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+    missing_keys = list(missing)
+    missing_texts = list(missing.values())
+    for batch in iter_text_batches(missing_texts, batch_size, max_batch_chars):
+        batch_keys = [missing_keys[i] for i in batch]
+        if rate_limiter:
+            rate_limiter.acquire()
+        embeddings = get_text_embedding_model().get_embeddings(
+            [missing[key] for key in batch_keys]
+        )
+        new_embeddings = {
+            key: embedding.values for key, embedding in zip(batch_keys, embeddings)
+        }
+        if embedding_cache:
+            embedding_cache.put_many(new_embeddings)
+        cached.update(new_embeddings)
+
+    return [cached[key] for key in keys]
+
+
 def get_image_embedding_from_multimodal_embedding_model(
-    image_uri: str,
+    image_uri: str = "",
     embedding_size: int = 512,
     text: str | None = None,
     return_array: bool | None = False,
+    image_bytes: bytes | None = None,
 ) -> list:
     """Extracts an image embedding from a multimodal embedding model.
     The function can optionally utilize contextual text to refine the embedding.
@@ -71,19 +413,45 @@ def get_image_embedding_from_multimodal_embedding_model(
         embedding_size (int): The desired dimensionality of the output embedding. Defaults to 512.
         return_array (Optional[bool]): If True, returns the embedding as a NumPy array.
         Otherwise, returns a list. Defaults to False.
+        image_bytes (Optional[bytes]): Encoded image to embed instead of reading `image_uri`.
 
     Returns:
         list: A list containing the image embedding values. If `return_array` is True, returns a NumPy array instead.
     """
-    image = vision_model_Image.load_from_file(image_uri)
-    embeddings = multimodal_embedding_model.get_embeddings(
-        image=image, contextual_text=text, dimension=embedding_size
-    )  # 128, 256, 512, 1408
+    embedding_cache = get_embedding_cache()
+    image_embedding = None
+    if embedding_cache:
+        # Local images are keyed by their bytes, remote ones by their URI
+        if image_bytes is not None:
+            content = image_bytes
+        elif os.path.isfile(image_uri):
+            with open(image_uri, "rb") as f:
+                content = f.read()
+        else:
+            content = image_uri.encode("utf-8")
+        key = EmbeddingCache.make_key(
+            MULTIMODAL_EMBEDDING_MODEL_NAME,
+            embedding_size,
+            content + b"\0" + (text or "").encode("utf-8"),
+        )
+        image_embedding = embedding_cache.get(key)
+
+    if image_embedding is None:
+        if image_bytes is not None:
+            image = vision_model_Image(image_bytes=image_bytes)
+        else:
+            image = vision_model_Image.load_from_file(image_uri)
+        embeddings = get_multimodal_embedding_model().get_embeddings(
+            image=image, contextual_text=text, dimension=embedding_size
+        )  # 128, 256, 512, 1408
+        image_embedding = embeddings.image_embedding
+        if embedding_cache:
+            embedding_cache.put(key, image_embedding)
 
     if return_array:
-        return np.fromiter(embeddings.image_embedding, dtype=float)
+        return np.fromiter(image_embedding, dtype=float)
 
-    return embeddings.image_embedding
+    return image_embedding
 
 
 def get_text_overlapping_chunk(
@@ -151,11 +519,11 @@ def get_page_text_embedding(text_data: dict | str) -> dict:
         return embeddings_dict
 
     if isinstance(text_data, dict):
-        # Process each chunk
-        for chunk_number, chunk_value in text_data.items():
-            embeddings_dict[
-                chunk_number
-            ] = get_text_embedding_from_text_embedding_model(text=chunk_value)
+        # Process all chunks in batched requests
+        chunk_embeddings = get_text_embeddings_from_text_embedding_model(
+            list(text_data.values())
+        )
+        embeddings_dict = dict(zip(text_data.keys(), chunk_embeddings))
     else:
         # Process the first 1000 characters of the page text
         embeddings_dict[
@@ -165,6 +533,30 @@ def get_page_text_embedding(text_data: dict | str) -> dict:
     return embeddings_dict
 
 
+def get_page_text_and_chunks(
+    page: fitz.Page, character_limit: int = 1000, overlap: int = 100
+) -> tuple[str, dict]:
+    """
+    Extracts the text from a page object and chunks it, without generating embeddings.
+
+    Args:
+        page: The fitz.Page object to process.
+        character_limit: Maximum characters per chunk (defaults to 1000).
+        overlap: Number of overlapping characters between chunks (defaults to 100).
+
+    Returns:
+        A tuple containing the extracted page text and the chunked text dictionary.
+    """
+
+    # Extract text from the page
+    text: str = page.get_text().encode("ascii", "ignore").decode("utf-8", "ignore")
+
+    # Chunk the text with the given limit and overlap
+    chunked_text_dict: dict = get_text_overlapping_chunk(text, character_limit, overlap)
+
+    return text, chunked_text_dict
+
+
 def get_chunk_text_metadata(
     page: fitz.Page,
     character_limit: int = 1000,
@@ -197,15 +589,12 @@ def get_chunk_text_metadata(
     if overlap > character_limit:
         raise ValueError("Overlap cannot be larger than character limit.")
 
-    # Extract text from the page
-    text: str = page.get_text().encode("ascii", "ignore").decode("utf-8", "ignore")
+    # Extract and chunk the text from the page
+    text, chunked_text_dict = get_page_text_and_chunks(page, character_limit, overlap)
 
     # Get whole-page text embeddings
     page_text_embeddings_dict: dict = get_page_text_embedding(text)
 
-    # Chunk the text with the given limit and overlap
-    chunked_text_dict: dict = get_text_overlapping_chunk(text, character_limit, overlap)
-
     # Get embeddings for the chunks
     chunk_embeddings_dict: dict = get_page_text_embedding(chunked_text_dict)
 
@@ -217,32 +606,67 @@ def get_image_for_gemini(
     doc: fitz.Document,
     image: tuple,
     image_no: int,
-    image_save_dir: str,
+    image_save_dir: str | None,
     file_name: str,
     page_num: int,
-) -> tuple[Image, str]:
+) -> tuple[Image, str | None]:
     """
-    Extracts an image from a PDF document, converts it to JPEG format, saves it to a specified directory,
-    and loads it as a PIL Image Object.
+    Extracts an image from a PDF document, converts it to JPEG format, optionally saves it to a specified directory,
+    and loads it as a Gemini Image Object from the encoded bytes.
 
     Parameters:
     - doc (fitz.Document): The PDF document from which the image is extracted.
     - image (tuple): A tuple containing image information.
     - image_no (int): The image number for naming purposes.
-    - image_save_dir (str): The directory where the image will be saved.
+    - image_save_dir (str | None): The directory where the image will be saved, or None to keep it in memory only.
     - file_name (str): The base name for the image file.
     - page_num (int): The page number from which the image is extracted.
 
     Returns:
-    - Tuple[Image.Image, str]: A tuple containing the Gemini Image object and the image filename.
+    - Tuple[Image.Image, str | None]: A tuple containing the Gemini Image object and the image filename (None if not saved).
     """
 
+    # Extract the image from the document and convert it to JPEG format once
+    image_bytes = get_image_bytes_from_pdf(doc, image)
+
+    # Optionally save the image to the specified location
+    image_name = None
+    if image_save_dir:
+        image_name = save_image_bytes(
+            image_bytes, image_save_dir, file_name, page_num, image_no, image[0]
+        )
+
+    # Load the encoded bytes as a Gemini Image Object
+    image_for_gemini = Image.from_bytes(image_bytes)
+
+    return image_for_gemini, image_name
+
+
+def get_image_bytes_from_pdf(doc: fitz.Document, image: tuple) -> bytes:
+    """Extracts an image from a PDF document and encodes it as JPEG bytes."""
+
     # Extract the image from the document
     xref = image[0]
     pix = fitz.Pixmap(doc, xref)
 
     # Convert the image to JPEG format
-    pix.tobytes("jpeg")
+    return pix.tobytes("jpeg")
+
+
+def save_image_bytes(
+    image_bytes: bytes,
+    image_save_dir: str,
+    file_name: str,
+    page_num: int,
+    image_no: int,
+    xref: int,
+) -> str:
+    """
+    Saves JPEG image bytes to `image_save_dir`.
+
+    Returns:
+        The path of the saved image.
+    """
 
     # Create the image file name
     image_name = f"{image_save_dir}/{file_name}_image_{page_num}_{image_no}_{xref}.jpeg"
@@ -251,12 +675,193 @@ def get_image_for_gemini(
     os.makedirs(image_save_dir, exist_ok=True)
 
     # Save the image to the specified location
-    pix.save(image_name)
+    with open(image_name, "wb") as f:
+        f.write(image_bytes)
 
-    # Load the saved image as a Gemini Image Object
-    image_for_gemini = Image.load_from_file(image_name)
+    return image_name
 
-    return image_for_gemini, image_name
+
+def get_image_hash(image_bytes: bytes, hash_size: int = 8) -> int:
+    """
+    Computes a perceptual hash of an image that is stable across re-encoding and resizing.
+
+    The low `hash_size * hash_size` bits are the difference hash (dHash) of the
+    grayscale image, and the bits above them hold its mean brightness in 16 levels so
+    that flat images of different shades do not collide.
+
+    Returns:
+        The hash as an integer.
+    """
+    with PIL.Image.open(io.BytesIO(image_bytes)) as pil_image:
+        pixels = np.asarray(
+            pil_image.convert("L").resize((hash_size + 1, hash_size)), dtype=np.int16
+        )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    difference_hash = int.from_bytes(np.packbits(bits).tobytes(), "big")
+    brightness = int(pixels.mean()) // 16
+    return (brightness << (hash_size * hash_size)) | difference_hash
+
+
+def get_image_content_hash(image_bytes: bytes) -> str:
+    """Returns the SHA-256 hash of an image's bytes."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class ImageDeduplicator:
+    """
+    Tracks the images seen across documents.
+
+    By default an image is only a duplicate if its bytes are identical to an image seen
+    before (same SHA-256 hash). Perceptual matching is opt-in: with `max_hash_distance`
+    set, an image is also a duplicate if its perceptual hash (see `get_image_hash`) is
+    within that many bits of an image seen before. Distinct images that look alike,
+    e.g. charts of the same layout, can then be matched.
+    """
+
+    def __init__(self, max_hash_distance: int | None = None) -> None:
+        self.max_hash_distance = max_hash_distance
+        self._images_by_content: dict[str, Any] = {}
+        self._images: dict[int, Any] = {}
+
+    def find(self, content_hash: str, image_hash: int) -> Any | None:
+        """Returns the value stored for a matching image, or None."""
+        value = self._images_by_content.get(content_hash)
+        if value is not None or self.max_hash_distance is None:
+            return value
+        if image_hash in self._images:
+            return self._images[image_hash]
+        for seen_hash, value in self._images.items():
+            if (seen_hash ^ image_hash).bit_count() <= self.max_hash_distance:
+                return value
+        return None
+
+    def add(self, content_hash: str, image_hash: int, value: Any) -> None:
+        """Stores a value for a new image."""
+        self._images_by_content[content_hash] = value
+        if self.max_hash_distance is not None:
+            self._images[image_hash] = value
+
+
+def parse_pdf_pages(
+    pdf_path: str,
+    page_nums: list[int],
+    character_limit: int = 1000,
+    overlap: int = 100,
+) -> list[dict]:
+    """
+    Extracts the text, text chunks and images of a range of pages of a PDF document.
+    Runs in a worker process, so it opens its own handle on the document.
+
+    Each distinct image (by xref) is encoded to JPEG once per call; later occurrences
+    on other pages of the range are skipped.
+
+    Args:
+        pdf_path: The path to the PDF document.
+        page_nums: The zero-based page numbers to parse.
+        character_limit: Maximum characters per chunk (defaults to 1000).
+        overlap: Number of overlapping characters between chunks (defaults to 100).
+
+    Returns:
+        One page record per page with the keys "page_num", "text", "chunked_text_dict"
+        and "images" (a list of dicts with the keys "image_no", "xref", "image_bytes",
+        "content_hash" and "image_hash").
+    """
+
+    page_records = []
+    seen_xrefs: set[int] = set()
+
+    with fitz.open(pdf_path) as doc:
+        for page_num in page_nums:
+            page = doc[page_num]
+            text, chunked_text_dict = get_page_text_and_chunks(
+                page, character_limit, overlap
+            )
+            images = []
+            for image_no, image in enumerate(page.get_images()):
+                xref = image[0]
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+                image_bytes = get_image_bytes_from_pdf(doc, image)
+                images.append(
+                    {
+                        "image_no": image_no,
+                        "xref": xref,
+                        "image_bytes": image_bytes,
+                        "content_hash": get_image_content_hash(image_bytes),
+                        "image_hash": get_image_hash(image_bytes),
+                    }
+                )
+            page_records.append(
+                {
+                    "page_num": page_num,
+                    "text": text,
+                    "chunked_text_dict": chunked_text_dict,
+                    "images": images,
+                }
+            )
+
+    return page_records
+
+
+def iter_pdf_page_records(
+    pdf_paths: list[str],
+    max_workers: int | None = None,
+    pages_per_task: int = 8,
+    max_pending_tasks: int | None = None,
+) -> Iterator[tuple[str, list[dict]]]:
+    """
+    Parses and chunks the pages of PDF documents on a process pool and streams the results.
+
+    Page ranges are submitted to the pool through a bounded queue of at most
+    `max_pending_tasks` tasks, so parsing runs ahead of the consumer without holding
+    the whole folder in memory. Results are yielded in document and page order.
+
+    Args:
+        pdf_paths: The paths to the PDF documents.
+        max_workers: Number of parser processes (defaults to the number of CPUs).
+            With 1, pages are parsed in the current process.
+        pages_per_task: Number of pages parsed per task.
+        max_pending_tasks: Maximum number of submitted tasks not yet consumed
+            (defaults to twice the number of workers).
+
+    Yields:
+        (pdf_path, page records) tuples, see `parse_pdf_pages`.
+    """
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending_tasks = max_pending_tasks or 2 * max_workers
+
+    def page_tasks() -> Iterator[tuple[str, list[int]]]:
+        for pdf_path in pdf_paths:
+            with fitz.open(pdf_path) as doc:
+                page_count = doc.page_count
+            for start in range(0, page_count, pages_per_task):
+                yield pdf_path, list(
+                    range(start, min(start + pages_per_task, page_count))
+                )
+
+    if max_workers == 1:
+        for pdf_path, page_nums in page_tasks():
+            yield pdf_path, parse_pdf_pages(pdf_path, page_nums)
+        return
+
+    # Workers are spawned rather than forked, as forking a process that already
+    # has gRPC clients (e.g. the embedding models) can deadlock the children
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        pending: deque[tuple[str, Future]] = deque()
+        for pdf_path, page_nums in page_tasks():
+            if len(pending) >= max_pending_tasks:
+                done_path, future = pending.popleft()
+                yield done_path, future.result()
+            pending.append(
+                (pdf_path, executor.submit(parse_pdf_pages, pdf_path, page_nums))
+            )
+        while pending:
+            done_path, future = pending.popleft()
+            yield done_path, future.result()
 
 
 def get_gemini_response(
@@ -323,26 +928,23 @@ def get_text_metadata_df(
         A Pandas DataFrame with the extracted text, chunk text, and chunk embeddings for each page.
     """
 
-    final_data_text: list[dict] = []
+    columns: dict[str, list] = {column: [] for column in TEXT_METADATA_COLUMNS}
 
     for key, values in text_metadata.items():
         for chunk_number, chunk_text in values["chunked_text_dict"].items():
-            data: dict = {}
-            data["file_name"] = filename
-            data["page_num"] = int(key) + 1
-            data["text"] = values["text"]
-            data["text_embedding_page"] = values["page_text_embeddings"][
-                "text_embedding"
-            ]
-            data["chunk_number"] = chunk_number
-            data["chunk_text"] = chunk_text
-            data["text_embedding_chunk"] = values["chunk_embeddings_dict"][chunk_number]
-
-            final_data_text.append(data)
+            columns["file_name"].append(filename)
+            columns["page_num"].append(int(key) + 1)
+            columns["text"].append(values["text"])
+            columns["text_embedding_page"].append(
+                values["page_text_embeddings"]["text_embedding"]
+            )
+            columns["chunk_number"].append(chunk_number)
+            columns["chunk_text"].append(chunk_text)
+            columns["text_embedding_chunk"].append(
+                values["chunk_embeddings_dict"][chunk_number]
+            )
 
-    return_df = pd.DataFrame(final_data_text)
-    return_df = return_df.reset_index(drop=True)
-    return return_df
+    return pd.DataFrame(columns)
 
 
 def get_image_metadata_df(
@@ -362,31 +964,208 @@ def get_image_metadata_df(
         A Pandas DataFrame with the extracted image path, image description, and image embeddings for each image.
     """
 
-    final_data_image: list[dict] = []
+    columns: dict[str, list] = {column: [] for column in IMAGE_METADATA_COLUMNS}
+
     for key, values in image_metadata.items():
         for _, image_values in values.items():
-            data: dict = {}
-            data["file_name"] = filename
-            data["page_num"] = int(key) + 1
-            data["img_num"] = int(image_values["img_num"])
-            data["img_path"] = image_values["img_path"]
-            data["img_desc"] = image_values["img_desc"]
-            # data["mm_embedding_from_text_desc_and_img"] = image_values[
-            #     "mm_embedding_from_text_desc_and_img"
-            # ]
-            data["mm_embedding_from_img_only"] = image_values[
-                "mm_embedding_from_img_only"
-            ]
-            data["text_embedding_from_image_description"] = image_values[
-                "text_embedding_from_image_description"
-            ]
-            final_data_image.append(data)
+            columns["file_name"].append(filename)
+            columns["page_num"].append(int(key) + 1)
+            columns["img_num"].append(int(image_values["img_num"]))
+            columns["img_path"].append(image_values["img_path"])
+            columns["img_desc"].append(image_values["img_desc"])
+            # columns["mm_embedding_from_text_desc_and_img"].append(
+            #     image_values["mm_embedding_from_text_desc_and_img"]
+            # )
+            columns["mm_embedding_from_img_only"].append(
+                image_values["mm_embedding_from_img_only"]
+            )
+            columns["text_embedding_from_image_description"].append(
+                image_values["text_embedding_from_image_description"]
+            )
 
-    return_df = pd.DataFrame(final_data_image).dropna()
+    return_df = pd.DataFrame(columns).dropna()
     return_df = return_df.reset_index(drop=True)
     return return_df
 
 
+class MetadataWriter:
+    """
+    Streams per-document text and image metadata DataFrames to Arrow IPC files.
+
+    Each call to `write` appends one record batch per file, with embeddings stored as
+    fixed-size float32 list columns, so the full metadata never has to be held in memory.
+    Use `load_document_metadata` to memory-map the result. Use as a context manager or
+    call `close` to finalize the files.
+    """
+
+    def __init__(self, output_dir: str) -> None:
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self._writers: dict[str, Any] = {}
+
+    def write(
+        self, text_metadata_df: pd.DataFrame, image_metadata_df: pd.DataFrame
+    ) -> None:
+        """Appends the metadata of one document."""
+        self._write_table(
+            TEXT_METADATA_FILE, text_metadata_df, TEXT_METADATA_EMBEDDING_COLUMNS
+        )
+        self._write_table(
+            IMAGE_METADATA_FILE, image_metadata_df, IMAGE_METADATA_EMBEDDING_COLUMNS
+        )
+
+    def _write_table(
+        self, file_name: str, dataframe: pd.DataFrame, embedding_columns: list[str]
+    ) -> None:
+        import pyarrow as pa
+
+        if dataframe.empty:
+            return
+
+        arrays = {}
+        for column in dataframe.columns:
+            if column in embedding_columns:
+                embeddings = np.asarray(dataframe[column].tolist(), dtype=np.float32)
+                arrays[column] = pa.FixedSizeListArray.from_arrays(
+                    pa.array(embeddings.ravel()), embeddings.shape[1]
+                )
+            else:
+                arrays[column] = pa.array(dataframe[column].tolist())
+        record_batch = pa.RecordBatch.from_pydict(arrays)
+
+        writer = self._writers.get(file_name)
+        if writer is None:
+            writer = pa.ipc.new_file(
+                os.path.join(self.output_dir, file_name), record_batch.schema
+            )
+            self._writers[file_name] = writer
+        writer.write_batch(record_batch)
+
+    def close(self) -> None:
+        """Finalizes the Arrow files."""
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+    def __enter__(self) -> "MetadataWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def load_document_metadata(output_dir: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Memory-maps the text and image metadata written by `MetadataWriter`.
+
+    Embedding columns hold read-only NumPy views into the memory-mapped files, so
+    loading does not copy or decode the embeddings.
+
+    Args:
+        output_dir: The directory the metadata was written to.
+
+    Returns:
+        A tuple containing the text metadata DataFrame and the image metadata DataFrame.
+    """
+
+    return (
+        _load_metadata_table(
+            os.path.join(output_dir, TEXT_METADATA_FILE),
+            TEXT_METADATA_COLUMNS,
+            TEXT_METADATA_EMBEDDING_COLUMNS,
+        ),
+        _load_metadata_table(
+            os.path.join(output_dir, IMAGE_METADATA_FILE),
+            IMAGE_METADATA_COLUMNS,
+            IMAGE_METADATA_EMBEDDING_COLUMNS,
+        ),
+    )
+
+
+def _load_metadata_table(
+    path: str, columns: list[str], embedding_columns: list[str]
+) -> pd.DataFrame:
+    import pyarrow as pa
+
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=columns)
+
+    table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    data = {}
+    for column in table.column_names:
+        chunked_array = table.column(column)
+        if column in embedding_columns:
+            data[column] = [
+                embedding
+                for chunk in chunked_array.chunks
+                for embedding in chunk.values.to_numpy(zero_copy_only=True).reshape(
+                    -1, chunk.type.list_size
+                )
+            ]
+        else:
+            data[column] = chunked_array.to_pandas()
+    return pd.DataFrame(data)
+
+
+def _embed_text_metadata(
+    text_metadata: dict[int | str, dict],
+    batch_size: int = TEXT_EMBEDDING_BATCH_SIZE,
+    rate_limiter: RateLimiter | None = None,
+) -> None:
+    """Embeds the page texts and chunks of a document in batched requests, in place."""
+
+    # Flatten page texts and chunks into one list of texts to embed
+    texts: list[str] = []
+    targets: list[tuple[dict, int | str]] = []
+    for values in text_metadata.values():
+        values["page_text_embeddings"] = {}
+        values["chunk_embeddings_dict"] = {}
+        if not values["text"]:
+            continue
+        texts.append(values["text"])
+        targets.append((values["page_text_embeddings"], "text_embedding"))
+        for chunk_number, chunk_text in values["chunked_text_dict"].items():
+            texts.append(chunk_text)
+            targets.append((values["chunk_embeddings_dict"], chunk_number))
+
+    text_embeddings = get_text_embeddings_from_text_embedding_model(
+        texts, batch_size=batch_size, rate_limiter=rate_limiter
+    )
+    for (embeddings_dict, key), text_embedding in zip(targets, text_embeddings):
+        embeddings_dict[key] = text_embedding
+
+
+def _describe_and_embed_image(
+    generative_multimodal_model,
+    image_bytes: bytes,
+    image_description_prompt: str,
+    embedding_size: int,
+    generation_config: GenerationConfig | None,
+    safety_settings: dict | None,
+    gemini_rate_limiter: RateLimiter,
+    multimodal_embedding_rate_limiter: RateLimiter,
+) -> tuple[str, list]:
+    """Generates the Gemini description and the multimodal embedding of one image."""
+
+    gemini_rate_limiter.acquire()
+    response = get_gemini_response(
+        generative_multimodal_model,
+        model_input=[image_description_prompt, Image.from_bytes(image_bytes)],
+        generation_config=generation_config,
+        safety_settings=safety_settings,
+        stream=True,
+    )
+
+    multimodal_embedding_rate_limiter.acquire()
+    image_embedding = get_image_embedding_from_multimodal_embedding_model(
+        image_bytes=image_bytes,
+        embedding_size=embedding_size,
+    )
+
+    return response, image_embedding
+
+
 def get_document_metadata(
     generative_multimodal_model,
     pdf_folder_path: str,
@@ -404,16 +1183,44 @@ def get_document_metadata(
     },
     add_sleep_after_page: bool = False,
     sleep_time_after_page: int = 2,
+    max_workers: int = 8,
+    parse_workers: int | None = None,
+    text_embedding_batch_size: int = TEXT_EMBEDDING_BATCH_SIZE,
+    text_embedding_requests_per_minute: float = 600,
+    gemini_requests_per_minute: float = 60,
+    multimodal_embedding_requests_per_minute: float = 120,
+    output_dir: str | None = None,
+    image_hash_distance: int | None = None,
 ) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
     This function takes a PDF path, an image save directory, an image description prompt, an embedding size, and a text embedding text limit as input.
 
+    PDF pages are parsed and chunked on a process pool (see `iter_pdf_page_records`) and
+    streamed to the embedding stage. Page texts and chunks are embedded in batched requests
+    once per document, and image descriptions and image embeddings run concurrently on a
+    bounded thread pool. All API calls go through token-bucket rate limiters sized by the
+    `*_requests_per_minute` quotas.
+
     Args:
         pdf_path: The path to the PDF document.
         image_save_dir: The directory where extracted images should be saved.
         image_description_prompt: A prompt to guide Gemini for generating image descriptions.
         embedding_size: The dimensionality of the embedding vectors.
-        text_emb_text_limit: The maximum number of tokens for text embedding.
+        add_sleep_after_page: Deprecated and ignored; use the `*_requests_per_minute` quotas instead.
+        sleep_time_after_page: Deprecated and ignored.
+        max_workers: Maximum number of images described and embedded concurrently.
+        parse_workers: Number of processes parsing and chunking PDF pages (defaults to the number of CPUs).
+        text_embedding_batch_size: Maximum number of texts per text embedding request.
+        text_embedding_requests_per_minute: Quota for text embedding requests.
+        gemini_requests_per_minute: Quota for Gemini image description requests.
+        multimodal_embedding_requests_per_minute: Quota for multimodal embedding requests.
+        output_dir: If set, the metadata of each document is streamed to Arrow files in
+            this directory with `MetadataWriter`, and the returned DataFrames are
+            memory-mapped from them with `load_document_metadata`.
+        image_hash_distance: If set, images whose perceptual hashes are within this many
+            bits are also treated as the same image, otherwise only images with identical
+            bytes are. Repeated images are described and embedded once: they are kept
+            once per document and reuse the results across documents.
 
     Returns:
         A tuple containing two DataFrames:
@@ -421,9 +1228,33 @@ def get_document_metadata(
             * Another DataFrame containing the extracted image metadata for each image in the PDF, including the image path, image description, image embeddings (with and without context), and image description text embedding.
     """
 
-    text_metadata_df_final, image_metadata_df_final = pd.DataFrame(), pd.DataFrame()
+    if add_sleep_after_page:
+        print(
+            "add_sleep_after_page is deprecated and ignored. API calls are rate limited with the *_requests_per_minute arguments instead."
+        )
+
+    text_embedding_rate_limiter = RateLimiter(text_embedding_requests_per_minute)
+    gemini_rate_limiter = RateLimiter(gemini_requests_per_minute)
+    multimodal_embedding_rate_limiter = RateLimiter(
+        multimodal_embedding_requests_per_minute
+    )
+
+    text_metadata_dfs: list[pd.DataFrame] = []
+    image_metadata_dfs: list[pd.DataFrame] = []
+    metadata_writer = MetadataWriter(output_dir) if output_dir else None
+
+    page_records = iter_pdf_page_records(
+        glob.glob(pdf_folder_path + "/*.pdf"),
+        max_workers=parse_workers,
+    )
+
+    # Maps each distinct image to the file it was first seen in, its description and
+    # embedding future and its saved path
+    image_deduplicator = ImageDeduplicator(max_hash_distance=image_hash_distance)
 
-    for pdf_path in glob.glob(pdf_folder_path + "/*.pdf"):
+    for pdf_path, record_batches in itertools.groupby(
+        page_records, key=lambda item: item[0]
+    ):
         print(
             "\n\n",
             "Processing the file: ---------------------------------",
@@ -431,98 +1262,136 @@ def get_document_metadata(
             "\n\n",
         )
 
-        # Open the PDF file
-        doc: fitz.Document = fitz.open(pdf_path)
-
         file_name = pdf_path.split("/")[-1]
 
         text_metadata: dict[int | str, dict] = {}
         image_metadata: dict[int | str, dict] = {}
 
-        for page_num, page in enumerate(doc):
-            print(f"Processing page: {page_num + 1}")
-
-            text = page.get_text()
-            (
-                text,
-                page_text_embeddings_dict,
-                chunked_text_dict,
-                chunk_embeddings_dict,
-            ) = get_chunk_text_metadata(page, embedding_size=embedding_size)
-
-            text_metadata[page_num] = {
-                "text": text,
-                "page_text_embeddings": page_text_embeddings_dict,
-                "chunked_text_dict": chunked_text_dict,
-                "chunk_embeddings_dict": chunk_embeddings_dict,
-            }
-
-            images = page.get_images()
-            image_metadata[page_num] = {}
-
-            for image_no, image in enumerate(images):
-                image_number = int(image_no + 1)
-                image_metadata[page_num][image_number] = {}
-
-                image_for_gemini, image_name = get_image_for_gemini(
-                    doc, image, image_no, image_save_dir, file_name, page_num
-                )
-
-                print(
-                    f"Extracting image from page: {page_num + 1}, saved as: {image_name}"
-                )
-
-                response = get_gemini_response(
-                    generative_multimodal_model,
-                    model_input=[image_description_prompt, image_for_gemini],
-                    generation_config=generation_config,
-                    safety_settings=safety_settings,
-                    stream=True,
-                )
-
-                image_embedding = get_image_embedding_from_multimodal_embedding_model(
-                    image_uri=image_name,
-                    embedding_size=embedding_size,
-                )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            image_futures = {}
+
+            for _, page_record_batch in record_batches:
+                for page_record in page_record_batch:
+                    page_num = page_record["page_num"]
+                    print(f"Processing page: {page_num + 1}")
+
+                    text_metadata[page_num] = {
+                        "text": page_record["text"],
+                        "chunked_text_dict": page_record["chunked_text_dict"],
+                    }
+
+                    image_metadata[page_num] = {}
+
+                    for image in page_record["images"]:
+                        image_number = int(image["image_no"] + 1)
+                        seen_image = image_deduplicator.find(
+                            image["content_hash"], image["image_hash"]
+                        )
+
+                        if seen_image is None:
+                            image_name = save_image_bytes(
+                                image["image_bytes"],
+                                image_save_dir,
+                                file_name,
+                                page_num,
+                                image["image_no"],
+                                image["xref"],
+                            )
+                            print(
+                                f"Extracting image from page: {page_num + 1}, saved as: {image_name}"
+                            )
+                            future = executor.submit(
+                                _describe_and_embed_image,
+                                generative_multimodal_model,
+                                image["image_bytes"],
+                                image_description_prompt,
+                                embedding_size,
+                                generation_config,
+                                safety_settings,
+                                gemini_rate_limiter,
+                                multimodal_embedding_rate_limiter,
+                            )
+                            image_deduplicator.add(
+                                image["content_hash"],
+                                image["image_hash"],
+                                (file_name, future, image_name),
+                            )
+                        else:
+                            seen_file_name, future, image_name = seen_image
+                            # Repeated images only appear once per document
+                            if seen_file_name == file_name:
+                                continue
+                            # Reuse the results of an image seen in an earlier document
+                            image_deduplicator.add(
+                                image["content_hash"],
+                                image["image_hash"],
+                                (file_name, future, image_name),
+                            )
+
+                        image_metadata[page_num][image_number] = {
+                            "img_num": image_number,
+                            "img_path": image_name,
+                        }
+                        image_futures[(page_num, image_number)] = future
+
+            # Embed page texts and chunks while the image requests are in flight
+            _embed_text_metadata(
+                text_metadata,
+                batch_size=text_embedding_batch_size,
+                rate_limiter=text_embedding_rate_limiter,
+            )
 
-                image_description_text_embedding = (
-                    get_text_embedding_from_text_embedding_model(text=response)
+            for (page_num, image_number), future in image_futures.items():
+                response, image_embedding = future.result()
+                image_metadata[page_num][image_number].update(
+                    {
+                        "img_desc": response,
+                        # "mm_embedding_from_text_desc_and_img": image_embedding_with_description,
+                        "mm_embedding_from_img_only": image_embedding,
+                    }
                 )
 
-                image_metadata[page_num][image_number] = {
-                    "img_num": image_number,
-                    "img_path": image_name,
-                    "img_desc": response,
-                    # "mm_embedding_from_text_desc_and_img": image_embedding_with_description,
-                    "mm_embedding_from_img_only": image_embedding,
-                    "text_embedding_from_image_description": image_description_text_embedding,
-                }
-
-            # Add sleep to reduce issues with Quota error on API
-            if add_sleep_after_page:
-                time.sleep(sleep_time_after_page)
-                print(
-                    "Sleeping for ",
-                    sleep_time_after_page,
-                    """ sec before processing the next page to avoid quota issues. You can disable it: "add_sleep_after_page = False"  """,
-                )
+        # Embed all image descriptions of the document in batched requests
+        image_values_list = [
+            image_values
+            for page_images in image_metadata.values()
+            for image_values in page_images.values()
+        ]
+        image_description_text_embeddings = (
+            get_text_embeddings_from_text_embedding_model(
+                [image_values["img_desc"] for image_values in image_values_list],
+                batch_size=text_embedding_batch_size,
+                rate_limiter=text_embedding_rate_limiter,
+            )
+        )
+        for image_values, image_description_text_embedding in zip(
+            image_values_list, image_description_text_embeddings
+        ):
+            image_values[
+                "text_embedding_from_image_description"
+            ] = image_description_text_embedding
 
         text_metadata_df = get_text_metadata_df(file_name, text_metadata)
-        image_metadata_df = get_image_metadata_df(file_name, image_metadata)
+        image_metadata_df = get_image_metadata_df(
+            file_name, image_metadata
+        ).drop_duplicates(subset=["img_desc"])
 
-        text_metadata_df_final = pd.concat(
-            [text_metadata_df_final, text_metadata_df], axis=0
-        )
-        image_metadata_df_final = pd.concat(
-            [
-                image_metadata_df_final,
-                image_metadata_df.drop_duplicates(subset=["img_desc"]),
-            ],
-            axis=0,
-        )
+        if metadata_writer:
+            metadata_writer.write(text_metadata_df, image_metadata_df)
+        else:
+            text_metadata_dfs.append(text_metadata_df)
+            image_metadata_dfs.append(image_metadata_df)
 
-        text_metadata_df_final = text_metadata_df_final.reset_index(drop=True)
-        image_metadata_df_final = image_metadata_df_final.reset_index(drop=True)
+    if metadata_writer:
+        metadata_writer.close()
+        return load_document_metadata(output_dir)
+
+    text_metadata_df_final = pd.concat(
+        text_metadata_dfs or [pd.DataFrame()], axis=0, ignore_index=True
+    )
+    image_metadata_df_final = pd.concat(
+        image_metadata_dfs or [pd.DataFrame()], axis=0, ignore_index=True
+    )
 
     return text_metadata_df_final, image_metadata_df_final
 
@@ -582,6 +1451,84 @@ def get_cosine_score(
     return round(np.dot(dataframe[column_name], input_text_embed), 2)
 
 
+class EmbeddingMatrix:
+    """
+    Packs an embedding column of a metadata DataFrame into a contiguous float32 matrix
+    so a query is scored with a single matrix-vector product instead of a per-row apply.
+
+    Row `i` of the matrix corresponds to positional row `i` of the DataFrame.
+    """
+
+    def __init__(self, dataframe: pd.DataFrame, column_name: str) -> None:
+        if column_name not in dataframe.columns:
+            raise KeyError(f"Column '{column_name}' not found in the dataframe")
+        self.column_name = column_name
+        self.matrix = np.ascontiguousarray(
+            np.array(dataframe[column_name].tolist(), dtype=np.float32, ndmin=2)
+        )
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def top_k(
+        self,
+        query_embeddings: np.ndarray | list,
+        top_n: int,
+        max_score: float | None = None,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Finds the top N rows by cosine similarity for one or more query embeddings.
+
+        Args:
+            query_embeddings: A single embedding or a 2D array with one embedding per query.
+            top_n: The number of rows to return per query.
+            max_score: If set, rows scoring at or above this value are skipped.
+
+        Returns:
+            One (row positions, scores) tuple per query, sorted by descending score.
+            Scores are rounded to two decimal places like `get_cosine_score`.
+        """
+        queries = np.array(query_embeddings, dtype=np.float32, ndmin=2)
+        if len(self) == 0:
+            return [(np.empty(0, dtype=int), np.empty(0)) for _ in queries]
+
+        scores = np.round((queries @ self.matrix.T).astype(np.float64), 2)
+        if max_score is not None:
+            scores[scores >= max_score] = -np.inf
+
+        k = min(top_n, len(self))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        results = []
+        for positions, row_scores in zip(top, top_scores):
+            keep = np.isfinite(row_scores)
+            results.append((positions[keep], row_scores[keep]))
+        return results
+
+
+_embedding_matrix_cache: dict[tuple[int, str], EmbeddingMatrix] = {}
+
+
+def get_embedding_matrix(dataframe: pd.DataFrame, column_name: str) -> EmbeddingMatrix:
+    """
+    Returns the EmbeddingMatrix for a DataFrame column, packing it on first use.
+    The packed matrix is reused until the DataFrame is garbage collected or changes length.
+    Create a new EmbeddingMatrix directly if embeddings are modified in place.
+    """
+    key = (id(dataframe), column_name)
+    embedding_matrix = _embedding_matrix_cache.get(key)
+    if embedding_matrix is None or len(embedding_matrix) != len(dataframe):
+        if key not in _embedding_matrix_cache:
+            weakref.finalize(dataframe, _embedding_matrix_cache.pop, key, None)
+        embedding_matrix = EmbeddingMatrix(dataframe, column_name)
+        _embedding_matrix_cache[key] = embedding_matrix
+    return embedding_matrix
+
+
 def print_text_to_image_citation(
     final_images: dict[int, dict[str, Any]], print_top: bool = True
 ) -> None:
@@ -686,88 +1633,39 @@ def print_text_to_text_citation(
             break
 
 
-def get_similar_image_from_query(
+def _get_image_matches(
     text_metadata_df: pd.DataFrame,
     image_metadata_df: pd.DataFrame,
-    query: str = "",
-    image_query_path: str = "",
-    column_name: str = "",
-    image_emb: bool = True,
-    top_n: int = 3,
-    embedding_size: int = 128,
+    positions: np.ndarray,
+    scores: np.ndarray,
 ) -> dict[int, dict[str, Any]]:
-    """
-    Finds the top N most similar images from a metadata DataFrame based on a text query or an image query.
-
-    Args:
-        text_metadata_df: A Pandas DataFrame containing text metadata associated with the images.
-        image_metadata_df: A Pandas DataFrame containing image metadata (paths, descriptions, etc.).
-        query: The text query used for finding similar images (if image_emb is False).
-        image_query_path: The path to the image used for finding similar images (if image_emb is True).
-        column_name: The column name in the image_metadata_df containing the image embeddings or captions.
-        image_emb: Whether to use image embeddings (True) or text captions (False) for comparisons.
-        top_n: The number of most similar images to return.
-        embedding_size: The dimensionality of the image embeddings (only used if image_emb is True).
-
-    Returns:
-        A dictionary containing information about the top N most similar images, including cosine scores, image objects, paths, page numbers, text excerpts, and descriptions.
-    """
-    # Check if image embedding is used
-    if image_emb:
-        # Calculate cosine similarity between query image and metadata images
-        user_query_image_embedding = get_user_query_image_embeddings(
-            image_query_path, embedding_size
-        )
-        cosine_scores = image_metadata_df.apply(
-            lambda x: get_cosine_score(x, column_name, user_query_image_embedding),
-            axis=1,
-        )
-    else:
-        # Calculate cosine similarity between query text and metadata image captions
-        user_query_text_embedding = get_user_query_text_embeddings(query)
-        cosine_scores = image_metadata_df.apply(
-            lambda x: get_cosine_score(x, column_name, user_query_text_embedding),
-            axis=1,
-        )
-
-    # Remove same image comparison score when user image is matched exactly with metadata image
-    cosine_scores = cosine_scores[cosine_scores < 1.0]
-
-    # Get top N cosine scores and their indices
-    top_n_cosine_scores = cosine_scores.nlargest(top_n).index.tolist()
-    top_n_cosine_values = cosine_scores.nlargest(top_n).values.tolist()
+    """Builds the matched image dictionary for row positions in image_metadata_df."""
 
     # Create a dictionary to store matched images and their information
     final_images: dict[int, dict[str, Any]] = {}
 
-    for matched_imageno, indexvalue in enumerate(top_n_cosine_scores):
+    for matched_imageno, (position, score) in enumerate(zip(positions, scores)):
+        image_row = image_metadata_df.iloc[position]
+
         # Create a sub-dictionary for each matched image
         final_images[matched_imageno] = {}
 
         # Store cosine score
-        final_images[matched_imageno]["cosine_score"] = top_n_cosine_values[
-            matched_imageno
-        ]
+        final_images[matched_imageno]["cosine_score"] = float(score)
 
         # Load image from file
         final_images[matched_imageno]["image_object"] = Image.load_from_file(
-            image_metadata_df.iloc[indexvalue]["img_path"]
+            image_row["img_path"]
         )
 
         # Add file name
-        final_images[matched_imageno]["file_name"] = image_metadata_df.iloc[indexvalue][
-            "file_name"
-        ]
+        final_images[matched_imageno]["file_name"] = image_row["file_name"]
 
         # Store image path
-        final_images[matched_imageno]["img_path"] = image_metadata_df.iloc[indexvalue][
-            "img_path"
-        ]
+        final_images[matched_imageno]["img_path"] = image_row["img_path"]
 
         # Store page number
-        final_images[matched_imageno]["page_num"] = image_metadata_df.iloc[indexvalue][
-            "page_num"
-        ]
+        final_images[matched_imageno]["page_num"] = image_row["page_num"]
 
         final_images[matched_imageno]["page_text"] = np.unique(
             text_metadata_df[
@@ -785,13 +1683,139 @@ def get_similar_image_from_query(
         )
 
         # Store image description
-        final_images[matched_imageno]["image_description"] = image_metadata_df.iloc[
-            indexvalue
-        ]["img_desc"]
+        final_images[matched_imageno]["image_description"] = image_row["img_desc"]
 
     return final_images
 
 
+def _get_text_matches(
+    text_metadata_df: pd.DataFrame,
+    positions: np.ndarray,
+    scores: np.ndarray,
+    chunk_text: bool = True,
+) -> dict[int, dict[str, Any]]:
+    """Builds the matched text dictionary for row positions in text_metadata_df."""
+
+    # Create a dictionary to store matched text and their information
+    final_text: dict[int, dict[str, Any]] = {}
+
+    for matched_textno, (position, score) in enumerate(zip(positions, scores)):
+        text_row = text_metadata_df.iloc[position]
+
+        # Create a sub-dictionary for each matched text
+        final_text[matched_textno] = {}
+
+        # Store file name
+        final_text[matched_textno]["file_name"] = text_row["file_name"]
+
+        # Store page number
+        final_text[matched_textno]["page_num"] = text_row["page_num"]
+
+        # Store cosine score
+        final_text[matched_textno]["cosine_score"] = float(score)
+
+        if chunk_text:
+            # Store chunk number
+            final_text[matched_textno]["chunk_number"] = text_row["chunk_number"]
+
+            # Store chunk text
+            final_text[matched_textno]["chunk_text"] = text_row["chunk_text"]
+        else:
+            # Store page text
+            final_text[matched_textno]["text"] = text_row["text"]
+
+    return final_text
+
+
+def get_similar_image_from_query(
+    text_metadata_df: pd.DataFrame,
+    image_metadata_df: pd.DataFrame,
+    query: str = "",
+    image_query_path: str = "",
+    column_name: str = "",
+    image_emb: bool = True,
+    top_n: int = 3,
+    embedding_size: int = 128,
+) -> dict[int, dict[str, Any]]:
+    """
+    Finds the top N most similar images from a metadata DataFrame based on a text query or an image query.
+
+    Args:
+        text_metadata_df: A Pandas DataFrame containing text metadata associated with the images.
+        image_metadata_df: A Pandas DataFrame containing image metadata (paths, descriptions, etc.).
+        query: The text query used for finding similar images (if image_emb is False).
+        image_query_path: The path to the image used for finding similar images (if image_emb is True).
+        column_name: The column name in the image_metadata_df containing the image embeddings or captions.
+        image_emb: Whether to use image embeddings (True) or text captions (False) for comparisons.
+        top_n: The number of most similar images to return.
+        embedding_size: The dimensionality of the image embeddings (only used if image_emb is True).
+
+    Returns:
+        A dictionary containing information about the top N most similar images, including cosine scores, image objects, paths, page numbers, text excerpts, and descriptions.
+    """
+    return get_similar_image_from_queries(
+        text_metadata_df,
+        image_metadata_df,
+        queries=[query],
+        image_query_paths=[image_query_path],
+        column_name=column_name,
+        image_emb=image_emb,
+        top_n=top_n,
+        embedding_size=embedding_size,
+    )[0]
+
+
+def get_similar_image_from_queries(
+    text_metadata_df: pd.DataFrame,
+    image_metadata_df: pd.DataFrame,
+    queries: list[str] | None = None,
+    image_query_paths: list[str] | None = None,
+    column_name: str = "",
+    image_emb: bool = True,
+    top_n: int = 3,
+    embedding_size: int = 128,
+) -> list[dict[int, dict[str, Any]]]:
+    """
+    Batch version of `get_similar_image_from_query`. All queries are scored against
+    the packed image embeddings in a single matrix product.
+
+    Args:
+        text_metadata_df: A Pandas DataFrame containing text metadata associated with the images.
+        image_metadata_df: A Pandas DataFrame containing image metadata (paths, descriptions, etc.).
+        queries: The text queries used for finding similar images (if image_emb is False).
+        image_query_paths: The paths to the query images (if image_emb is True).
+        column_name: The column name in the image_metadata_df containing the image embeddings.
+        image_emb: Whether to use image embeddings (True) or text captions (False) for comparisons.
+        top_n: The number of most similar images to return per query.
+        embedding_size: The dimensionality of the image embeddings (only used if image_emb is True).
+
+    Returns:
+        A list with one matched image dictionary per query, in the same order as the queries.
+    """
+    # Check if image embedding is used
+    if image_emb:
+        query_embeddings = [
+            get_user_query_image_embeddings(image_query_path, embedding_size)
+            for image_query_path in image_query_paths or []
+        ]
+    else:
+        query_embeddings = [
+            get_user_query_text_embeddings(query) for query in queries or []
+        ]
+    if not query_embeddings:
+        return []
+
+    # Remove same image comparison score when user image is matched exactly with metadata image
+    matches = get_embedding_matrix(image_metadata_df, column_name).top_k(
+        query_embeddings, top_n, max_score=1.0
+    )
+
+    return [
+        _get_image_matches(text_metadata_df, image_metadata_df, positions, scores)
+        for positions, scores in matches
+    ]
+
+
 def get_similar_text_from_query(
     query: str,
     text_metadata_df: pd.DataFrame,
@@ -819,64 +1843,62 @@ def get_similar_text_from_query(
         KeyError: If the specified `column_name` is not present in the `text_metadata_df`.
     """
 
-    if column_name not in text_metadata_df.columns:
-        raise KeyError(f"Column '{column_name}' not found in the 'text_metadata_df'")
-
-    query_vector = get_user_query_text_embeddings(query)
+    final_text = get_similar_text_from_queries(
+        [query],
+        text_metadata_df,
+        column_name=column_name,
+        top_n=top_n,
+        chunk_text=chunk_text,
+    )[0]
 
-    # Calculate cosine similarity between query text and metadata text
-    cosine_scores = text_metadata_df.apply(
-        lambda row: get_cosine_score(
-            row,
-            column_name,
-            query_vector,
-        ),
-        axis=1,
-    )
+    # Optionally print citations immediately
+    if print_citation:
+        print_text_to_text_citation(final_text, chunk_text=chunk_text)
 
-    # Get top N cosine scores and their indices
-    top_n_indices = cosine_scores.nlargest(top_n).index.tolist()
-    top_n_scores = cosine_scores.nlargest(top_n).values.tolist()
+    return final_text
 
-    # Create a dictionary to store matched text and their information
-    final_text: dict[int, dict[str, Any]] = {}
 
-    for matched_textno, index in enumerate(top_n_indices):
-        # Create a sub-dictionary for each matched text
-        final_text[matched_textno] = {}
+def get_similar_text_from_queries(
+    queries: list[str],
+    text_metadata_df: pd.DataFrame,
+    column_name: str = "",
+    top_n: int = 3,
+    chunk_text: bool = True,
+) -> list[dict[int, dict[str, Any]]]:
+    """
+    Batch version of `get_similar_text_from_query`. All queries are scored against
+    the packed text embeddings in a single matrix product.
 
-        # Store page number
-        final_text[matched_textno]["file_name"] = text_metadata_df.iloc[index][
-            "file_name"
-        ]
+    Args:
+        queries: The text queries used for finding similar passages.
+        text_metadata_df: A Pandas DataFrame containing the text metadata to search.
+        column_name: The column name in the text_metadata_df containing the text embeddings.
+        top_n: The number of most similar text passages to return per query.
+        chunk_text: Whether to return individual text chunks (True) or the entire page text (False).
 
-        # Store page number
-        final_text[matched_textno]["page_num"] = text_metadata_df.iloc[index][
-            "page_num"
-        ]
+    Returns:
+        A list with one matched text dictionary per query, in the same order as the queries.
 
-        # Store cosine score
-        final_text[matched_textno]["cosine_score"] = top_n_scores[matched_textno]
+    Raises:
+        KeyError: If the specified `column_name` is not present in the `text_metadata_df`.
+    """
 
-        if chunk_text:
-            # Store chunk number
-            final_text[matched_textno]["chunk_number"] = text_metadata_df.iloc[index][
-                "chunk_number"
-            ]
+    if column_name not in text_metadata_df.columns:
+        raise KeyError(f"Column '{column_name}' not found in the 'text_metadata_df'")
+    if not queries:
+        return []
 
-            # Store chunk text
-            final_text[matched_textno]["chunk_text"] = text_metadata_df["chunk_text"][
-                index
-            ]
-        else:
-            # Store page text
-            final_text[matched_textno]["text"] = text_metadata_df["text"][index]
+    query_vectors = [get_user_query_text_embeddings(query) for query in queries]
 
-    # Optionally print citations immediately
-    if print_citation:
-        print_text_to_text_citation(final_text, chunk_text=chunk_text)
+    # Calculate cosine similarity between all queries and metadata text at once
+    matches = get_embedding_matrix(text_metadata_df, column_name).top_k(
+        query_vectors, top_n
+    )
 
-    return final_text
+    return [
+        _get_text_matches(text_metadata_df, positions, scores, chunk_text=chunk_text)
+        for positions, scores in matches
+    ]
 
 
 def display_images(